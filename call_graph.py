@@ -0,0 +1,351 @@
+"""Граф звонков для быстрых запросов из чата: связи номера, общие контакты, пути до группы.
+
+Номера интернируются в целые id (id - позиция в отсортированном массиве
+номеров, поиск номера - бинарный). Смежность хранится в CSR: соседи узла u -
+indices[indptr[u]:indptr[u + 1]], для каждого ребра - число звонков в обе
+стороны и даты первого и последнего. Граф неориентированный: ребро u-v есть у
+обоих узлов. Все массивы - .npy в одном каталоге, открываются через memmap.
+
+python call_graph.py --input calls.csv --output call_graph
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+ARRAYS = ('numbers', 'group_of', 'indptr', 'indices', 'calls_out', 'calls_in', 'first', 'last')
+META_FILE = 'meta.json'
+# Сколько частичных агрегатов ребер копить, прежде чем слить их в один
+MERGE_EVERY = 8
+
+
+def merge_edges(parts):
+    import pandas as pd
+
+    edges = pd.concat(parts, ignore_index=True)
+    return edges.groupby(['src', 'dst'], sort=False).agg(
+        count=('count', 'sum'), first=('first', 'min'), last=('last', 'max')
+    ).reset_index()
+
+
+def build_graph(path: str, out_dir: str, chunksize: int = 1_000_000) -> Dict[str, Any]:
+    """Построение графа по журналу звонков (CSV или Parquet), файл читается кусками"""
+    import pandas as pd
+    from know_stats import read_chunks
+
+    started = time.perf_counter()
+    rows = 0
+    edge_parts = []
+    group_parts = []
+    for chunk in read_chunks(path, chunksize):
+        rows += len(chunk)
+        chunk = chunk.dropna(subset=['tlf_call', 'tlf_to'])
+        # Звонок самому себе связью не считается
+        chunk = chunk[chunk['tlf_call'] != chunk['tlf_to']]
+        dates = pd.to_datetime(chunk['date']).to_numpy('datetime64[ns]').view('int64')
+        calls = pd.DataFrame({'src': chunk['tlf_call'].to_numpy(), 'dst': chunk['tlf_to'].to_numpy(), 'date': dates})
+        edge_parts.append(calls.groupby(['src', 'dst'], sort=False)['date'].agg(
+            count='size', first='min', last='max'
+        ).reset_index())
+        if len(edge_parts) >= MERGE_EVERY:
+            edge_parts = [merge_edges(edge_parts)]
+
+        # Группа номера - последняя известная из любой стороны звонка (стороны чередуются в порядке строк)
+        groups = pd.DataFrame({
+            'number': np.column_stack([chunk['tlf_call'].to_numpy(), chunk['tlf_to'].to_numpy()]).ravel(),
+            'group': np.column_stack([chunk['group_call'].to_numpy(), chunk['group_to'].to_numpy()]).ravel()
+        }).dropna()
+        group_parts.append(groups.drop_duplicates('number', keep='last'))
+
+    edges = merge_edges(edge_parts) if edge_parts else pd.DataFrame(
+        {'src': [], 'dst': [], 'count': [], 'first': [], 'last': []}
+    )
+
+    # Интернирование: id номера - его позиция в отсортированном массиве
+    src_numbers = edges['src'].to_numpy().astype(str)
+    dst_numbers = edges['dst'].to_numpy().astype(str)
+    numbers = np.unique(np.concatenate([src_numbers, dst_numbers]))
+    src = np.searchsorted(numbers, src_numbers)
+    dst = np.searchsorted(numbers, dst_numbers)
+
+    # Каждый звонок a -> b дает ребро a-b (исходящий для a) и b-a (входящий для b)
+    count = edges['count'].to_numpy(np.int64)
+    zeros = np.zeros_like(count)
+    symmetric = pd.DataFrame({
+        'u': np.concatenate([src, dst]),
+        'v': np.concatenate([dst, src]),
+        'calls_out': np.concatenate([count, zeros]),
+        'calls_in': np.concatenate([zeros, count]),
+        'first': np.tile(edges['first'].to_numpy(np.int64), 2),
+        'last': np.tile(edges['last'].to_numpy(np.int64), 2)
+    }).groupby(['u', 'v'], sort=True).agg(
+        calls_out=('calls_out', 'sum'), calls_in=('calls_in', 'sum'), first=('first', 'min'), last=('last', 'max')
+    ).reset_index()
+
+    indptr = np.zeros(len(numbers) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(symmetric['u'].to_numpy(), minlength=len(numbers)), out=indptr[1:])
+
+    group_of = np.full(len(numbers), -1, dtype=np.int32)
+    group_names: List[str] = []
+    if group_parts:
+        groups = pd.concat(group_parts, ignore_index=True).drop_duplicates('number', keep='last')
+        group_names = sorted(groups['group'].astype(str).unique().tolist())
+        group_numbers = groups['number'].to_numpy().astype(str)
+        position = np.minimum(np.searchsorted(numbers, group_numbers), max(len(numbers) - 1, 0))
+        present = (numbers[position] == group_numbers) if len(numbers) else np.zeros(0, dtype=bool)
+        group_of[position[present]] = np.searchsorted(group_names, groups['group'].astype(str).to_numpy()[present])
+
+    arrays = {
+        'numbers': numbers,
+        'group_of': group_of,
+        'indptr': indptr,
+        'indices': symmetric['v'].to_numpy(np.int64),
+        'calls_out': symmetric['calls_out'].to_numpy(np.int64),
+        'calls_in': symmetric['calls_in'].to_numpy(np.int64),
+        'first': symmetric['first'].to_numpy(np.int64),
+        'last': symmetric['last'].to_numpy(np.int64)
+    }
+    meta = {
+        'source': os.path.abspath(path),
+        'rows': rows,
+        'nodes': len(numbers),
+        'edges': len(symmetric) // 2,
+        'groups': group_names,
+        'built_at': datetime.now().isoformat(timespec='seconds'),
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+    # Пишем во временный каталог и переименовываем: бот не увидит наполовину записанный граф
+    tmp = out_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, f'{name}.npy'), values)
+    with open(os.path.join(tmp, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp, out_dir)
+    return meta
+
+
+def format_date(ns: int) -> str:
+    return (datetime(1970, 1, 1) + timedelta(microseconds=int(ns) // 1000)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class CallGraph:
+    """Запросы к построенному графу. Массивы открыты через memmap и в память целиком не читаются"""
+
+    def __init__(self, path: str):
+        self.path = path
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.groups: List[str] = self.meta['groups']
+        self.mtime = os.path.getmtime(os.path.join(path, META_FILE))
+
+    def node(self, number: str) -> Optional[int]:
+        position = int(np.searchsorted(self.numbers, number))
+        if position < len(self.numbers) and self.numbers[position] == number:
+            return position
+        return None
+
+    def group_name(self, node: int) -> Optional[str]:
+        group = int(self.group_of[node])
+        return self.groups[group] if group >= 0 else None
+
+    def find_group(self, name: str) -> Optional[int]:
+        lowered = name.strip().lower()
+        return next((i for i, group in enumerate(self.groups) if group.lower() == lowered), None)
+
+    def _totals(self, start: int, end: int) -> np.ndarray:
+        return np.asarray(self.calls_out[start:end]) + np.asarray(self.calls_in[start:end])
+
+    def _edge(self, position: int) -> Dict[str, Any]:
+        neighbour = int(self.indices[position])
+        return {
+            'number': str(self.numbers[neighbour]),
+            'group': self.group_name(neighbour),
+            'calls_out': int(self.calls_out[position]),
+            'calls_in': int(self.calls_in[position]),
+            'first': format_date(self.first[position]),
+            'last': format_date(self.last[position])
+        }
+
+    def neighbours(self, number: str, limit: int = 20) -> Optional[Dict[str, Any]]:
+        """Связи номера, самые частые первыми. None - номера нет в графе"""
+        node = self.node(number)
+        if node is None:
+            return None
+        start, end = int(self.indptr[node]), int(self.indptr[node + 1])
+        order = np.argsort(-self._totals(start, end), kind='stable')[:limit]
+        return {
+            'number': number,
+            'group': self.group_name(node),
+            'degree': end - start,
+            'contacts': [self._edge(start + int(i)) for i in order]
+        }
+
+    def shared_contacts(self, first: str, second: str, limit: int = 20) -> Optional[List[Dict[str, Any]]]:
+        """Номера, с которыми связаны оба. None - одного из номеров нет в графе"""
+        a, b = self.node(first), self.node(second)
+        if a is None or b is None:
+            return None
+        a_start, a_end = int(self.indptr[a]), int(self.indptr[a + 1])
+        b_start, b_end = int(self.indptr[b]), int(self.indptr[b + 1])
+        # Соседи в CSR отсортированы, пересечение - слиянием
+        common, a_pos, b_pos = np.intersect1d(
+            self.indices[a_start:a_end], self.indices[b_start:b_end], assume_unique=True, return_indices=True
+        )
+        weight = self._totals(a_start, a_end)[a_pos] + self._totals(b_start, b_end)[b_pos]
+        order = np.argsort(-weight, kind='stable')[:limit]
+        return [{
+            'number': str(self.numbers[common[i]]),
+            'group': self.group_name(int(common[i])),
+            'with_first': int(self._totals(a_start, a_end)[a_pos[i]]),
+            'with_second': int(self._totals(b_start, b_end)[b_pos[i]])
+        } for i in order]
+
+    def paths_to_group(self, number: str, group: str, limit: int = 20) -> Optional[List[Dict[str, Any]]]:
+        """Пути длиной 1 и 2 от номера до номеров группы; сильнее связанные первыми.
+
+        Вес пути - меньшее из чисел звонков на его ребрах. None - нет номера или группы.
+        """
+        node, target = self.node(number), self.find_group(group)
+        if node is None or target is None:
+            return None
+        start, end = int(self.indptr[node]), int(self.indptr[node + 1])
+        middle = np.asarray(self.indices[start:end])
+        first_hop = self._totals(start, end)
+
+        # Соседи соседей одним проходом: позиции всех их ребер в CSR
+        starts = np.asarray(self.indptr[middle])
+        lengths = np.asarray(self.indptr[middle + 1]) - starts
+        positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        targets = np.asarray(self.indices[positions])
+        through = np.repeat(np.arange(len(middle)), lengths)
+        mask = (np.asarray(self.group_of[targets]) == target) & (targets != node)
+        positions, targets, through = positions[mask], targets[mask], through[mask]
+        second_hop = np.asarray(self.calls_out[positions]) + np.asarray(self.calls_in[positions])
+
+        # Прямые связи с группой - пути длины 1 (last = -1)
+        direct = np.flatnonzero(np.asarray(self.group_of[middle]) == target)
+        hops = np.concatenate([direct, through])
+        lasts = np.concatenate([np.full(len(direct), -1), targets])
+        weights = np.concatenate([first_hop[direct], np.minimum(first_hop[through], second_hop)])
+
+        # Сортируем массивами и в Python переводим только первые limit путей
+        order = np.argsort(-weights, kind='stable')[:limit]
+        paths = []
+        for i in order:
+            path = [number, str(self.numbers[middle[hops[i]]])]
+            if lasts[i] >= 0:
+                path.append(str(self.numbers[lasts[i]]))
+            paths.append({'weight': int(weights[i]), 'path': path, 'group': self.groups[target]})
+        return paths
+
+    def stats(self) -> Dict[str, Any]:
+        return {key: self.meta[key] for key in ('rows', 'nodes', 'edges', 'built_at')}
+
+
+def render_neighbours(result: Dict[str, Any]) -> str:
+    lines = [f"Номер {result['number']} ({result['group'] or 'группа неизвестна'}), связей: {result['degree']}"]
+    for contact in result['contacts']:
+        lines.append(f"{contact['number']} ({contact['group'] or '?'}): исходящих {contact['calls_out']}, "
+                     f"входящих {contact['calls_in']}, {contact['first']} - {contact['last']}")
+    return '\n'.join(lines)
+
+
+def render_shared(first: str, second: str, contacts: List[Dict[str, Any]]) -> str:
+    if not contacts:
+        return f"Общих контактов у {first} и {second} нет"
+    lines = [f"Общие контакты {first} и {second}: {len(contacts)}"]
+    for contact in contacts:
+        lines.append(f"{contact['number']} ({contact['group'] or '?'}): "
+                     f"звонков с первым {contact['with_first']}, со вторым {contact['with_second']}")
+    return '\n'.join(lines)
+
+
+def render_paths(number: str, group: str, paths: List[Dict[str, Any]]) -> str:
+    if not paths:
+        return f"Путей от {number} до группы {group} длиной до 2 нет"
+    lines = [f"Пути от {number} до группы {paths[0]['group']}:"]
+    for path in paths:
+        lines.append(f"{' -> '.join(path['path'])} (звонков: {path['weight']})")
+    return '\n'.join(lines)
+
+
+def benchmark(rows: int, seed: int = 0, queries: int = 50):
+    """Сверка запросов к графу с пересчетом по DataFrame и замер времени"""
+    import pandas as pd
+    from know_stats import generate_calls
+
+    # Номеров больше, чем в замере know_stats: граф реальных звонков разреженный
+    calls = generate_calls(rows, numbers=max(500, rows // 20), seed=seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'calls.csv')
+        calls.to_csv(path, index=False)
+        meta = build_graph(path, os.path.join(tmp, 'graph'), chunksize=max(1, rows // 7))
+        print(f"Строк: {rows}, номеров: {meta['nodes']}, связей: {meta['edges']}, построение: {meta['seconds']} с")
+        graph = CallGraph(os.path.join(tmp, 'graph'))
+
+        calls = pd.read_csv(path, dtype=str)
+        calls = calls[calls['tlf_call'] != calls['tlf_to']]
+        sample = calls['tlf_call'].drop_duplicates().head(queries).tolist()
+
+        started = time.perf_counter()
+        expected = {}
+        for number in sample:
+            # Пересчет по всему журналу, как без индекса
+            out = calls.loc[calls['tlf_call'] == number, 'tlf_to'].value_counts()
+            inc = calls.loc[calls['tlf_to'] == number, 'tlf_call'].value_counts()
+            expected[number] = out.add(inc, fill_value=0).astype(int).to_dict()
+        scan_ms = (time.perf_counter() - started) * 1000 / len(sample)
+
+        started = time.perf_counter()
+        actual = {}
+        for number in sample:
+            result = graph.neighbours(number, limit=len(graph.indices))
+            actual[number] = {c['number']: c['calls_out'] + c['calls_in'] for c in result['contacts']}
+        index_ms = (time.perf_counter() - started) * 1000 / len(sample)
+        if actual != expected:
+            raise AssertionError("связи из графа расходятся с пересчетом по журналу")
+
+        started = time.perf_counter()
+        for first, second in zip(sample, sample[1:]):
+            graph.shared_contacts(first, second)
+            graph.paths_to_group(first, graph.groups[0])
+        pair_ms = (time.perf_counter() - started) * 1000 / max(1, len(sample) - 1)
+
+    print(f"Связи номера: пересчет {scan_ms:.1f} мс, граф {index_ms:.2f} мс (ускорение {scan_ms / index_ms:.0f}x)")
+    print(f"Общие контакты + пути до группы: {pair_ms:.2f} мс на запрос")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Граф звонков для запросов из бота')
+    parser.add_argument('--input', help='журнал звонков (CSV или Parquet)')
+    parser.add_argument('--output', default='call_graph', help='каталог графа (call_graph_path в боте)')
+    parser.add_argument('--chunksize', type=int, default=1_000_000, help='строк в одном куске')
+    parser.add_argument('--benchmark', type=int, metavar='ROWS',
+                        help='сверить запросы с пересчетом по синтетическому журналу и замерить время')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return
+    if not args.input:
+        parser.error('нужен --input или --benchmark')
+    meta = build_graph(args.input, args.output, args.chunksize)
+    print(f"Граф {args.output}: строк {meta['rows']}, номеров {meta['nodes']}, связей {meta['edges']}, "
+          f"{meta['seconds']} с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Tuple
+
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SECONDS = metrics.histogram('classifier_batch_seconds', 'Классификация одной пачки текстов')
+BATCH_SIZE = metrics.histogram('classifier_batch_size', 'Текстов в пачке', buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+# Файлы, которые export_model.py кладет рядом с моделью
+INT8_FILE = 'model_int8.pt'
+ONNX_FILE = 'model.onnx'
+ONNX_INT8_FILE = 'model_int8.onnx'
+BACKENDS_FILE = 'backends.json'
+# Порядок выбора без замеров export_model.py: сначала квантованные
+DEFAULT_ORDER = ('onnx-int8', 'int8', 'onnx', 'fp32')
+
+
+class TorchBackend:
+    """Прямой проход модели torch: fp32 или динамически квантованной в int8"""
+
+    tensors = 'pt'
+
+    def __init__(self, name: str, model):
+        self.name = name
+        self.model = model
+        self.model.eval()
+
+    def logits(self, inputs) -> Any:
+        with torch.inference_mode():
+            return self.model(**inputs).logits.numpy()
+
+
+class OnnxBackend:
+    """Прямой проход через ONNX Runtime"""
+
+    tensors = 'np'
+
+    def __init__(self, name: str, path: str, threads: Optional[int] = None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.name = name
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def logits(self, inputs) -> Any:
+        feed = {name: inputs[name].astype('int64') for name in self.input_names}
+        return self.session.run(['logits'], feed)[0]
+
+
+def open_backend(model_dir: str, name: str, threads: Optional[int] = None):
+    """Открывает вариант модели по имени: fp32, int8, onnx или onnx-int8"""
+    if name == 'fp32':
+        return TorchBackend(name, AutoModelForSequenceClassification.from_pretrained(model_dir))
+    filenames = {'int8': INT8_FILE, 'onnx': ONNX_FILE, 'onnx-int8': ONNX_INT8_FILE}
+    if name not in filenames:
+        raise ValueError(f"Неизвестный вариант модели: {name}")
+    path = os.path.join(model_dir, filenames[name])
+    # onnxruntime сообщает об отсутствии файла своим исключением (NoSuchFile), а не OSError
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Нет файла {path}: запустите export_model.py")
+    if name == 'int8':
+        # Квантованная модель сохраняется целиком, а не state_dict
+        return TorchBackend(name, torch.load(path, weights_only=False))
+    return OnnxBackend(name, path, threads)
+
+
+def backend_order(model_dir: str) -> List[str]:
+    """Варианты модели от быстрого к медленному.
+
+    Если export_model.py сохранил замеры (backends.json), берется его
+    рейтинг: в него попадают только варианты, прошедшие проверку точности.
+    """
+    path = os.path.join(model_dir, BACKENDS_FILE)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            ranking = json.load(f).get('ranking') or []
+        return ranking + [name for name in ('fp32',) if name not in ranking]
+    return list(DEFAULT_ORDER)
+
+
+def load_backend(model_dir: str, backend: str = 'auto', threads: Optional[int] = None):
+    """Загружает указанный вариант модели, а при backend='auto' - самый быстрый из доступных"""
+    if backend != 'auto':
+        return open_backend(model_dir, backend, threads)
+
+    for name in backend_order(model_dir):
+        try:
+            return open_backend(model_dir, name, threads)
+        except (OSError, ImportError) as e:
+            # Нет файла экспорта или onnxruntime не установлен - пробуем следующий
+            logger.debug(f"Вариант {name} недоступен: {e}")
+        except Exception as e:
+            # Файл есть, но не открывается (поврежден, другая версия onnxruntime/torch)
+            logger.warning(f"Вариант {name} не загружен: {e}")
+    raise RuntimeError(f"Не удалось загрузить модель из {model_dir}")
+
+
+class BatchClassifier:
+    """Классификация сообщений моделью, сохраненной unbalance_classes.py (./my_model).
+
+    Модель загружается один раз. classify() ставит текст в очередь, а
+    фоновая задача собирает из очереди пачку (до max_batch текстов или
+    max_wait секунд ожидания) и выполняет один прямой проход на всю пачку
+    в отдельном потоке, так что event loop не блокируется, а на CPU
+    обрабатываются сотни сообщений в секунду вместо одного на проход.
+    Вариант модели (fp32, int8, ONNX) выбирает load_backend.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        max_batch: int = 32,
+        max_wait: float = 0.005,
+        max_length: int = 128,
+        threads: Optional[int] = None,
+        backend: str = 'auto'
+    ):
+        self.model_dir = model_dir
+        self.backend_name = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_length = max_length
+        self.threads = threads
+        self.tokenizer = None
+        self.backend = None
+        # Один поток: torch сам распараллеливает прямой проход по ядрам
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='classifier')
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+
+    def _load(self):
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+        self.backend = load_backend(self.model_dir, self.backend_name, self.threads)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._load)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._batcher())
+        logger.info(f"Классификатор загружен из {self.model_dir} ({self.backend.name})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    def predict_batch(self, texts: List[str]) -> List[int]:
+        # padding='longest' - пачка дополняется до самого длинного текста, а не до max_length
+        inputs = self.tokenizer(
+            texts, padding='longest', truncation=True, max_length=self.max_length,
+            return_tensors=self.backend.tensors
+        )
+        return self.backend.logits(inputs).argmax(axis=-1).tolist()
+
+    async def classify(self, text: str) -> int:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[str, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            texts = [text for text, _ in batch]
+            BATCH_SIZE.observe(len(texts))
+            try:
+                with BATCH_SECONDS.time():
+                    labels = await loop.run_in_executor(self.executor, self.predict_batch, texts)
+            except Exception as e:
+                logger.error(f"Ошибка классификации: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), label in zip(batch, labels):
+                if not future.done():
+                    future.set_result(label)
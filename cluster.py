@@ -0,0 +1,253 @@
+"""Несколько реплик бота с разделением комнат.
+
+Комнаты делятся на partitions разделов (crc32 от room_id). Каждый раздел
+арендует одна реплика; аренды, список живых реплик и отметки комнат хранятся
+в общем файле SQLite (cluster_db). Раздел достается реплике с наибольшим
+весом hash(реплика, раздел) среди живых (rendezvous hashing): при появлении
+или пропаже реплики переезжает только ее доля разделов.
+
+Шаг согласования (heartbeat) раз в interval секунд: реплика отмечается
+живой, продлевает свои аренды, занимает свободные или просроченные разделы
+своей доли и сообщает, какие разделы пора отдать. Аренда живет ttl секунд:
+разделы упавшей реплики переходят к остальным не позже чем через ttl.
+Контексты диалогов и обработанные id тоже лежат в общей базе, поэтому
+новый владелец комнаты продолжает диалог, а не отвечает повторно.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+
+def partition_of(room_id: str, partitions: int) -> int:
+    # crc32, как и в ShardedDispatcher: одинаково во всех процессах
+    return zlib.crc32(room_id.encode('utf-8')) % partitions
+
+
+def rendezvous_owner(partition: int, replicas: Iterable[str]) -> Optional[str]:
+    """Реплика с наибольшим весом для раздела (None, если реплик нет)"""
+    def weight(replica: str) -> bytes:
+        return hashlib.blake2b(f'{replica}:{partition}'.encode('utf-8'), digest_size=8).digest()
+
+    return max(replicas, key=weight, default=None)
+
+
+def default_replica_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class LeaseChange:
+    """Итог шага согласования"""
+
+    def __init__(self, owned: Dict[int, float], acquired: List[int], surrender: List[int],
+                 marks: Dict[str, str], replicas: List[str]):
+        self.owned = owned            # раздел -> срок аренды (time.time())
+        self.acquired = acquired      # разделы, полученные на этом шаге
+        self.surrender = surrender    # свои разделы, которые по хэшу принадлежат другой реплике
+        self.marks = marks            # сохраненные отметки комнат полученных разделов
+        self.replicas = replicas
+
+
+class LeaseStore:
+    """Аренды разделов в SQLite. Синхронный: вызывается из потока (asyncio.to_thread)"""
+
+    def __init__(self, path: str, replica_id: str, partitions: int = 64, ttl: float = 10):
+        self.replica_id = replica_id
+        self.partitions = partitions
+        self.ttl = ttl
+        # Соединение используется из потоков to_thread, но не одновременно
+        self._db = sqlite3.connect(path, isolation_level=None, timeout=ttl, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS replicas (replica_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS leases (partition INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS room_marks (room_id TEXT PRIMARY KEY, partition INTEGER NOT NULL, ts TEXT NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS room_marks_partition ON room_marks (partition)')
+
+    def _save_marks(self, marks: Dict[str, str]):
+        # Отметка только растет: ее могла сохранить и прежняя владелица комнаты
+        self._db.executemany(
+            'INSERT INTO room_marks (room_id, partition, ts) VALUES (?, ?, ?) '
+            'ON CONFLICT (room_id) DO UPDATE SET ts = max(ts, excluded.ts)',
+            [(room_id, partition_of(room_id, self.partitions), ts) for room_id, ts in marks.items()]
+        )
+
+    def _load_marks(self, partitions: List[int]) -> Dict[str, str]:
+        if not partitions:
+            return {}
+        placeholders = ','.join('?' * len(partitions))
+        return dict(self._db.execute(
+            f'SELECT room_id, ts FROM room_marks WHERE partition IN ({placeholders})', partitions
+        ))
+
+    def heartbeat(self, marks: Dict[str, str], held: Set[int]) -> LeaseChange:
+        """Шаг согласования; marks - отметки комнат, изменившиеся с прошлого шага"""
+        now = time.time()
+        expires_at = now + self.ttl
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            self._db.execute(
+                'INSERT OR REPLACE INTO replicas (replica_id, heartbeat_at) VALUES (?, ?)', (self.replica_id, now)
+            )
+            self._db.execute('DELETE FROM replicas WHERE heartbeat_at < ?', (now - self.ttl,))
+            replicas = sorted(row[0] for row in self._db.execute('SELECT replica_id FROM replicas'))
+            leases = {row[0]: (row[1], row[2]) for row in self._db.execute('SELECT partition, owner, expires_at FROM leases')}
+            self._save_marks(marks)
+
+            owned, acquired, surrender = {}, [], []
+            for partition in range(self.partitions):
+                owner, lease_until = leases.get(partition, (None, 0.0))
+                mine = owner == self.replica_id
+                leaving = rendezvous_owner(partition, replicas) != self.replica_id
+                if leaving:
+                    if mine:
+                        # Аренду продлеваем, пока бот не доработает начатое и не отдаст раздел
+                        surrender.append(partition)
+                    else:
+                        continue
+                elif not mine and owner in replicas and lease_until > now:
+                    # Прежняя владелица жива и еще не отпустила раздел
+                    continue
+                self._db.execute(
+                    'INSERT OR REPLACE INTO leases (partition, owner, expires_at) VALUES (?, ?, ?)',
+                    (partition, self.replica_id, expires_at)
+                )
+                owned[partition] = expires_at
+                if partition not in held and not leaving:
+                    acquired.append(partition)
+            loaded = self._load_marks(acquired)
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        return LeaseChange(owned, acquired, surrender, loaded, replicas)
+
+    def release(self, partitions: List[int], marks: Dict[str, str], leave: bool = False):
+        """Сохранение отметок и отпуск разделов; leave - еще и выход реплики из списка живых"""
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            self._save_marks(marks)
+            self._db.executemany(
+                'DELETE FROM leases WHERE partition = ? AND owner = ?',
+                [(partition, self.replica_id) for partition in partitions]
+            )
+            if leave:
+                self._db.execute('DELETE FROM replicas WHERE replica_id = ?', (self.replica_id,))
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        self._db.close()
+
+
+class Cluster:
+    """Разделы комнат этой реплики для бота: owns(room_id) и шаги согласования вне event loop"""
+
+    def __init__(
+        self,
+        path: str,
+        replica_id: Optional[str] = None,
+        partitions: int = 64,
+        ttl: float = 10,
+        interval: float = 2
+    ):
+        self.replica_id = replica_id or default_replica_id()
+        self.partitions = partitions
+        self.ttl = ttl
+        self.interval = interval
+        self.store = LeaseStore(path, self.replica_id, partitions, ttl)
+        self.owned: Dict[int, float] = {}
+        self.replicas: List[str] = []
+        self.handovers = 0
+        # Отметки комнат, еще не записанные в общую базу
+        self._marks: Dict[str, str] = {}
+        # Принятые ботом, но еще не обработанные сообщения по разделам
+        self._in_flight: Dict[int, int] = {}
+        self._drained = asyncio.Event()
+
+    def owns(self, room_id: str) -> bool:
+        # Истекшая аренда (например, база недоступна) - комнату уже могла взять другая реплика
+        return self.owned.get(partition_of(room_id, self.partitions), 0.0) > time.time()
+
+    def note_mark(self, room_id: str, ts: str):
+        self._marks[room_id] = ts
+
+    def accept(self, room_id: str):
+        """Сообщение комнаты принято в обработку: раздел не отдается, пока оно не обработано"""
+        partition = partition_of(room_id, self.partitions)
+        self._in_flight[partition] = self._in_flight.get(partition, 0) + 1
+
+    def done(self, room_id: str):
+        partition = partition_of(room_id, self.partitions)
+        left = self._in_flight[partition] - 1
+        if left:
+            self._in_flight[partition] = left
+        else:
+            del self._in_flight[partition]
+            self._drained.set()
+
+    async def drain(self, partitions: List[int], timeout: float) -> List[int]:
+        """Ожидание (не дольше timeout) обработки принятых сообщений разделов; возвращает разделы без них"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while any(p in self._in_flight for p in partitions) and loop.time() < deadline:
+            self._drained.clear()
+            try:
+                await asyncio.wait_for(self._drained.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+        return [p for p in partitions if p not in self._in_flight]
+
+    def _take_marks(self) -> Dict[str, str]:
+        marks, self._marks = self._marks, {}
+        return marks
+
+    async def heartbeat(self) -> LeaseChange:
+        marks = self._take_marks()
+        try:
+            change = await asyncio.to_thread(self.store.heartbeat, marks, set(self.owned))
+        except BaseException:
+            # Несохраненные отметки запишем на следующем шаге
+            self._marks = {**marks, **self._marks}
+            raise
+        # Отдаваемые разделы сразу перестаем обслуживать
+        self.owned = {p: until for p, until in change.owned.items() if p not in change.surrender}
+        self.replicas = change.replicas
+        if change.acquired:
+            logger.info(f"Реплика {self.replica_id}: получены разделы {change.acquired} (реплик: {len(change.replicas)})")
+        return change
+
+    async def release(self, partitions: List[int]):
+        await asyncio.to_thread(self.store.release, partitions, self._take_marks())
+        self.handovers += len(partitions)
+        logger.info(f"Реплика {self.replica_id}: отданы разделы {partitions}")
+
+    async def leave(self):
+        """Отпуск всех разделов при остановке: их сразу забирают остальные реплики"""
+        partitions = list(self.owned)
+        self.owned = {}
+        await asyncio.to_thread(self.store.release, partitions, self._take_marks(), True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'replica': self.replica_id,
+            'replicas': len(self.replicas),
+            'partitions': len(self.owned),
+            'handovers': self.handovers
+        }
+
+    def close(self):
+        self.store.close()
@@ -0,0 +1,129 @@
+import difflib
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import metrics
+
+
+COMMAND_SECONDS = metrics.histogram('bot_command_seconds', 'Время выполнения команды (и шагов ее диалога)', ['command'])
+
+
+class Command:
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Awaitable[Optional[str]]],
+        description: str,
+        aliases: Iterable[str] = (),
+        parser: Optional[Callable[[List[str]], Sequence[Any]]] = None,
+        usage: Optional[str] = None
+    ):
+        self.name = name
+        self.func = func
+        self.description = description
+        self.aliases = tuple(aliases)
+        # parser(args) -> разобранные аргументы, при ошибке - ValueError с текстом для пользователя
+        self.parser = parser
+        self.usage = usage or name
+
+
+def command(name: str, description: str, aliases: Iterable[str] = (), parser=None, usage: Optional[str] = None):
+    """Декоратор метода-обработчика команды; регистрируется через CommandRouter.register_handlers"""
+    def decorator(func):
+        func.command_spec = {
+            'name': name,
+            'description': description,
+            'aliases': aliases,
+            'parser': parser,
+            'usage': usage
+        }
+        return func
+    return decorator
+
+
+class CommandRouter:
+    """Маршрутизатор команд.
+
+    Имена и синонимы команд сводятся в один словарь при регистрации, поэтому
+    поиск не зависит от числа команд. Понимает /команду, команду@бот и
+    упоминание @бот в начале сообщения. Для неизвестной команды, похожей на
+    существующую, предлагает варианты. Текст справки собирается один раз.
+    """
+
+    def __init__(self, bot_username: Optional[str] = None):
+        self.commands: Dict[str, Command] = {}
+        self._index: Dict[str, Command] = {}
+        self._help_text: Optional[str] = None
+        self.bot_username = bot_username
+
+    def add(self, name: str, func, description: str, aliases: Iterable[str] = (), parser=None, usage=None):
+        cmd = Command(name, func, description, aliases, parser, usage)
+        for key in (name, *cmd.aliases):
+            key = key.lower()
+            if key in self._index:
+                raise ValueError(f"Команда или синоним '{key}' уже зарегистрированы")
+            self._index[key] = cmd
+        self.commands[name] = cmd
+        self._help_text = None
+        return cmd
+
+    def register_handlers(self, obj):
+        """Регистрация методов obj, помеченных декоратором @command (в порядке объявления)"""
+        seen = set()
+        for cls in reversed(type(obj).__mro__):
+            for attr, value in vars(cls).items():
+                spec = getattr(value, 'command_spec', None)
+                if spec is not None and attr not in seen:
+                    seen.add(attr)
+                    self.add(func=getattr(obj, attr), **spec)
+
+    @property
+    def help_text(self) -> str:
+        if self._help_text is None:
+            lines = ["Доступные команды:"]
+            for cmd in self.commands.values():
+                aliases = f" ({', '.join(cmd.aliases)})" if cmd.aliases else ""
+                lines.append(f"• {cmd.name}{aliases} - {cmd.description}")
+            self._help_text = '\n'.join(lines) + '\n'
+        return self._help_text
+
+    def split(self, text: str) -> Tuple[Optional[str], List[str]]:
+        """Имя команды (без /, @бот, в нижнем регистре) и аргументы"""
+        parts = text.split()
+        if parts and self.bot_username and parts[0].lower().lstrip('@') == self.bot_username.lower():
+            parts = parts[1:]
+        if not parts:
+            return None, []
+        name = parts[0].lower().lstrip('/')
+        # /help@bot
+        name = name.split('@', 1)[0]
+        return name or None, parts[1:]
+
+    def resolve(self, name: str) -> Optional[Command]:
+        return self._index.get(name)
+
+    def suggest(self, name: str, limit: int = 3) -> List[str]:
+        matches = difflib.get_close_matches(name, list(self._index), n=limit, cutoff=0.75)
+        # Синонимы заменяем основными именами команд, без повторов
+        return list(dict.fromkeys(self._index[match].name for match in matches))
+
+    async def dispatch(self, text: str, *context) -> Optional[str]:
+        """Вызов обработчика команды: handler(*context, *args)"""
+        name, args = self.split(text)
+        if name is None:
+            return None
+
+        cmd = self.resolve(name)
+        if cmd is None:
+            suggestions = self.suggest(name)
+            if suggestions:
+                return f"Неизвестная команда '{name}'. Возможно, вы имели в виду: {', '.join(suggestions)}"
+            return None
+
+        if cmd.parser is not None:
+            try:
+                args = cmd.parser(args)
+            except ValueError as e:
+                return f"{e}\nИспользование: {cmd.usage}"
+        with COMMAND_SECONDS.time(command=cmd.name):
+            return await cmd.func(*context, *args)
+
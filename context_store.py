@@ -0,0 +1,160 @@
+import asyncio
+import heapq
+import json
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class ContextStore:
+    """Хранилище контекстов диалогов с истечением по последней активности.
+
+    Контекст - сериализуемый в JSON словарь: имя состояния, ключ обработчика
+    диалога (а не связанный метод), room_id и собранные данные. Каждая запись
+    (set) продлевает срок жизни на ttl секунд. Методы асинхронные: хранилище
+    в базе не должно блокировать event loop.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+
+    async def get(self, user: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def set(self, user: str, context: Dict[str, Any]):
+        raise NotImplementedError
+
+    async def delete(self, user: str):
+        raise NotImplementedError
+
+    async def expire(self) -> List[str]:
+        """Удаляет просроченные контексты и возвращает их пользователей"""
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryContextStore(ContextStore):
+    """Контексты в памяти процесса, сроки - в куче (heapq).
+
+    Продление срока добавляет в кучу новую запись, а устаревшие записи
+    отбрасываются лениво при expire, поэтому и set, и очистка стоят
+    O(log n) на контекст вместо полного обхода словаря.
+    """
+
+    def __init__(self, ttl: float = 300):
+        super().__init__(ttl)
+        self._contexts: Dict[str, Dict[str, Any]] = {}
+        self._deadlines: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+
+    async def get(self, user: str) -> Optional[Dict[str, Any]]:
+        deadline = self._deadlines.get(user)
+        if deadline is None or deadline <= time.time():
+            return None
+        return self._contexts[user]
+
+    async def set(self, user: str, context: Dict[str, Any]):
+        deadline = time.time() + self.ttl
+        self._contexts[user] = context
+        self._deadlines[user] = deadline
+        heapq.heappush(self._heap, (deadline, user))
+        # Устаревших записей в куче не должно стать слишком много
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, u) for u, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    async def delete(self, user: str):
+        self._contexts.pop(user, None)
+        self._deadlines.pop(user, None)
+
+    async def expire(self) -> List[str]:
+        now = time.time()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, user = heapq.heappop(self._heap)
+            # Запись актуальна, только если срок не продлевали после нее
+            if self._deadlines.get(user) == deadline:
+                await self.delete(user)
+                expired.append(user)
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+
+class SqliteContextStore(ContextStore):
+    """Контексты в SQLite: переживают перезапуск и доступны нескольким процессам бота.
+
+    Запросы к базе идут вне event loop (asyncio.to_thread) и по одному:
+    единственное соединение обслуживает их в порядке вызова, так что set и
+    delete одного пользователя не переставляются. Файл может быть общим для
+    реплик кластера, поэтому ожидание блокировки ограничено timeout секундами,
+    после чего вызов завершается sqlite3.OperationalError. len() - число
+    контекстов на момент последнего expire, без запроса к базе.
+    """
+
+    def __init__(self, path: str, ttl: float = 300, timeout: float = 1.0):
+        super().__init__(ttl)
+        self.path = path
+        # Соединение используется из потоков to_thread, но только под self._lock
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS contexts '
+            '(user TEXT PRIMARY KEY, payload TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS contexts_expires ON contexts (expires_at)')
+        self._count = self._db.execute('SELECT COUNT(*) FROM contexts').fetchone()[0]
+        self._lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    def _get(self, user: str) -> Optional[str]:
+        row = self._db.execute(
+            'SELECT payload FROM contexts WHERE user = ? AND expires_at > ?', (user, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, user: str, payload: str):
+        self._db.execute(
+            'INSERT OR REPLACE INTO contexts (user, payload, expires_at) VALUES (?, ?, ?)',
+            (user, payload, time.time() + self.ttl)
+        )
+
+    def _delete(self, user: str):
+        self._db.execute('DELETE FROM contexts WHERE user = ?', (user,))
+
+    def _expire(self) -> List[str]:
+        now = time.time()
+        expired = [row[0] for row in self._db.execute('SELECT user FROM contexts WHERE expires_at <= ?', (now,))]
+        if expired:
+            self._db.execute('DELETE FROM contexts WHERE expires_at <= ?', (now,))
+        self._count = self._db.execute('SELECT COUNT(*) FROM contexts').fetchone()[0]
+        return expired
+
+    async def get(self, user: str) -> Optional[Dict[str, Any]]:
+        payload = await self._run(self._get, user)
+        return json.loads(payload) if payload is not None else None
+
+    async def set(self, user: str, context: Dict[str, Any]):
+        await self._run(self._set, user, json.dumps(context, ensure_ascii=False))
+
+    async def delete(self, user: str):
+        await self._run(self._delete, user)
+
+    async def expire(self) -> List[str]:
+        return await self._run(self._expire)
+
+    def __len__(self) -> int:
+        return self._count
+
+    async def close(self):
+        async with self._lock:
+            self._db.close()
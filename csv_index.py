@@ -0,0 +1,159 @@
+import csv
+import io
+import itertools
+import re
+import time
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+
+# Возможные заголовки колонок для каждого типа поиска в db_check
+SEARCH_COLUMNS = {
+    'fio': ('фио', 'fio', 'full_name', 'name'),
+    'department': ('отдел', 'подразделение', 'department'),
+    'location': ('местоположение', 'расположение', 'location', 'город'),
+}
+
+_NON_WORD = re.compile(r'[^\w]+')
+
+
+def normalize(value: str) -> str:
+    """'  Иванов  И.И. ' -> 'иванов и и'"""
+    return _NON_WORD.sub(' ', value.casefold().replace('ё', 'е')).strip()
+
+
+class CsvIndex:
+    """Индекс по одной колонке CSV-файла, строящийся за один потоковый проход.
+
+    Строки файла в памяти не хранятся: для каждого нормализованного значения
+    ключа - только число строк и не больше sample_size примеров, плюс индекс
+    по первым prefix_len символам для поиска по началу значения. Память
+    зависит от числа различных значений ключа, а не от размера файла.
+
+    Если задан search_value, индекс строится под один запрос: хранятся только
+    значения, совпадающие с ним или начинающиеся с него, и память зависит от
+    числа совпадений. lookup другого значения такого индекса ничего не найдет.
+    """
+
+    def __init__(
+        self,
+        key_column: str,
+        header: List[str],
+        prefix_len: int = 3,
+        sample_size: int = 5,
+        search_value: Optional[str] = None
+    ):
+        self.key_column = key_column
+        self.header = header
+        self.prefix_len = prefix_len
+        self.sample_size = sample_size
+        self.counts: Dict[str, int] = {}
+        self.samples: Dict[str, List[List[str]]] = {}
+        self.prefixes: Dict[str, set] = {}
+        self.search_key = normalize(search_value) if search_value is not None else None
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @classmethod
+    def build(
+        cls,
+        stream: BinaryIO,
+        column_candidates: Iterable[str],
+        encoding: str = 'utf-8-sig',
+        **kwargs
+    ) -> 'CsvIndex':
+        started = time.perf_counter()
+        text = io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline='')
+        first_line = text.readline()
+        if not first_line:
+            raise ValueError("Файл пустой")
+        try:
+            dialect = csv.Sniffer().sniff(first_line, delimiters=',;\t|')
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(itertools.chain([first_line], text), dialect)
+
+        header = next(reader)
+        normalized_header = [h.strip().casefold() for h in header]
+        key_pos = next((normalized_header.index(c) for c in column_candidates if c in normalized_header), None)
+        if key_pos is None:
+            raise ValueError(f"В файле нет колонки {' / '.join(column_candidates)}")
+
+        index = cls(header[key_pos].strip(), header, **kwargs)
+        for row in reader:
+            if len(row) > key_pos:
+                index.add(normalize(row[key_pos]), row)
+            index.rows += 1
+        # Байты считаем по исходному потоку, если он это умеет (tell у ответа HTTP)
+        try:
+            index.bytes = stream.tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+        index.seconds = time.perf_counter() - started
+        return index
+
+    @classmethod
+    def build_file(cls, path: str, column_candidates: Iterable[str], **kwargs) -> 'CsvIndex':
+        """build по файлу на диске: вызывается в пуле процессов, куда поток ответа HTTP не передать"""
+        with open(path, 'rb') as stream:
+            return cls.build(stream, column_candidates, **kwargs)
+
+    def add(self, key: str, row: List[str]):
+        if not key:
+            return
+        if self.search_key is not None and not (self.search_key and key.startswith(self.search_key)):
+            return
+        count = self.counts.get(key)
+        if count is None:
+            self.counts[key] = 1
+            self.samples[key] = [row]
+            self.prefixes.setdefault(key[:self.prefix_len], set()).add(key)
+            return
+        self.counts[key] = count + 1
+        samples = self.samples[key]
+        if len(samples) < self.sample_size:
+            samples.append(row)
+
+    def lookup(self, value: str) -> Tuple[str, int, List[List[str]]]:
+        """(тип совпадения 'exact'/'prefix'/'none', число строк, примеры)"""
+        key = normalize(value)
+        if key in self.counts:
+            return 'exact', self.counts[key], self.samples[key]
+
+        if len(key) < self.prefix_len:
+            candidates: Iterable[str] = itertools.chain.from_iterable(
+                keys for prefix, keys in self.prefixes.items() if prefix.startswith(key)
+            ) if key else ()
+        else:
+            candidates = self.prefixes.get(key[:self.prefix_len], ())
+        matched = sorted(k for k in candidates if k.startswith(key))
+        if not matched:
+            return 'none', 0, []
+
+        samples: List[List[str]] = []
+        for k in matched:
+            samples.extend(self.samples[k][:self.sample_size - len(samples)])
+            if len(samples) >= self.sample_size:
+                break
+        return 'prefix', sum(self.counts[k] for k in matched), samples
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rows': self.rows,
+            'distinct_keys': len(self.counts),
+            'seconds': self.seconds,
+            'rows_per_sec': self.rows / self.seconds if self.seconds else 0.0,
+            'mb_per_sec': self.bytes / 1e6 / self.seconds if self.seconds else 0.0
+        }
+
+    def format_matches(self, value: str) -> str:
+        kind, count, samples = self.lookup(value)
+        stats = self.stats()
+        footer = (f"Строк в файле: {stats['rows']}, разбор: {stats['seconds']:.2f} с "
+                  f"({stats['rows_per_sec']:.0f} строк/с)")
+        if kind == 'none':
+            return f"Совпадений по колонке '{self.key_column}' для '{value}' не найдено.\n{footer}"
+        how = "точных совпадений" if kind == 'exact' else "совпадений по началу значения"
+        lines = [f"Найдено {count} {how} по колонке '{self.key_column}' для '{value}'.", footer, "Примеры:"]
+        lines.extend('• ' + '; '.join(row) for row in samples)
+        return '\n'.join(lines)
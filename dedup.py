@@ -0,0 +1,155 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+class DedupStore:
+    """Ограниченное хранилище id уже обработанных сообщений.
+
+    В памяти - OrderedDict в порядке добавления: при превышении max_entries
+    и по истечении ttl старые id вытесняются, так что память не растет со
+    временем работы бота. Если задан path, id дублируются в SQLite (WAL),
+    и после перезапуска бот не отвечает повторно на уже обработанные сообщения.
+    Общий файл могут использовать несколько процессов: сообщение достается
+    тому, кто отметил его первым.
+
+    Запись в SQLite идет вне event loop (asyncio.to_thread) одной транзакцией
+    на пачку: id, отмеченные, пока пишется предыдущая пачка, попадают в
+    следующую. В память id попадает только после успешной записи в базу.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 100_000, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, float]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db: Optional[sqlite3.Connection] = None
+        # id, ожидающие записи в базу, и их результат (True - отмечен нами первым)
+        self._claims: Dict[str, asyncio.Future] = {}
+        self._evicted: List[Tuple[str]] = []
+        self._writer: Optional[asyncio.Task] = None
+        if path:
+            self._open()
+
+    def _open(self):
+        # Соединение используется из потока записи, но не одновременно с event loop
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS processed (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)')
+        self._db.execute('DELETE FROM processed WHERE seen_at < ?', (time.time() - self.ttl,))
+        self._db.commit()
+        rows = self._db.execute(
+            'SELECT id, seen_at FROM (SELECT id, seen_at FROM processed ORDER BY seen_at DESC LIMIT ?) '
+            'ORDER BY seen_at',
+            (self.max_entries,)
+        )
+        self._entries.update(rows)
+
+    def __contains__(self, msg_id: str) -> bool:
+        return msg_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def check_and_add(self, msg_id: str) -> bool:
+        """True, если сообщение новое (и теперь отмечено), False - если уже обрабатывалось"""
+        if msg_id in self._entries:
+            self.hits += 1
+            return False
+        if self._db is None:
+            self._entries[msg_id] = time.time()
+            self.misses += 1
+            self._evict(time.time())
+            return True
+
+        claim = self._claims.get(msg_id)
+        if claim is not None:
+            # Тот же id уже пишется (опрос и realtime): новым он может быть только для первого
+            await asyncio.shield(claim)
+            self.hits += 1
+            return False
+        claim = self._claims[msg_id] = asyncio.get_running_loop().create_future()
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_claims())
+        # Ошибка записи (например, database is locked) пробрасывается: id не отмечен,
+        # и сообщение будет обработано при следующем опросе
+        if not await asyncio.shield(claim):
+            self.hits += 1
+            return False
+        self.misses += 1
+        return True
+
+    async def _write_claims(self):
+        try:
+            while self._claims:
+                claims = self._claims
+                self._claims = {}
+                evicted, self._evicted = self._evicted, []
+                now = time.time()
+                try:
+                    inserted = await asyncio.to_thread(self._insert, list(claims), now, evicted)
+                except Exception as e:
+                    self._evicted = evicted + self._evicted
+                    for claim in claims.values():
+                        claim.set_exception(e)
+                    continue
+                for msg_id, claim in claims.items():
+                    # Отмеченный другой репликой (или не попавший в память при загрузке) id - тоже повтор
+                    self._entries[msg_id] = now
+                    claim.set_result(msg_id in inserted)
+                self._evict(now)
+        finally:
+            self._writer = None
+
+    def _insert(self, ids: List[str], now: float, evicted: List[Tuple[str]]) -> set:
+        """Отметка пачки id одной транзакцией; возвращает id, которых в базе еще не было"""
+        inserted = set()
+        try:
+            for msg_id in ids:
+                # Проверка и отметка одним запросом: базу могут делить несколько реплик бота
+                if self._db.execute(
+                    'INSERT OR IGNORE INTO processed (id, seen_at) VALUES (?, ?)', (msg_id, now)
+                ).rowcount:
+                    inserted.add(msg_id)
+            self._db.executemany('DELETE FROM processed WHERE id = ?', evicted)
+            self._db.commit()
+        except BaseException:
+            self._db.rollback()
+            raise
+        return inserted
+
+    def _evict(self, now: float):
+        expired_before = now - self.ttl
+        while self._entries:
+            msg_id, seen_at = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and seen_at >= expired_before:
+                break
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            if self._db is not None:
+                # Удаляются из базы вместе со следующей пачкой записей
+                self._evicted.append((msg_id,))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    async def close(self):
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+        if self._db is not None:
+            if self._evicted:
+                await asyncio.to_thread(self._insert, [], time.time(), self._evicted)
+                self._evicted = []
+            self._db.close()
+            self._db = None
@@ -0,0 +1,134 @@
+import inspect
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+
+
+COMPLETE = 'complete'
+CANCEL_WORDS = {'отмена'}
+
+
+class DialogError(ValueError):
+    """Ответ пользователя не прошел проверку: текст ошибки уходит пользователю, состояние не меняется"""
+
+
+class Step:
+    """Шаг диалога.
+
+    prompt   - вопрос при входе в шаг (шаблон str.format по собранным data)
+    field    - ключ data, куда сохраняется проверенный ответ
+    validate - validate(user_input, data) -> значение, либо DialogError
+    next     - следующее состояние (или функция от data), COMPLETE - конец диалога
+    timeout  - сколько секунд ждать ответа в этом шаге (None - без ограничения)
+    file     - шаг ждет вложение: validate получает {'name', 'url', 'type'} вместо текста
+    """
+
+    def __init__(
+        self,
+        prompt: str,
+        field: Optional[str] = None,
+        validate: Optional[Callable[[str, Dict[str, Any]], Any]] = None,
+        next: Union[str, Callable[[Dict[str, Any]], str]] = COMPLETE,
+        timeout: Optional[float] = None,
+        file: bool = False
+    ):
+        self.prompt = prompt
+        self.field = field
+        self.validate = validate
+        self.next = next
+        self.timeout = timeout
+        self.file = file
+
+
+class Dialog:
+    """Табличный диалог: состояния объявляются один раз, переход - поиск в словаре.
+
+    Контекст диалога - только JSON-совместимые данные (имя диалога, состояние,
+    data), поэтому его можно хранить в любом ContextStore.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        steps: Dict[str, Step],
+        finish: Callable[[Dict[str, Any], Dict[str, Any]], Union[str, Awaitable[str]]]
+    ):
+        self.name = name
+        self.steps = steps
+        # Первый объявленный шаг - начальный
+        self.start_state = next(iter(steps))
+        self.finish = finish
+
+        for state, step in steps.items():
+            if isinstance(step.next, str) and step.next != COMPLETE and step.next not in steps:
+                raise ValueError(f"Диалог {name}: переход из {state} в неизвестное состояние {step.next}")
+
+    def start(self, room_id: str) -> Tuple[Dict[str, Any], str]:
+        now = time.time()
+        context = {
+            'dialog': self.name,
+            'state': self.start_state,
+            'room_id': room_id,
+            'data': {},
+            'created_at': now,
+            'state_started': now
+        }
+        return context, self.steps[self.start_state].prompt.format()
+
+    async def handle(
+        self,
+        context: Dict[str, Any],
+        user_input: str,
+        attachment: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, str]:
+        """Обработка ответа пользователя. Возвращает (новое состояние, ответ)"""
+        if user_input.strip().lower() in CANCEL_WORDS:
+            return COMPLETE, "Диалог прерван"
+
+        state = context['state']
+        step = self.steps[state]
+        if step.timeout is not None and time.time() - context['state_started'] > step.timeout:
+            return COMPLETE, "Время ожидания ответа истекло. Диалог прерван"
+
+        data = context['data']
+        if step.file:
+            if attachment is None:
+                return state, "Пожалуйста, прикрепите файл к сообщению"
+            answer = attachment
+        else:
+            answer = user_input
+        try:
+            value = step.validate(answer, data) if step.validate else answer
+        except DialogError as e:
+            return state, str(e)
+
+        if step.field:
+            data[step.field] = value
+
+        new_state = step.next(data) if callable(step.next) else step.next
+        if new_state == COMPLETE:
+            response = self.finish(data, context)
+            if inspect.isawaitable(response):
+                response = await response
+            return COMPLETE, response
+
+        context['state'] = new_state
+        context['state_started'] = time.time()
+        return new_state, self.steps[new_state].prompt.format(**data)
+
+
+def choice(options: Dict[str, str], error: str) -> Callable[[str, Dict[str, Any]], str]:
+    """Валидатор выбора варианта по номеру"""
+    def validate(user_input: str, data: Dict[str, Any]) -> str:
+        key = user_input.strip()
+        if key not in options:
+            raise DialogError(error)
+        return options[key]
+    return validate
+
+
+def parse_datetime(user_input: str, fmt: str, error: str) -> datetime:
+    try:
+        return datetime.strptime(user_input.strip(), fmt)
+    except ValueError:
+        raise DialogError(error)
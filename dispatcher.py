@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedDispatcher:
+    """Распределение сообщений по фиксированному пулу воркеров.
+
+    Ключ сообщения (отправитель, иначе комната) хэшируется на один из
+    workers воркеров, у каждого своя ограниченная asyncio.Queue. Сообщения
+    одного пользователя обрабатываются строго по очереди (на это опирается
+    continue_dialog), разные пользователи - параллельно. Семафор
+    max_in_flight ограничивает общее число принятых, но еще не обработанных
+    сообщений: при всплеске submit ждет, а не копит задачи в памяти.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Dict[str, Any]], Awaitable[None]],
+        workers: int = 8,
+        queue_size: int = 100,
+        max_in_flight: int = 500
+    ):
+        self.handler = handler
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.errors = 0
+
+    @staticmethod
+    def shard_key(message: Dict[str, Any]) -> str:
+        return message.get('u', {}).get('username') or message.get('rid', '')
+
+    def shard_for(self, message: Dict[str, Any]) -> int:
+        # crc32 вместо hash(): не зависит от PYTHONHASHSEED
+        return zlib.crc32(self.shard_key(message).encode('utf-8')) % len(self.queues)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+
+    async def stop(self):
+        """Остановка воркеров; сообщения, оставшиеся в очередях, отбрасываются (перед ней - join())"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, message: Dict[str, Any]):
+        """Постановка сообщения в очередь его шарда (ждет, если лимиты исчерпаны)"""
+        await self._slots.acquire()
+        self.in_flight += 1
+        try:
+            await self.queues[self.shard_for(message)].put(message)
+        except BaseException:
+            self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    async def join(self):
+        """Ожидание обработки всех принятых сообщений"""
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            message = await queue.get()
+            try:
+                await self.handler(message)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка обработчика сообщения: {e}")
+            finally:
+                queue.task_done()
+                self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [queue.qsize() for queue in self.queues]
+        return {
+            'queue_depths': depths,
+            'queued': sum(depths),
+            'in_flight': self.in_flight,
+            'processed': self.processed,
+            'errors': self.errors
+        }
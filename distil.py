@@ -1,81 +1,271 @@
-from transformers import BertTokenizer, BertForSequenceClassification, DistilBertTokenizer, DistilBertForSequenceClassification
-from torch.utils.data import DataLoader, Dataset
-from torch.optim import Adam
+import argparse
+import contextlib
+import os
+import time
+
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim import Adam
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from classifier import TorchBackend
+from export_model import measure_latency, predict
+from token_cache import cached_dataset, fingerprint, make_dataloader
+from unbalance_classes import load_data, split_data
+
+
+def compute_teacher_logits(teacher, tokenizer, texts, max_length, batch_size=64) -> torch.Tensor:
+    """Логиты учителя на всем обучающем наборе: учитель не обучается, поэтому прямой проход делается один раз"""
+    teacher.eval()
+    chunks = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            inputs = tokenizer(
+                texts[start:start + batch_size], padding='longest', truncation=True,
+                max_length=max_length, return_tensors='pt'
+            )
+            chunks.append(teacher(**inputs).logits)
+    return torch.cat(chunks)
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature, alpha):
+    """alpha * KL(ученик || учитель) на смягченных распределениях + (1 - alpha) * CE по истинным меткам.
+
+    KL умножается на T^2, чтобы масштаб градиентов не зависел от температуры.
+    """
+    soft = F.kl_div(
+        F.log_softmax(student_logits / temperature, dim=-1),
+        F.softmax(teacher_logits / temperature, dim=-1),
+        reduction='batchmean'
+    ) * temperature ** 2
+    hard = F.cross_entropy(student_logits, labels)
+    return alpha * soft + (1 - alpha) * hard
 
-# Пример пользовательского датасета
-class CustomDataset(Dataset):
-    def __init__(self, texts, labels, tokenizer, max_length):
-        self.texts = texts
-        self.labels = labels
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-
-    def __len__(self):
-        return len(self.texts)
-
-    def __getitem__(self, idx):
-        text = self.texts[idx]
-        label = self.labels[idx]
-        encoding = self.tokenizer(
-            text,
-            add_special_tokens=True,
-            max_length=self.max_length,
-            return_token_type_ids=False,
-            padding='max_length',
-            return_attention_mask=True,
-            return_tensors='pt',
-        )
-        return {
-            'input_ids': encoding['input_ids'].flatten(),
-            'attention_mask': encoding['attention_mask'].flatten(),
-            'labels': torch.tensor(label, dtype=torch.long)
-        }
 
-# Инициализация токенайзера и модели
-tokenizer = BertTokenizer.from_pretrained('bert-base-multilingual-uncased')
-model = BertForSequenceClassification.from_pretrained('bert-base-multilingual-uncased', num_labels=2)
-
-# Для DistilBERT достаточно заменить две строки выше следующими строками:
-# tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-multilingual-cased')
-# model = DistilBertForSequenceClassification.from_pretrained('distilbert-base-multilingual-cased')
-
-texts = ["пример текста 1", "пример текста 2", ...]  # Ваши тексты
-labels = [0, 1, ...]  # Ваши метки
-
-# Параметры обучения
-batch_size = 16
-epochs = 3
-max_length = 128
-learning_rate = 5e-5
-
-# Создание DataLoader
-dataset = CustomDataset(texts, labels, tokenizer, max_length)
-dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
-
-# Инициализация оптимизатора
-optimizer = Adam(model.parameters(), lr=learning_rate)
-
-# Цикл обучения
-for epoch in range(epochs):
-    print(f'Epoch {epoch + 1}/{epochs}')
-    model.train()
-    for batch in dataloader:
-        input_ids = batch['input_ids']
-        attention_mask = batch['attention_mask']
-        labels = batch['labels']
-        
-        # Обнуление градиентов
+def train(
+    model,
+    dataloader,
+    epochs,
+    learning_rate,
+    temperature=2.0,
+    alpha=0.5,
+    accumulation=1,
+    bf16=False,
+    log_every=50,
+    max_steps=None,
+    rank=0,
+    world_size=1
+) -> float:
+    """Цикл обучения; возвращает скорость в примерах в секунду по всем процессам.
+
+    accumulation - сколько пачек накапливать градиент перед шагом оптимизатора
+    bf16         - прямой проход в bfloat16 (torch.autocast на CPU), потери считаются в fp32
+    log_every    - печатать среднюю потерю раз в столько шагов: loss.item() ждет
+                   окончания вычислений, поэтому на каждой пачке его не вызываем
+    max_steps    - остановиться после стольких шагов (замер скорости)
+    """
+    # Инициализация оптимизатора
+    optimizer = Adam(model.parameters(), lr=learning_rate)
+
+    step = 0
+    examples = 0
+    started = time.perf_counter()
+    running_loss = torch.zeros(())
+    running_batches = 0
+
+    # Цикл обучения
+    for epoch in range(epochs):
+        if rank == 0:
+            print(f'Epoch {epoch + 1}/{epochs}')
+        model.train()
         optimizer.zero_grad()
-        
-        # Прямой проход
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
-        loss = outputs.loss
-        
-        # Обратный проход
-        loss.backward()
-        
-        # Обновление параметров
-        optimizer.step()
-        
-        print(f'Loss: {loss.item()}')
+        for index, batch in enumerate(dataloader, 1):
+            labels = batch['labels']
+            boundary = index % accumulation == 0 or index == len(dataloader)
+            # DDP обменивается градиентами только на пачке перед шагом оптимизатора
+            if isinstance(model, DistributedDataParallel) and not boundary:
+                sync = model.no_sync()
+            else:
+                sync = contextlib.nullcontext()
+
+            with sync:
+                # Прямой проход
+                with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+                    outputs = model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'])
+                logits = outputs.logits.float()
+                if 'teacher_logits' in batch:
+                    loss = distillation_loss(logits, batch['teacher_logits'], labels, temperature, alpha)
+                else:
+                    loss = F.cross_entropy(logits, labels)
+
+                # Обратный проход
+                (loss / accumulation).backward()
+
+            running_loss += loss.detach()
+            running_batches += 1
+            examples += len(labels)
+            if not boundary:
+                continue
+
+            # Обновление параметров
+            optimizer.step()
+            optimizer.zero_grad()
+            step += 1
+            if step == 1:
+                # Первый шаг включает запуск воркеров DataLoader - в скорость не входит
+                started = time.perf_counter()
+                examples = 0
+
+            if step % log_every == 0 and rank == 0:
+                speed = examples * world_size / (time.perf_counter() - started)
+                print(f'Step {step}: loss {running_loss.item() / running_batches:.4f}, {speed:.0f} примеров/с')
+                running_loss.zero_()
+                running_batches = 0
+            if max_steps and step >= max_steps:
+                return examples * world_size / (time.perf_counter() - started)
+
+    return examples * world_size / (time.perf_counter() - started)
+
+
+def init_distributed():
+    """(rank, world_size): при запуске через torchrun - группа процессов gloo, иначе один процесс"""
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        dist.init_process_group('gloo')
+        return dist.get_rank(), world_size
+    return 0, 1
+
+
+def teacher_logits_cached(cache_dir, teacher_dir, texts, labels, max_length, rank, world_size) -> torch.Tensor:
+    """Логиты учителя считает один процесс и сохраняет рядом с кэшем токенов, остальные их читают"""
+    teacher_tokenizer = AutoTokenizer.from_pretrained(teacher_dir)
+    # Время изменения весов в имени: переобученный учитель не возьмет старые логиты
+    version = max(os.path.getmtime(os.path.join(teacher_dir, name)) for name in os.listdir(teacher_dir))
+    key = fingerprint(texts, labels, teacher_tokenizer, max_length)
+    path = os.path.join(cache_dir, f'teacher-{key}-{int(version)}.pt')
+    if rank == 0 and not os.path.exists(path):
+        teacher = AutoModelForSequenceClassification.from_pretrained(teacher_dir)
+        logits = compute_teacher_logits(teacher, teacher_tokenizer, texts, max_length)
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(logits, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    if world_size > 1:
+        dist.barrier()
+    return torch.load(path)
+
+
+def count_parameters(model) -> int:
+    return sum(p.numel() for p in model.parameters())
+
+
+def report(models, texts, labels, batch_sizes, repeat=20):
+    """Точность на отложенной выборке, число параметров и задержка на CPU для учителя и ученика"""
+    results = {}
+    for name, (model, tokenizer) in models.items():
+        backend = TorchBackend(name, model)
+        predicted = predict(backend, tokenizer, texts)
+        results[name] = {
+            'accuracy': float((predicted == labels).mean()),
+            'params': count_parameters(model),
+            'latency_ms': {size: measure_latency(backend, tokenizer, texts, size, repeat) for size in batch_sizes}
+        }
+
+    base = next(iter(results.values()))
+    for name, result in results.items():
+        print(f"\n{name}: точность {result['accuracy']:.4f}, параметров {result['params'] / 1e6:.1f} млн")
+        for size, latency in result['latency_ms'].items():
+            print(f"  пачка {size:>3}: {latency:8.2f} мс, ускорение {base['latency_ms'][size] / latency:.1f}x")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Обучение классификатора; с --teacher - дистилляция из обученной модели',
+        epilog='Несколько процессов на одной машине: torchrun --nproc_per_node 4 distil.py --threads 8 ...'
+    )
+    parser.add_argument('--teacher', help='каталог модели-учителя (./my_model из unbalance_classes.py)')
+    parser.add_argument('--student', help='модель-ученик (по умолчанию distilbert-base-multilingual-cased, '
+                                          'без --teacher - bert-base-multilingual-uncased)')
+    parser.add_argument('--output', default='./my_model_student', help='куда сохранить обученную модель')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=16, help='пачка одного процесса')
+    parser.add_argument('--accumulation', type=int, default=1, help='пачек на один шаг оптимизатора')
+    parser.add_argument('--bf16', action='store_true', help='прямой проход в bfloat16 (CPU с AVX512-BF16/AMX)')
+    parser.add_argument('--threads', type=int, help='потоков torch на процесс (по умолчанию ядра / процессы)')
+    parser.add_argument('--log-every', type=int, default=50, help='печатать потерю раз в столько шагов')
+    parser.add_argument('--benchmark-steps', type=int,
+                        help='только замерить скорость (примеров/с) на стольких шагах, без сохранения и отчета')
+    parser.add_argument('--max-length', type=int, default=128)
+    parser.add_argument('--lr', type=float, default=5e-5)
+    parser.add_argument('--temperature', type=float, default=2.0, help='температура смягчения логитов')
+    parser.add_argument('--alpha', type=float, default=0.5, help='вес KL по учителю против CE по меткам')
+    parser.add_argument('--limit', type=int, default=1000, help='текстов отложенной выборки для отчета')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32], help='размеры пачек для замера')
+    parser.add_argument('--cache-dir', default='./token_cache', help='каталог кэша токенизированных текстов')
+    parser.add_argument('--workers', type=int, default=2, help='воркеров DataLoader')
+    args = parser.parse_args()
+
+    rank, world_size = init_distributed()
+    # torchrun ставит OMP_NUM_THREADS=1, поэтому число потоков задаем явно
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // world_size))
+
+    X_train, X_test, y_train, y_test = split_data(load_data())
+    texts, labels = X_train.tolist(), y_train.tolist()
+
+    student_name = args.student or (
+        'distilbert-base-multilingual-cased' if args.teacher else 'bert-base-multilingual-uncased'
+    )
+    tokenizer = AutoTokenizer.from_pretrained(student_name)
+    model = AutoModelForSequenceClassification.from_pretrained(student_name, num_labels=2)
+
+    extra = {}
+    if args.teacher:
+        # У учителя свой токенизатор, поэтому его логиты считаются заранее по текстам
+        extra['teacher_logits'] = teacher_logits_cached(
+            args.cache_dir, args.teacher, texts, labels, args.max_length, rank, world_size
+        )
+
+    # Тексты токенизируются один раз в кэш, пачки - из текстов близкой длины с дополнением до самого длинного.
+    # Кэш строит первый процесс, остальные ждут и открывают готовый
+    if rank == 0:
+        cached_dataset(args.cache_dir, texts, labels, tokenizer, args.max_length)
+    if world_size > 1:
+        dist.barrier()
+    dataset = cached_dataset(args.cache_dir, texts, labels, tokenizer, args.max_length, **extra)
+    dataloader = make_dataloader(
+        dataset, args.batch_size, tokenizer.pad_token_id, num_workers=args.workers, rank=rank, world_size=world_size
+    )
+
+    trained = DistributedDataParallel(model) if world_size > 1 else model
+    speed = train(
+        trained, dataloader, args.epochs, args.lr, args.temperature, args.alpha,
+        accumulation=args.accumulation, bf16=args.bf16, log_every=args.log_every,
+        max_steps=args.benchmark_steps, rank=rank, world_size=world_size
+    )
+    if rank == 0:
+        print(f"Скорость обучения: {speed:.0f} примеров/с ({world_size} процессов по {torch.get_num_threads()} "
+              f"потоков, пачка {args.batch_size} x {args.accumulation}, bf16={args.bf16})")
+
+    if rank == 0 and not args.benchmark_steps:
+        model.save_pretrained(args.output)
+        tokenizer.save_pretrained(args.output)
+        print(f"Модель сохранена в {args.output}")
+
+        model.eval()
+        models = {}
+        if args.teacher:
+            models['teacher'] = (
+                AutoModelForSequenceClassification.from_pretrained(args.teacher),
+                AutoTokenizer.from_pretrained(args.teacher)
+            )
+        models['student'] = (model, tokenizer)
+        report(models, X_test.tolist()[:args.limit], y_test.to_numpy()[:args.limit], args.batch_sizes)
+
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Экспорт классификатора из ./my_model для CPU.
+
+Рядом с моделью сохраняются:
+  model_int8.pt    - динамическое квантование Linear-слоев в int8 (torch)
+  model.onnx       - граф для ONNX Runtime (--onnx)
+  model_int8.onnx  - тот же граф с int8-весами (--onnx)
+  backends.json    - точность и задержка каждого варианта и рейтинг для load_backend
+
+python export_model.py --model ./my_model --onnx
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from classifier import BACKENDS_FILE, INT8_FILE, ONNX_FILE, ONNX_INT8_FILE, open_backend
+from unbalance_classes import load_data, split_data
+
+
+class LogitsOnly(torch.nn.Module):
+    """Обертка для torch.onnx.export: входы по порядку names, на выходе только logits, без ModelOutput"""
+
+    def __init__(self, model, names: List[str]):
+        super().__init__()
+        self.model = model
+        self.names = names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.names, inputs))).logits
+
+
+def export_int8(model_dir: str) -> str:
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+    model.eval()
+    quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    path = os.path.join(model_dir, INT8_FILE)
+    torch.save(quantized, path)
+    return path
+
+
+def export_onnx(model_dir: str, tokenizer, opset: int = 14) -> List[str]:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+    model.eval()
+    sample = tokenizer(['пример текста'], return_tensors='pt')
+    # Входы - те, что выдает токенизатор модели: у DistilBERT, например, нет token_type_ids
+    names = [name for name in tokenizer.model_input_names if name in sample]
+    path = os.path.join(model_dir, ONNX_FILE)
+    torch.onnx.export(
+        LogitsOnly(model, names),
+        tuple(sample[name] for name in names),
+        path,
+        input_names=names,
+        output_names=['logits'],
+        # Размер пачки и длина текста меняются от вызова к вызову
+        dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in names}, 'logits': {0: 'batch'}},
+        opset_version=opset
+    )
+    int8_path = os.path.join(model_dir, ONNX_INT8_FILE)
+    quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+    return [path, int8_path]
+
+
+def weights_size(model_dir: str, name: str) -> int:
+    files = {
+        'fp32': ['model.safetensors', 'pytorch_model.bin'],
+        'int8': [INT8_FILE],
+        'onnx': [ONNX_FILE],
+        'onnx-int8': [ONNX_INT8_FILE]
+    }[name]
+    return sum(os.path.getsize(os.path.join(model_dir, f)) for f in files if os.path.exists(os.path.join(model_dir, f)))
+
+
+def predict(backend, tokenizer, texts: List[str], batch_size: int = 64, max_length: int = 128) -> np.ndarray:
+    labels = []
+    for start in range(0, len(texts), batch_size):
+        inputs = tokenizer(
+            texts[start:start + batch_size], padding='longest', truncation=True, max_length=max_length,
+            return_tensors=backend.tensors
+        )
+        labels.append(backend.logits(inputs).argmax(axis=-1))
+    return np.concatenate(labels)
+
+
+def measure_latency(backend, tokenizer, texts: List[str], batch_size: int, repeat: int) -> float:
+    """Медиана времени одной пачки в миллисекундах, вместе с токенизацией - как в боте"""
+    batch = (texts * (batch_size // len(texts) + 1))[:batch_size]
+    for _ in range(3):
+        predict(backend, tokenizer, batch, batch_size)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        predict(backend, tokenizer, batch, batch_size)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def evaluate(
+    model_dir: str,
+    names: List[str],
+    limit: int,
+    batch_sizes: List[int],
+    repeat: int,
+    min_agreement: float,
+    threads: Optional[int] = None
+) -> Dict[str, Any]:
+    """Сверка вариантов с fp32 на отложенной выборке unbalance_classes.py и замер задержки"""
+    if threads:
+        torch.set_num_threads(threads)
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    _, X_test, _, y_test = split_data(load_data())
+    texts = X_test.tolist()[:limit]
+    labels = np.array(y_test.tolist()[:limit])
+
+    reference = None
+    results = {}
+    for name in names:
+        backend = open_backend(model_dir, name, threads)
+        predicted = predict(backend, tokenizer, texts)
+        if reference is None:
+            reference = predicted
+        results[name] = {
+            'accuracy': float((predicted == labels).mean()),
+            'agreement': float((predicted == reference).mean()),
+            'size_mb': round(weights_size(model_dir, name) / 2 ** 20, 1),
+            'latency_ms': {
+                str(size): round(measure_latency(backend, tokenizer, texts, size, repeat), 2) for size in batch_sizes
+            }
+        }
+
+    # Рейтинг по задержке на самой большой пачке; варианты с потерей точности не участвуют
+    largest = str(max(batch_sizes))
+    ranking = sorted(
+        (name for name, result in results.items() if result['agreement'] >= min_agreement),
+        key=lambda name: results[name]['latency_ms'][largest]
+    )
+    return {'evaluated_on': len(texts), 'min_agreement': min_agreement, 'backends': results, 'ranking': ranking}
+
+
+def print_report(report: Dict[str, Any]):
+    fp32 = report['backends']['fp32']
+    print(f"Отложенная выборка: {report['evaluated_on']} текстов")
+    for name, result in report['backends'].items():
+        print(f"\n{name}: точность {result['accuracy']:.4f}, совпадение с fp32 {result['agreement']:.4f}, "
+              f"веса {result['size_mb']} МБ")
+        for size, latency in result['latency_ms'].items():
+            speedup = fp32['latency_ms'][size] / latency
+            print(f"  пачка {size:>3}: {latency:8.2f} мс, {int(size) / latency * 1000:8.0f} текстов/с, "
+                  f"ускорение {speedup:.1f}x")
+    print(f"\nРейтинг для load_backend: {', '.join(report['ranking'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Экспорт классификатора в int8/ONNX и замер на CPU')
+    parser.add_argument('--model', default='./my_model', help='каталог модели из unbalance_classes.py')
+    parser.add_argument('--onnx', action='store_true', help='дополнительно экспортировать в ONNX (нужен onnxruntime)')
+    parser.add_argument('--limit', type=int, default=1000, help='текстов отложенной выборки для сверки')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32], help='размеры пачек для замера')
+    parser.add_argument('--repeat', type=int, default=20, help='повторов замера на каждый размер пачки')
+    parser.add_argument('--min-agreement', type=float, default=0.99,
+                        help='минимальная доля совпадений с fp32, чтобы вариант попал в рейтинг')
+    parser.add_argument('--threads', type=int, help='потоков torch/onnxruntime (как classifier_threads в боте)')
+    args = parser.parse_args()
+
+    names = ['fp32', 'int8']
+    print(f"Сохранено: {export_int8(args.model)}")
+    if args.onnx:
+        tokenizer = AutoTokenizer.from_pretrained(args.model)
+        for path in export_onnx(args.model, tokenizer):
+            print(f"Сохранено: {path}")
+        names += ['onnx', 'onnx-int8']
+
+    report = evaluate(args.model, names, args.limit, args.batch_sizes, args.repeat, args.min_agreement, args.threads)
+    with open(os.path.join(args.model, BACKENDS_FILE), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+JOB_WAIT_SECONDS = metrics.histogram('bot_job_wait_seconds', 'Ожидание задачи в очереди', ['job'])
+JOB_RUN_SECONDS = metrics.histogram('bot_job_run_seconds', 'Выполнение задачи', ['job', 'status'])
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TIMEOUT = 'timeout'
+FINISHED = (DONE, FAILED, CANCELLED, TIMEOUT)
+
+# Задача, в которой выполняется текущая корутина: run_in_pool привязывает к ней работу в пуле
+_current_job: contextvars.ContextVar[Optional['Job']] = contextvars.ContextVar('current_job', default=None)
+
+STATUS_TEXT = {
+    QUEUED: 'в очереди',
+    RUNNING: 'выполняется',
+    DONE: 'готова',
+    FAILED: 'ошибка',
+    CANCELLED: 'отменена',
+    TIMEOUT: 'прервана по времени'
+}
+
+
+class Job:
+    """Задача пользователя: статус, время и результат; по id ее можно запросить позже"""
+
+    def __init__(self, job_id: int, name: str, sender: str, room_id: str, timeout: float):
+        self.id = job_id
+        self.name = name
+        self.sender = sender
+        self.room_id = room_id
+        self.timeout = timeout
+        self.status = QUEUED
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.runner: Optional[asyncio.Task] = None
+        # Работа задачи в пуле процессов (run_in_pool): отмена ее не останавливает
+        self.pool_futures: List[Future] = []
+        self.on_done: Optional[Callable[['Job'], Awaitable[Any]]] = None
+
+    def describe(self) -> str:
+        now = time.monotonic()
+        if self.status == QUEUED:
+            timing = f"ждет {now - self.submitted_at:.0f} с"
+        elif self.status == RUNNING:
+            timing = f"{now - self.started_at:.0f} с"
+        else:
+            timing = f"за {(self.finished_at or now) - (self.started_at or self.submitted_at):.1f} с"
+        text = f"#{self.id} {self.name}: {STATUS_TEXT[self.status]} ({timing})"
+        if self.error:
+            text += f" - {self.error}"
+        return text
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class JobManager:
+    """Выполнение тяжелых команд вне event loop.
+
+    Работа задачи - корутина; тяжелую часть она выполняет через run_in_pool
+    (функция в пуле процессов). Одновременно выполняется не больше workers
+    задач, остальные ждут в очереди. Пока задача идет, в комнату раз в
+    progress_interval секунд уходит сообщение о ходе; по истечении timeout
+    задача прерывается. Отмена (cancel) снимает задачи пользователя: ожидающая
+    в очереди в пул не попадет, а уже начатая в процессе доработает, но ее
+    результат отбрасывается. Слот прерванной задачи освобождается только
+    после того, как процесс закончит ее работу: пул не получает больше
+    workers функций одновременно.
+    Завершенные задачи хранятся (до keep штук), чтобы результат можно было запросить.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        notify: Callable[[str, str], Awaitable[Any]],
+        workers: int = 2,
+        timeout: float = 600,
+        progress_interval: float = 30,
+        keep: int = 200
+    ):
+        self.executor = executor
+        self.notify = notify
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        self.keep = keep
+        self.jobs: 'OrderedDict[int, Job]' = OrderedDict()
+        self._slots = asyncio.Semaphore(workers)
+        self._ids = itertools.count(1)
+        # Последние задержки: ожидание в очереди и выполнение
+        self.wait_seconds: deque = deque(maxlen=1000)
+        self.run_seconds: deque = deque(maxlen=1000)
+        self.finished = {status: 0 for status in FINISHED}
+        # Ожидание работы прерванных задач в пуле перед освобождением их слотов
+        self._draining: Set[asyncio.Task] = set()
+
+    def run_in_pool(self, func: Callable[..., Any], *args) -> Awaitable[Any]:
+        """Функция в пуле процессов; вызванная из задачи, держит ее слот до своего окончания"""
+        future = self.executor.submit(func, *args)
+        job = _current_job.get()
+        if job is not None:
+            job.pool_futures.append(future)
+        return asyncio.wrap_future(future)
+
+    def submit(
+        self,
+        sender: str,
+        room_id: str,
+        name: str,
+        work: Callable[[], Awaitable[Any]],
+        on_done: Optional[Callable[[Job], Awaitable[Any]]] = None,
+        timeout: Optional[float] = None
+    ) -> Job:
+        """Постановка задачи. on_done(job) вызывается после успешного завершения (по умолчанию - str(result) в комнату)"""
+        job = Job(next(self._ids), name, sender, room_id, timeout or self.timeout)
+        job.on_done = on_done
+        self.jobs[job.id] = job
+        self._trim()
+        job.runner = asyncio.create_task(self._run(job, work))
+        return job
+
+    def _trim(self):
+        # Удаляем самые старые завершенные задачи сверх keep
+        excess = len(self.jobs) - self.keep
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.status in FINISHED][:max(0, excess)]:
+            del self.jobs[job_id]
+
+    def _finish(self, job: Job, status: str, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.monotonic()
+        self.finished[status] += 1
+        if job.started_at is not None:
+            self.run_seconds.append(job.finished_at - job.started_at)
+            JOB_RUN_SECONDS.observe(job.finished_at - job.started_at, job=job.name, status=status)
+
+    async def _run(self, job: Job, work: Callable[[], Awaitable[Any]]):
+        try:
+            await self._slots.acquire()
+            try:
+                job.status = RUNNING
+                job.started_at = time.monotonic()
+                self.wait_seconds.append(job.started_at - job.submitted_at)
+                JOB_WAIT_SECONDS.observe(job.started_at - job.submitted_at, job=job.name)
+                _current_job.set(job)
+                task = asyncio.ensure_future(work())
+                try:
+                    job.result = await self._wait(job, task)
+                finally:
+                    if not task.done():
+                        task.cancel()
+            finally:
+                self._release_slot(job)
+        except asyncio.TimeoutError:
+            self._finish(job, TIMEOUT)
+            await self.notify(job.room_id, f"Задача #{job.id} ({job.name}) прервана: дольше {job.timeout:.0f} с")
+            return
+        except asyncio.CancelledError:
+            self._finish(job, CANCELLED)
+            return
+        except Exception as e:
+            logger.error("Задача #%s (%s) завершилась с ошибкой: %s", job.id, job.name, e)
+            self._finish(job, FAILED, str(e))
+            await self.notify(job.room_id, f"Задача #{job.id} ({job.name}) завершилась с ошибкой: {e}")
+            return
+
+        self._finish(job, DONE)
+        logger.info("Задача #%s (%s) выполнена за %.2f с", job.id, job.name, job.finished_at - job.started_at)
+        try:
+            await self.deliver(job)
+        except Exception as e:
+            logger.error("Ошибка отправки результата задачи #%s: %s", job.id, e)
+
+    def _release_slot(self, job: Job):
+        busy = [future for future in job.pool_futures if not future.done()]
+        if not busy:
+            self._slots.release()
+            return
+        # Прерванная задача еще считается в процессе: слот освободится, когда он закончит
+        drain = asyncio.ensure_future(self._release_after(busy))
+        self._draining.add(drain)
+        drain.add_done_callback(self._draining.discard)
+
+    async def _release_after(self, futures: List[Future]):
+        try:
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+        finally:
+            self._slots.release()
+
+    async def deliver(self, job: Job):
+        """Отправка результата готовой задачи в комнату: по завершении и повторно по запросу"""
+        if job.on_done is not None:
+            await job.on_done(job)
+        else:
+            await self.notify(job.room_id, f"Задача #{job.id} ({job.name}) готова:\n{job.result}")
+
+    async def _wait(self, job: Job, task: asyncio.Future) -> Any:
+        """Ожидание результата с сообщениями о ходе и общим лимитом времени"""
+        deadline = job.started_at + job.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), min(self.progress_interval, remaining))
+            except asyncio.TimeoutError:
+                if time.monotonic() >= deadline:
+                    raise
+                await self.notify(job.room_id, f"Задача #{job.id} ({job.name}) выполняется "
+                                               f"{time.monotonic() - job.started_at:.0f} с...")
+
+    def get(self, job_id: int) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def user_jobs(self, sender: str) -> List[Job]:
+        return [job for job in self.jobs.values() if job.sender == sender]
+
+    def cancel(self, sender: str) -> List[Job]:
+        """Отмена всех незавершенных задач пользователя"""
+        cancelled = [job for job in self.user_jobs(sender) if job.status not in FINISHED]
+        for job in cancelled:
+            job.runner.cancel()
+        return cancelled
+
+    def stats(self) -> Dict[str, Any]:
+        statuses = [job.status for job in self.jobs.values()]
+        waits, runs = list(self.wait_seconds), list(self.run_seconds)
+        return {
+            'queued': statuses.count(QUEUED),
+            'running': statuses.count(RUNNING),
+            'finished': dict(self.finished),
+            'wait_p50': percentile(waits, 0.5),
+            'wait_p95': percentile(waits, 0.95),
+            'run_p50': percentile(runs, 0.5),
+            'run_p95': percentile(runs, 0.95)
+        }
+
+    async def close(self):
+        runners = [job.runner for job in self.jobs.values() if job.status not in FINISHED]
+        for runner in runners:
+            runner.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+        # Работу прерванных задач в пуле не ждем: пул останавливается вслед за менеджером
+        for drain in list(self._draining):
+            drain.cancel()
+        await asyncio.gather(*self._draining, return_exceptions=True)
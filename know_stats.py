@@ -1,110 +1,619 @@
-import pandas as pd
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import tempfile
+import time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+CALL_COLUMNS = ['date', 'tlf_call', 'tlf_to', 'fio_call', 'fio_to', 'group_call', 'group_to']
+
+
+def load_sample() -> pd.DataFrame:
+    # Пример данных
+    data = {
+        'date': ['2024-01-01 06:55:11', '2024-01-02 07:00:00', '2024-01-03 08:00:00',
+                 '2024-01-01 09:00:00', '2024-01-02 10:00:00'],
+        'tlf_call': ['1234567890', '1234567890', '1234567890', '0987654321', '0987654321'],
+        'tlf_to': ['0987654321', '1234567890', '1111111111', '1234567890', '2222222222'],
+        'fio_call': ['Иванов И.И.', 'Иванов И.И.', 'Иванов И.И.', 'Петров П.П.', 'Петров П.П.'],
+        'fio_to': ['Петров П.П.', 'Иванов И.И.', 'Сидоров С.С.', 'Иванов И.И.', 'Сидоров С.С.'],
+        'group_call': [None, None, None, 'Group A', 'Group B'],
+        'group_to': ['Group A', None, 'Group C', None, 'Group C']
+    }
+
+    # Создаем DataFrame
+    df = pd.DataFrame(data)
+
+    # Преобразуем столбец с датами в формат datetime
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+def filter_unknown(df: pd.DataFrame) -> pd.DataFrame:
+    # Фильтруем абонентов с неизвестной группой
+    return df[df['group_call'].isnull() | df['group_to'].isnull()]
+
+
+def aggregate_loop(unknown_group_calls: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
+    """Исходный построчный расчет (iterrows). Оставлен как эталон для проверки aggregate.
+
+    Цикл проверяет "is not None", поэтому пропуски должны быть None, а не NaN
+    (NaN дают строковые колонки pandas и чтение CSV) - см. nulls_as_none.
+    """
+    # Словари для агрегации
+    result = defaultdict(lambda: {
+        'fio_abonents_agg': defaultdict(int),
+        'group_abonents_agg': defaultdict(int),
+        'connect_dates': defaultdict(lambda: {'date_first_connect': None, 'date_last_connect': None})
+    })
+
+    # Обрабатываем данные
+    for _, row in unknown_group_calls.iterrows():
+        tlf_new = row['tlf_call']
+        date = row['date']
+
+        # Если у tlf_call есть группа, используем tlf_to как известный номер
+        if row['group_call'] is not None:
+            tlf_know = row['tlf_to']
+            fio_to = row['fio_to']
+            group_to = row['group_to']
+
+            # Обновляем агрегацию ФИО
+            result[tlf_new]['fio_abonents_agg'][fio_to] += 1
+
+            # Обновляем агрегацию групп
+            if group_to:
+                result[tlf_new]['group_abonents_agg'][group_to] += 1
+
+            # Обновляем даты соединений для каждой пары
+            pair_key = (tlf_new, tlf_know)
+            if result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] is None or date < result[tlf_new]['connect_dates'][pair_key]['date_first_connect']:
+                result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] = date
+            if result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] is None or date > result[tlf_new]['connect_dates'][pair_key]['date_last_connect']:
+                result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] = date
+
+        # Если у tlf_to есть группа, используем tlf_call как известный номер
+        elif row['group_to'] is not None:
+            tlf_know = row['tlf_call']
+            fio_to = row['fio_call']
+            group_call = row['group_call']
+
+            # Обновляем агрегацию ФИО
+            result[tlf_new]['fio_abonents_agg'][fio_to] += 1
+
+            # Обновляем агрегацию групп
+            if group_call:
+                result[tlf_new]['group_abonents_agg'][group_call] += 1
+
+            # Обновляем даты соединений для каждой пары
+            pair_key = (tlf_know, tlf_new)
+            if result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] is None or date < result[tlf_new]['connect_dates'][pair_key]['date_first_connect']:
+                result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] = date
+            if result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] is None or date > result[tlf_new]['connect_dates'][pair_key]['date_last_connect']:
+                result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] = date
+
+    return result
+
+
+def nulls_as_none(df: pd.DataFrame) -> pd.DataFrame:
+    """Пропуски (NaN) -> None, как их ожидает aggregate_loop"""
+    return df.astype(object).where(df.notnull(), None)
 
-# Пример данных
-data = {
-    'date': ['2024-01-01 06:55:11', '2024-01-02 07:00:00', '2024-01-03 08:00:00', 
-             '2024-01-01 09:00:00', '2024-01-02 10:00:00'],
-    'tlf_call': ['1234567890', '1234567890', '1234567890', '0987654321', '0987654321'],
-    'tlf_to': ['0987654321', '1234567890', '1111111111', '1234567890', '2222222222'],
-    'fio_call': ['Иванов И.И.', 'Иванов И.И.', 'Иванов И.И.', 'Петров П.П.', 'Петров П.П.'],
-    'fio_to': ['Петров П.П.', 'Иванов И.И.', 'Сидоров С.С.', 'Иванов И.И.', 'Сидоров С.С.'],
-    'group_call': [None, None, None, 'Group A', 'Group B'],
-    'group_to': ['Group A', None, 'Group C', None, 'Group C']
+
+def prepare_pairs(unknown_group_calls: pd.DataFrame) -> pd.DataFrame:
+    """Для каждой строки - тот же выбор номера, ФИО, группы и пары, что и в aggregate_loop, но столбцами.
+
+    Строка учитывается, если известна группа ровно одной стороны (при двух
+    неизвестных группах цикл ничего не делает).
+    """
+    group_call_known = unknown_group_calls['group_call'].notnull().to_numpy()
+    group_to_known = unknown_group_calls['group_to'].notnull().to_numpy()
+    use_to = group_call_known                        # ветка "у tlf_call есть группа"
+    selected = group_call_known | group_to_known
+    calls = unknown_group_calls[selected]
+    use_to = use_to[selected]
+
+    tlf_new = calls['tlf_call'].to_numpy()
+    tlf_know = np.where(use_to, calls['tlf_to'].to_numpy(), tlf_new)
+    return pd.DataFrame({
+        'tlf_new': tlf_new,
+        'fio': np.where(use_to, calls['fio_to'].to_numpy(), calls['fio_call'].to_numpy()),
+        'group': np.where(use_to, calls['group_to'].to_numpy(), calls['group_call'].to_numpy()),
+        'pair_first': np.where(use_to, tlf_new, tlf_know),
+        'pair_second': np.where(use_to, tlf_know, tlf_new),
+        'date': calls['date'].to_numpy()
+    })
+
+
+def partial_aggregate(unknown_group_calls: pd.DataFrame, offset: int = 0, by_day: bool = False) -> Dict[str, pd.DataFrame]:
+    """Частичные агрегаты по куску данных, которые точно сливаются merge_partials.
+
+    Для каждой группы кроме счетчика/дат хранится pos - номер первой строки
+    (offset - сколько строк исходных данных было до этого куска), чтобы после
+    слияния восстановить порядок первого появления, как у aggregate_loop.
+    by_day - первым ключом групп идет день звонка ('2024-01-01'), как их хранит AggregateStore.
+    """
+    pairs = prepare_pairs(unknown_group_calls)
+    pairs['pos'] = offset + np.arange(len(pairs))
+    keys = []
+    if by_day:
+        pairs['day'] = pairs['date'].dt.strftime('%Y-%m-%d')
+        keys = ['day']
+
+    fio = pairs.groupby(keys + ['tlf_new', 'fio'], sort=False, dropna=False).agg(
+        count=('pos', 'size'), pos=('pos', 'min'))
+    # Как и "if group_to:" в цикле - пустые и неизвестные группы не считаем
+    has_group = pairs['group'].notnull() & (pairs['group'] != '')
+    group = pairs[has_group].groupby(keys + ['tlf_new', 'group'], sort=False).agg(
+        count=('pos', 'size'), pos=('pos', 'min'))
+    dates = pairs.groupby(keys + ['tlf_new', 'pair_first', 'pair_second'], sort=False).agg(
+        first=('date', 'min'), last=('date', 'max'), pos=('pos', 'min'))
+    return {'fio': fio, 'group': group, 'dates': dates}
+
+
+PARTIAL_MERGE = {
+    'fio': {'count': 'sum', 'pos': 'min'},
+    'group': {'count': 'sum', 'pos': 'min'},
+    'dates': {'first': 'min', 'last': 'max', 'pos': 'min'},
 }
 
-# Создаем DataFrame
-df = pd.DataFrame(data)
-
-# Преобразуем столбец с датами в формат datetime
-df['date'] = pd.to_datetime(df['date'])
-
-# Фильтруем абонентов с неизвестной группой
-unknown_group_calls = df[df['group_call'].isnull() | df['group_to'].isnull()]
-
-# Словари для агрегации
-result = defaultdict(lambda: {
-    'fio_abonents_agg': defaultdict(int),
-    'group_abonents_agg': defaultdict(int),
-    'connect_dates': defaultdict(lambda: {'date_first_connect': None, 'date_last_connect': None})
-})
-
-# Обрабатываем данные
-for _, row in unknown_group_calls.iterrows():
-    tlf_new = row['tlf_call']
-    date = row['date']
-    
-    # Если у tlf_call есть группа, используем tlf_to как известный номер
-    if row['group_call'] is not None:
-        tlf_know = row['tlf_to']
-        fio_to = row['fio_to']
-        group_to = row['group_to']
-        
-        # Обновляем агрегацию ФИО
-        result[tlf_new]['fio_abonents_agg'][fio_to] += 1
-        
-        # Обновляем агрегацию групп
-        if group_to:
-            result[tlf_new]['group_abonents_agg'][group_to] += 1
-        
-        # Обновляем даты соединений для каждой пары
-        pair_key = (tlf_new, tlf_know)
-        if result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] is None or date < result[tlf_new]['connect_dates'][pair_key]['date_first_connect']:
-            result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] = date
-        if result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] is None or date > result[tlf_new]['connect_dates'][pair_key]['date_last_connect']:
-            result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] = date
-
-    # Если у tlf_to есть группа, используем tlf_call как известный номер
-    elif row['group_to'] is not None:
-        tlf_know = row['tlf_call']
-        fio_to = row['fio_call']
-        group_call = row['group_call']
-        
-        # Обновляем агрегацию ФИО
-        result[tlf_new]['fio_abonents_agg'][fio_to] += 1
-        
-        # Обновляем агрегацию групп
-        if group_call:
-            result[tlf_new]['group_abonents_agg'][group_call] += 1
-        
-        # Обновляем даты соединений для каждой пары
-        pair_key = (tlf_know, tlf_new)
-        if result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] is None or date < result[tlf_new]['connect_dates'][pair_key]['date_first_connect']:
-            result[tlf_new]['connect_dates'][pair_key]['date_first_connect'] = date
-        if result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] is None or date > result[tlf_new]['connect_dates'][pair_key]['date_last_connect']:
-            result[tlf_new]['connect_dates'][pair_key]['date_last_connect'] = date
-
-# Форматируем результат
-formatted_result = []
-for tlf_new, agg_data in result.items():
-    fio_abonents_agg = ', '.join([f"{fio}: {count}" for fio, count in agg_data['fio_abonents_agg'].items()])
-    group_abonents_agg = ', '.join([f"{group}: {count}" for group, count in agg_data['group_abonents_agg'].items()])
-    
-    # Собираем даты соединений для каждой пары
-    connect_dates = []
-    for (caller, receiver), dates in agg_data['connect_dates'].items():
-        connect_dates.append({
-            'pair': f"{caller} - {receiver}",
-            'date_first_connect': dates['date_first_connect'],
-            'date_last_connect': dates['date_last_connect']
+
+def merge_partials(partials: List[Dict[str, pd.DataFrame]]) -> Dict[str, pd.DataFrame]:
+    """Слияние частичных агрегатов: суммы счетчиков, min/max дат, min позиции"""
+    if len(partials) == 1:
+        return partials[0]
+    merged = {}
+    for name, how in PARTIAL_MERGE.items():
+        frame = pd.concat([partial[name] for partial in partials])
+        merged[name] = frame.groupby(level=list(range(frame.index.nlevels)), sort=False, dropna=False).agg(how)
+    return merged
+
+
+def result_from_partial(partial: Dict[str, pd.DataFrame]) -> Dict[str, Dict[str, Any]]:
+    fio = partial['fio'].sort_values('pos', kind='stable')
+    group = partial['group'].sort_values('pos', kind='stable')
+    dates = partial['dates'].sort_values('pos', kind='stable')
+    return build_result(
+        zip(fio.index, fio['count'].tolist()),
+        zip(group.index, group['count'].tolist()),
+        zip(dates.index, dates['first'].tolist(), dates['last'].tolist())
+    )
+
+
+def aggregate(unknown_group_calls: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
+    """Векторный расчет той же агрегации через groupby.
+
+    Результат совпадает с aggregate_loop, включая порядок ключей (порядок
+    первого появления), поэтому format_result дает идентичный вывод.
+    """
+    return result_from_partial(partial_aggregate(unknown_group_calls))
+
+
+class _RangeReader(io.RawIOBase):
+    """Чтение открытого файла не дальше limit байт от текущей позиции"""
+
+    def __init__(self, f: io.BufferedReader, limit: int):
+        self._f = f
+        self._left = limit
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._left <= 0:
+            return 0
+        read = self._f.readinto(memoryview(buffer)[:self._left])
+        self._left -= read
+        return read
+
+
+def last_row_end(path: str, size: int, block: int = 1 << 16) -> int:
+    """Смещение конца последней полной строки файла (после последнего перевода строки)"""
+    with open(path, 'rb') as f:
+        position = size
+        while position > 0:
+            start = max(0, position - block)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            position = start
+    return 0
+
+
+def read_chunks(path: str, chunksize: int, start: int = 0, end: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """Чтение журнала звонков кусками по chunksize строк (CSV или Parquet), только нужные колонки.
+
+    Для CSV можно прочитать только байты [start, end): start - конец уже
+    загруженных строк (AggregateStore.sync_file), end - конец последней полной
+    строки. Заголовок тогда берется из первой строки файла, а предыдущие строки
+    не разбираются.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=CALL_COLUMNS):
+            yield batch.to_pandas()
+        return
+
+    with open(path, 'rb') as f:
+        header = {}
+        if start > 0:
+            names = next(csv.reader([f.readline().decode('utf-8')]))
+            header = {'header': None, 'names': names}
+            f.seek(start)
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        stream = io.BufferedReader(_RangeReader(f, end - f.tell()))
+        # Номера читаем строками, чтобы не терять ведущие нули
+        yield from pd.read_csv(stream, usecols=CALL_COLUMNS, dtype=str, chunksize=chunksize, **header)
+
+
+def process_chunk(
+    chunk: pd.DataFrame,
+    offset: int,
+    date_from: Optional[pd.Timestamp] = None,
+    date_to: Optional[pd.Timestamp] = None,
+    by_day: bool = False
+) -> Dict[str, pd.DataFrame]:
+    # Фильтруем как можно раньше: даты разбираем только у строк с неизвестной группой
+    unknown_group_calls = filter_unknown(chunk)
+    unknown_group_calls = unknown_group_calls.assign(date=pd.to_datetime(unknown_group_calls['date']))
+    # Период [date_from, date_to)
+    if date_from is not None:
+        unknown_group_calls = unknown_group_calls[unknown_group_calls['date'] >= date_from]
+    if date_to is not None:
+        unknown_group_calls = unknown_group_calls[unknown_group_calls['date'] < date_to]
+    return partial_aggregate(unknown_group_calls, offset, by_day)
+
+
+def aggregate_file(
+    path: str,
+    chunksize: int = 1_000_000,
+    workers: int = 0,
+    date_from: Optional[pd.Timestamp] = None,
+    date_to: Optional[pd.Timestamp] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Агрегация файла, который не помещается в память (звонки за период [date_from, date_to)).
+
+    Пиковая память - несколько кусков по chunksize строк плюс накопленные
+    агрегаты (пропорциональны числу групп, а не строк). При workers > 1
+    куски обрабатываются в пуле процессов, в очереди не больше 2 * workers кусков.
+    """
+    state: Optional[Dict[str, pd.DataFrame]] = None
+
+    def fold(partials):
+        nonlocal state
+        state = merge_partials(([state] if state is not None else []) + list(partials))
+
+    offset = 0
+    if workers <= 1:
+        for chunk in read_chunks(path, chunksize):
+            fold([process_chunk(chunk, offset, date_from, date_to)])
+            offset += len(chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for chunk in read_chunks(path, chunksize):
+                pending.add(pool.submit(process_chunk, chunk, offset, date_from, date_to))
+                offset += len(chunk)
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    fold(future.result() for future in done)
+            fold(future.result() for future in pending)
+
+    return result_from_partial(state) if state is not None else {}
+
+
+def build_result(fio_counts, group_counts, connect_dates) -> Dict[str, Dict[str, Any]]:
+    """Сборка словаря той же структуры, что у aggregate_loop, из сгруппированных значений"""
+    result: Dict[str, Dict[str, Any]] = {}
+
+    def entry(tlf_new):
+        agg_data = result.get(tlf_new)
+        if agg_data is None:
+            agg_data = result[tlf_new] = {'fio_abonents_agg': {}, 'group_abonents_agg': {}, 'connect_dates': {}}
+        return agg_data
+
+    for (tlf_new, fio), count in fio_counts:
+        # Пропуск ФИО - None, как в aggregate_loop (groupby дает NaN)
+        entry(tlf_new)['fio_abonents_agg'][None if pd.isna(fio) else fio] = int(count)
+    for (tlf_new, group), count in group_counts:
+        entry(tlf_new)['group_abonents_agg'][group] = int(count)
+    for (tlf_new, caller, receiver), first, last in connect_dates:
+        entry(tlf_new)['connect_dates'][(caller, receiver)] = {
+            'date_first_connect': first,
+            'date_last_connect': last
+        }
+    return result
+
+
+def format_result(result: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Форматируем результат
+    formatted_result = []
+    for tlf_new, agg_data in result.items():
+        fio_abonents_agg = ', '.join([f"{fio}: {count}" for fio, count in agg_data['fio_abonents_agg'].items()])
+        group_abonents_agg = ', '.join([f"{group}: {count}" for group, count in agg_data['group_abonents_agg'].items()])
+
+        # Собираем даты соединений для каждой пары
+        connect_dates = []
+        for (caller, receiver), dates in agg_data['connect_dates'].items():
+            connect_dates.append({
+                'pair': f"{caller} - {receiver}",
+                'date_first_connect': dates['date_first_connect'],
+                'date_last_connect': dates['date_last_connect']
+            })
+
+        formatted_result.append({
+            'tlf_new': tlf_new,
+            'fio_abonents_agg': fio_abonents_agg,
+            'group_abonents_agg': group_abonents_agg,
+            'connect_dates': connect_dates
         })
-    
-    formatted_result.append({
-        'tlf_new': tlf_new,
-        'fio_abonents_agg': fio_abonents_agg,
-        'group_abonents_agg': group_abonents_agg,
-        'connect_dates': connect_dates
+    return formatted_result
+
+
+def print_result(formatted_result: List[Dict[str, Any]]):
+    # Преобразуем в DataFrame для удобного отображения
+    result_df = pd.DataFrame(formatted_result)
+
+    # Выводим результат
+    for entry in result_df.itertuples(index=False):
+        print(f"Телефон: {entry.tlf_new}")
+        print(f"ФИО абонентов: {entry.fio_abonents_agg}")
+        print(f"Группы абонентов: {entry.group_abonents_agg}")
+        for connect in entry.connect_dates:
+            print(f"Связь: {connect['pair']}, Дата первого соединения: {connect['date_first_connect']}, Дата последнего соединения: {connect['date_last_connect']}")
+        print()
+
+
+class AggregateStore:
+    """Накопленные агрегаты в SQLite с дозагрузкой новых данных.
+
+    Счетчики и даты первого/последнего соединения сливаются точно, поэтому
+    update(new_rows) добавляет к сохраненному состоянию только новые строки
+    (например, выгрузку за день), не пересчитывая всю историю. Агрегаты
+    хранятся по дням звонков: result() за все время возвращает ту же
+    структуру, что aggregate по всем данным сразу, а result(date_from, date_to) -
+    то же, что aggregate_file за период [date_from, date_to).
+    """
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        # timeout - сколько ждать, пока другой процесс дозагружает данные (sync_file)
+        self._db = sqlite3.connect(path, timeout=timeout)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS fio (
+                day TEXT, tlf_new TEXT, fio TEXT, fio_null INTEGER, count INTEGER, pos INTEGER,
+                PRIMARY KEY (day, tlf_new, fio, fio_null));
+            CREATE TABLE IF NOT EXISTS grp (
+                day TEXT, tlf_new TEXT, grp TEXT, count INTEGER, pos INTEGER, PRIMARY KEY (day, tlf_new, grp));
+            CREATE TABLE IF NOT EXISTS dates (
+                day TEXT, tlf_new TEXT, pair_first TEXT, pair_second TEXT, first INTEGER, last INTEGER, pos INTEGER,
+                PRIMARY KEY (day, tlf_new, pair_first, pair_second));
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        """)
+
+    def _meta(self, key: str, default: Any = None) -> Any:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key: str, value: Any):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    @property
+    def rows_seen(self) -> int:
+        return self._meta('rows_seen', 0)
+
+    def update(self, new_rows: pd.DataFrame):
+        """Добавление новых строк журнала звонков (даты - строки или datetime)"""
+        with self._db:
+            self._fold(new_rows)
+
+    def _fold(self, new_rows: pd.DataFrame):
+        # Без commit: вызывается внутри транзакции update или sync_file
+        offset = self.rows_seen
+        partial = process_chunk(new_rows, offset, by_day=True)
+        # NULL в первичном ключе не сливается: пропуск ФИО храним пустой строкой с fio_null = 1,
+        # чтобы отличать его от настоящей пустой строки
+        fio = partial['fio'].reset_index()
+        fio['fio_null'] = fio['fio'].isnull().astype(int)
+        fio['fio'] = fio['fio'].fillna('')
+        group = partial['group'].reset_index()
+        dates = partial['dates'].reset_index()
+        # Даты храним целыми наносекундами: min/max считает сама SQLite
+        dates['first'] = dates['first'].astype('datetime64[ns]').astype('int64')
+        dates['last'] = dates['last'].astype('datetime64[ns]').astype('int64')
+
+        self._db.executemany(
+            "INSERT INTO fio VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (day, tlf_new, fio, fio_null) "
+            "DO UPDATE SET count = count + excluded.count",
+            fio[['day', 'tlf_new', 'fio', 'fio_null', 'count', 'pos']].itertuples(index=False, name=None)
+        )
+        self._db.executemany(
+            "INSERT INTO grp VALUES (?, ?, ?, ?, ?) ON CONFLICT (day, tlf_new, grp) "
+            "DO UPDATE SET count = count + excluded.count",
+            group[['day', 'tlf_new', 'group', 'count', 'pos']].itertuples(index=False, name=None)
+        )
+        self._db.executemany(
+            "INSERT INTO dates VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (day, tlf_new, pair_first, pair_second) "
+            "DO UPDATE SET first = min(first, excluded.first), last = max(last, excluded.last)",
+            dates[['day', 'tlf_new', 'pair_first', 'pair_second', 'first', 'last', 'pos']].itertuples(
+                index=False, name=None)
+        )
+        self._set_meta('rows_seen', offset + len(new_rows))
+
+    def update_file(self, path: str, chunksize: int = 1_000_000):
+        for chunk in read_chunks(path, chunksize):
+            self.update(chunk)
+
+    def sync_file(self, path: str, chunksize: int = 1_000_000) -> int:
+        """Дозагрузка строк, дописанных в выгрузку path с прошлого вызова; возвращает их число.
+
+        CSV-выгрузка считается пополняемой только дописыванием в конец: хранится
+        смещение конца последней загруженной строки, и разбирается только то,
+        что дописано после него (недописанная последняя строка - при следующем
+        вызове). Если файл другой или стал короче (заменен), а также при любом
+        изменении Parquet-файла агрегаты строятся заново. Одновременные вызовы
+        из нескольких процессов выполняются по очереди.
+        """
+        size = os.path.getsize(path)
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            loaded = self._meta('source_size', 0)
+            parquet = path.endswith('.parquet')
+            if self._meta('source') != path or size < loaded or (parquet and size != loaded):
+                for table in ('fio', 'grp', 'dates', 'meta'):
+                    self._db.execute(f'DELETE FROM {table}')
+                loaded = 0
+            end = size if parquet else last_row_end(path, size)
+            if end <= loaded:
+                self._db.rollback()
+                return 0
+
+            added = 0
+            for chunk in read_chunks(path, chunksize, start=loaded, end=end):
+                self._fold(chunk)
+                added += len(chunk)
+            self._set_meta('source', path)
+            self._set_meta('source_size', end)
+            self._db.commit()
+        except BaseException:
+            self._db.rollback()
+            raise
+        return added
+
+    def result(self, date_from: Optional[str] = None, date_to: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """Агрегаты за дни [date_from, date_to) ('2024-01-01'; None - без границы)"""
+        conditions, params = [], []
+        if date_from is not None:
+            conditions.append('day >= ?')
+            params.append(pd.Timestamp(date_from).strftime('%Y-%m-%d'))
+        if date_to is not None:
+            conditions.append('day < ?')
+            params.append(pd.Timestamp(date_to).strftime('%Y-%m-%d'))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        fio = self._db.execute(
+            f"SELECT tlf_new, CASE WHEN fio_null THEN NULL ELSE fio END, SUM(count), MIN(pos) AS first_pos "
+            f"FROM fio {where} GROUP BY tlf_new, fio, fio_null ORDER BY first_pos", params)
+        group = self._db.execute(
+            f"SELECT tlf_new, grp, SUM(count), MIN(pos) AS first_pos "
+            f"FROM grp {where} GROUP BY tlf_new, grp ORDER BY first_pos", params)
+        dates = self._db.execute(
+            f"SELECT tlf_new, pair_first, pair_second, MIN(first), MAX(last), MIN(pos) AS first_pos "
+            f"FROM dates {where} GROUP BY tlf_new, pair_first, pair_second ORDER BY first_pos", params)
+        return build_result(
+            (((tlf_new, name), count) for tlf_new, name, count, _ in fio),
+            (((tlf_new, name), count) for tlf_new, name, count, _ in group),
+            (((tlf_new, caller, receiver), pd.Timestamp(first), pd.Timestamp(last))
+             for tlf_new, caller, receiver, first, last, _ in dates)
+        )
+
+    def close(self):
+        self._db.close()
+
+
+def generate_calls(rows: int, numbers: int = 500, seed: int = 0) -> pd.DataFrame:
+    """Синтетический журнал звонков для проверки и замеров"""
+    rng = np.random.default_rng(seed)
+    phones = np.array([f"7{n:09d}" for n in range(numbers)], dtype=object)
+    fios = np.array([f"Абонент {n}" for n in range(numbers)], dtype=object)
+    groups = np.array([None, 'Group A', 'Group B', 'Group C'], dtype=object)
+    call_idx = rng.integers(0, numbers, rows)
+    to_idx = rng.integers(0, numbers, rows)
+    df = pd.DataFrame({
+        'date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 30 * 86400, rows), unit='s'),
+        'tlf_call': phones[call_idx],
+        'tlf_to': phones[to_idx],
+        'fio_call': fios[call_idx],
+        'fio_to': fios[to_idx],
+        'group_call': groups[rng.integers(0, len(groups), rows)],
+        'group_to': groups[rng.integers(0, len(groups), rows)]
     })
+    return df
+
+
+def benchmark(rows: int, seed: int = 0):
+    """Сравнение aggregate с эталонным циклом: результат должен совпасть, печатается ускорение"""
+    unknown_group_calls = filter_unknown(generate_calls(rows, seed=seed))
+
+    started = time.perf_counter()
+    expected = format_result(aggregate_loop(nulls_as_none(unknown_group_calls)))
+    loop_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    actual = format_result(aggregate(unknown_group_calls))
+    vector_seconds = time.perf_counter() - started
+
+    if actual != expected:
+        raise AssertionError("aggregate расходится с эталонным циклом aggregate_loop")
+    print(f"Строк: {rows}, с неизвестной группой: {len(unknown_group_calls)}")
+    print(f"Цикл: {loop_seconds:.2f} с, векторно: {vector_seconds:.3f} с, "
+          f"ускорение: {loop_seconds / vector_seconds:.0f}x")
+
+    # Потоковый режим по файлу должен дать тот же результат при любом размере куска
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'calls.csv')
+        generate_calls(rows, seed=seed).to_csv(path, index=False)
+        for workers in (0, 2):
+            started = time.perf_counter()
+            chunked = format_result(aggregate_file(path, chunksize=max(1, rows // 7), workers=workers))
+            if chunked != expected:
+                raise AssertionError(f"aggregate_file (workers={workers}) расходится с эталонным циклом")
+            print(f"По файлу кусками (workers={workers}): {time.perf_counter() - started:.3f} с")
+
+        # Накопление по дням: несколько update должны дать тот же результат, что расчет сразу
+        calls = pd.read_csv(path, dtype=str)
+        store = AggregateStore(os.path.join(tmp, 'stats.sqlite3'))
+        started = time.perf_counter()
+        for day_rows in np.array_split(np.arange(len(calls)), 5):
+            store.update(calls.iloc[day_rows])
+        incremental = format_result(store.result())
+        store.close()
+        if incremental != expected:
+            raise AssertionError("AggregateStore расходится с эталонным циклом")
+        print(f"Накопление в AggregateStore (5 частей): {time.perf_counter() - started:.3f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Агрегация звонков абонентов с неизвестной группой')
+    parser.add_argument('--benchmark', type=int, metavar='ROWS',
+                        help='сверить векторный расчет с циклом на синтетических данных и замерить время')
+    parser.add_argument('--input', help='журнал звонков (CSV или Parquet), читается кусками')
+    parser.add_argument('--chunksize', type=int, default=1_000_000, help='строк в одном куске')
+    parser.add_argument('--workers', type=int, default=0, help='процессов для обработки кусков')
+    parser.add_argument('--store', help='SQLite с накопленными агрегатами: --input дозагружается в него')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return
+
+    if args.store:
+        store = AggregateStore(args.store)
+        if args.input:
+            store.update_file(args.input, args.chunksize)
+        print_result(format_result(store.result()))
+        store.close()
+        return
+
+    if args.input:
+        print_result(format_result(aggregate_file(args.input, args.chunksize, args.workers)))
+        return
 
-# Преобразуем в DataFrame для удобного отображения
-result_df = pd.DataFrame(formatted_result)
+    unknown_group_calls = filter_unknown(load_sample())
+    print_result(format_result(aggregate(unknown_group_calls)))
 
-# Выводим результат
-for entry in result_df.itertuples(index=False):
-    print(f"Телефон: {entry.tlf_new}")
-    print(f"ФИО абонентов: {entry.fio_abonents_agg}")
-    print(f"Группы абонентов: {entry.group_abonents_agg}")
-    for connect in entry.connect_dates:
-        print(f"Связь: {connect['pair']}, Дата первого соединения: {connect['date_first_connect']}, Дата последнего соединения: {connect['date_last_connect']}")
-    print()
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,663 @@
+"""Нагрузочный тест бота: фейковый сервер Rocket.Chat и имитация пользователей.
+
+    python loadtest.py --users 100 --duration 30
+    python loadtest.py --users 50 --latency-ms 40 --post-rate 20 --scenario mixed
+    python loadtest.py --http --users 20                  # через ThreadPoolTransport и HTTP
+    python loadtest.py --bot-config '{"send_rate": 50}'   # переопределить настройки бота
+    python loadtest.py --replicas 3 --stop-replica-after 10  # реплики с общей базой, одна уходит
+    python loadtest.py --scenario db_check --users 20     # задачи: CSV-вложение, отчет с выгрузкой файла
+
+Бот (RocketChatBot.run) работает в том же процессе, что и сервер. Каждый
+пользователь - своя личная комната: он пишет сообщение сценария, ждет ответ
+(не дольше --reply-timeout), делает паузу и пишет следующее. В отчете -
+ответы в секунду, задержка ответа (от появления сообщения на сервере до
+chat.postMessage бота), потерянные, лишние и запоздавшие ответы, 429 сервера
+и рост памяти процесса (в него входит и история комнат фейкового
+сервера; --tracemalloc покажет, где именно растет). С --json результат пишется в файл для сравнения
+с предыдущими прогонами.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import metrics
+from jobs import percentile
+from rocket_bot import RocketChatBot, format_ts
+from transport import AsyncTransport
+
+
+BOT_ID = 'loadtest-bot'
+BOT_NAME = 'bot'
+
+
+class FakeResponse:
+    """Ответ в виде requests.Response: .status_code, .headers, .json()"""
+
+    def __init__(self, status_code: int, headers: Dict[str, str], body: Dict[str, Any]):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Dict[str, Any]:
+        return self.body
+
+
+class FakeRocketChat:
+    """Состояние фейкового сервера: личные комнаты бота с историей сообщений.
+
+    Реализованы login, me, im.list, im.history, chat.postMessage, rooms.upload
+    и скачивание вложений (/file-upload/<id>/<имя>). Задержка
+    ответа - latency + случайная добавка до jitter секунд (выдерживает
+    вызывающий: транспорт или HTTP-обработчик). post_rate ограничивает
+    chat.postMessage в секунду с заголовками X-RateLimit-* как у Rocket.Chat,
+    error_rate - доля случайных 429 без заголовков. Методы потокобезопасны:
+    HTTP-сервер вызывает их из своих потоков.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        post_rate: Optional[float] = None,
+        error_rate: float = 0.0,
+        seed: int = 0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.post_rate = post_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.rooms: Dict[str, List[Dict[str, Any]]] = {}
+        self.last_ts: Dict[str, datetime] = {}
+        # Содержимое вложений по id файла
+        self.files: Dict[str, bytes] = {}
+        self.tokens = post_rate or 0.0
+        self.tokens_updated = time.monotonic()
+        self.requests: Counter = Counter()
+        self.rate_limited = 0
+        self.injected_errors = 0
+        # on_reply(room_id, text) - вызывается при каждом сообщении бота
+        self.on_reply: Optional[Callable[[str, str], None]] = None
+
+    def delay(self) -> float:
+        with self.lock:
+            return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def _next_ts(self, room_id: str) -> str:
+        # Строго возрастающее время в комнате: бот сравнивает отметки с точностью до миллисекунды
+        now = datetime.now(timezone.utc)
+        last = self.last_ts.get(room_id)
+        if last is not None and now <= last:
+            now = last + timedelta(milliseconds=1)
+        self.last_ts[room_id] = now
+        return format_ts(now)
+
+    def add_room(self, room_id: str):
+        with self.lock:
+            self.rooms.setdefault(room_id, [])
+
+    def _add_message(self, room_id: str, user_id: str, username: str, text: str) -> Dict[str, Any]:
+        message = {
+            '_id': f'{room_id}-{len(self.rooms[room_id])}',
+            'rid': room_id,
+            'msg': text,
+            'ts': self._next_ts(room_id),
+            'u': {'_id': user_id, 'username': username}
+        }
+        self.rooms[room_id].append(message)
+        return message
+
+    def _attach(self, message: Dict[str, Any], name: str, content: bytes):
+        file_id = f'file-{len(self.files)}'
+        self.files[file_id] = content
+        # Как у Rocket.Chat: описание файла и ссылка на скачивание во вложении сообщения
+        message['file'] = {'_id': file_id, 'name': name, 'type': 'text/csv'}
+        message['attachments'] = [{'title': name, 'title_link': f'/file-upload/{file_id}/{name}'}]
+
+    def user_message(self, room_id: str, username: str, text: str,
+                     file: Optional[Tuple[str, bytes]] = None) -> Dict[str, Any]:
+        """Сообщение пользователя; file - (имя, содержимое) вложения"""
+        with self.lock:
+            message = self._add_message(room_id, f'id-{username}', username, text)
+            if file is not None:
+                self._attach(message, *file)
+            return message
+
+    def download(self, path: str) -> Optional[bytes]:
+        """Содержимое вложения по пути /file-upload/<id>/<имя> (None - нет такого файла)"""
+        with self.lock:
+            self.requests['file-upload'] += 1
+            parts = urlsplit(path).path.split('/')
+            return self.files.get(parts[2]) if len(parts) > 2 else None
+
+    def _take_token(self) -> Tuple[bool, Dict[str, str]]:
+        if not self.post_rate:
+            return True, {}
+        now = time.monotonic()
+        self.tokens = min(self.post_rate, self.tokens + (now - self.tokens_updated) * self.post_rate)
+        self.tokens_updated = now
+        allowed = self.tokens >= 1
+        if allowed:
+            self.tokens -= 1
+        reset = time.time() + max(0.0, 1 - self.tokens) / self.post_rate
+        return allowed, {
+            'X-RateLimit-Limit': str(int(self.post_rate)),
+            'X-RateLimit-Remaining': str(int(self.tokens)),
+            'X-RateLimit-Reset': str(int(reset * 1000))
+        }
+
+    def handle(self, method: str, params: Dict[str, Any]) -> Tuple[int, Dict[str, str], Dict[str, Any]]:
+        """REST-метод: (HTTP-статус, заголовки, тело)"""
+        reply = None
+        with self.lock:
+            self.requests[method] += 1
+            if method == 'login':
+                return 200, {}, {'status': 'success', 'data': {'authToken': 'token', 'userId': BOT_ID}}
+            if method == 'me':
+                return 200, {}, {'_id': BOT_ID, 'username': BOT_NAME, 'success': True}
+            if method == 'im.list':
+                ims = []
+                for room_id, messages in self.rooms.items():
+                    room = {'_id': room_id, 't': 'd'}
+                    if messages:
+                        room['lastMessage'] = messages[-1]
+                    ims.append(room)
+                return 200, {}, {'ims': ims, 'success': True}
+            if method == 'im.history':
+                oldest = params.get('oldest', '')
+                count = int(params.get('count', 20))
+                offset = int(params.get('offset', 0))
+                newer = [m for m in reversed(self.rooms.get(params['roomId'], [])) if m['ts'] > oldest]
+                return 200, {}, {'messages': newer[offset:offset + count], 'success': True}
+            if method == 'chat.postMessage':
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.injected_errors += 1
+                    return 429, {}, {'success': False, 'error': 'injected'}
+                allowed, headers = self._take_token()
+                if not allowed:
+                    self.rate_limited += 1
+                    return 429, headers, {'success': False, 'error': 'error-too-many-requests'}
+                room_id = params['roomId']
+                message = self._add_message(room_id, BOT_ID, BOT_NAME, params['text'])
+                reply = (room_id, params['text'])
+                status, headers, body = 200, headers, {'message': message, 'success': True}
+            elif method == 'rooms.upload':
+                room_id = params['roomId']
+                message = self._add_message(room_id, BOT_ID, BOT_NAME, params.get('description', ''))
+                self._attach(message, params['filename'], params['content'])
+                # Файл дополняет ответ бота, а не заменяет его: в ответы (on_reply) не идет
+                return 200, {}, {'message': message, 'success': True}
+            else:
+                return 404, {}, {'success': False, 'error': f'unknown method {method}'}
+        # Вне блокировки: обработчик может обращаться к серверу
+        if self.on_reply is not None:
+            self.on_reply(*reply)
+        return status, headers, body
+
+
+class FakeTransport(AsyncTransport):
+    """Транспорт бота прямо к FakeRocketChat, без сети: задержка - asyncio.sleep"""
+
+    def __init__(self, server: FakeRocketChat):
+        self.server = server
+
+    async def _call(self, method: str, **params) -> FakeResponse:
+        delay = self.server.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return FakeResponse(*self.server.handle(method, params))
+
+    async def connect(self):
+        await self._call('login')
+
+    async def me(self):
+        return await self._call('me')
+
+    async def im_list(self, **kwargs):
+        return await self._call('im.list', **kwargs)
+
+    async def im_history(self, room_id: str, **kwargs):
+        return await self._call('im.history', roomId=room_id, **kwargs)
+
+    async def chat_post_message(self, room_id: str, text: str, **kwargs):
+        return await self._call('chat.postMessage', roomId=room_id, text=text, **kwargs)
+
+    async def download_file(self, path: str, dest: str) -> int:
+        delay = self.server.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        content = self.server.download(path)
+        if content is None:
+            raise FileNotFoundError(path)
+
+        def write():
+            with open(dest, 'wb') as f:
+                f.write(content)
+
+        # Как у ThreadPoolTransport: запись на диск не занимает event loop
+        await asyncio.to_thread(write)
+        return len(content)
+
+    async def upload_file(self, room_id: str, filename: str, content: bytes, description: str = ''):
+        return await self._call('rooms.upload', roomId=room_id, filename=filename,
+                                content=content, description=description)
+
+
+def serve_http(server: FakeRocketChat, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """HTTP-вариант сервера (/api/v1/<метод>) для проверки бота вместе с rocketchat_API и пулом потоков"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status: int, headers: Dict[str, str], payload: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _respond(self, params: Dict[str, Any], method: Optional[str] = None):
+            method = method or urlsplit(self.path).path.rsplit('/', 1)[-1]
+            delay = server.delay()
+            if delay:
+                time.sleep(delay)
+            status, headers, body = server.handle(method, params)
+            self._send(status, headers, json.dumps(body).encode('utf-8'), 'application/json')
+
+        def do_GET(self):
+            if self.path.startswith('/file-upload/'):
+                delay = server.delay()
+                if delay:
+                    time.sleep(delay)
+                content = server.download(self.path)
+                if content is None:
+                    self._send(404, {}, b'', 'text/plain')
+                else:
+                    self._send(200, {}, content, 'text/csv')
+                return
+            query = parse_qs(urlsplit(self.path).query)
+            self._respond({key: values[-1] for key, values in query.items()})
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            content_type = self.headers.get('Content-Type', '')
+            path = urlsplit(self.path).path
+            if '/rooms.upload/' in path:
+                # rocketchat_API: POST rooms.upload/<rid>, файл и описание - multipart/form-data
+                form = BytesParser(policy=policy.HTTP).parsebytes(
+                    f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + raw
+                )
+                params = {'roomId': unquote(path.rsplit('/', 1)[-1])}
+                for part in form.iter_parts():
+                    name = part.get_param('name', header='content-disposition')
+                    if name == 'file':
+                        params['filename'] = part.get_filename()
+                        params['content'] = part.get_payload(decode=True)
+                    else:
+                        params[name] = part.get_content()
+                self._respond(params, 'rooms.upload')
+                return
+            if content_type.startswith('application/json'):
+                params = json.loads(raw or b'{}')
+            else:
+                params = {key: values[-1] for key, values in parse_qs(raw.decode('utf-8')).items()}
+            self._respond(params)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='fake-rocketchat', daemon=True).start()
+    return httpd
+
+
+# Ответы задач (JobManager), после которых задача больше ничего не пришлет
+JOB_FAILED = ('завершилась с ошибкой', 'прервана:')
+DB_CHECK_DONE = ('Строк в файле', 'Не удалось проверить файл') + JOB_FAILED
+REPORT_DONE = ('во вложении', 'за этот период нет') + JOB_FAILED
+STAFF_FILE = 'staff.csv'
+
+
+class Say:
+    """Сообщение пользователя в сценарии.
+
+    file - имя вложения (содержимое - в LoadDriver.files); until - подстроки,
+    одна из которых завершает ожидание ответа: команда с задачей сразу
+    отвечает подтверждением, а результат присылает позже. Без until
+    достаточно первого ответа.
+    """
+
+    def __init__(self, text: str, file: Optional[str] = None, until: Optional[Tuple[str, ...]] = None):
+        self.text = text
+        self.file = file
+        self.until = until
+
+
+def staff_csv(rows: int) -> bytes:
+    """Файл сотрудников для db_check"""
+    lines = ['ФИО;Отдел;Местоположение']
+    lines.extend(f'Сотрудник {n};Отдел {n % 20};Город {n % 7}' for n in range(rows))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def scenario(name: str, rng: random.Random) -> List[Union[str, Say]]:
+    """Сообщения одного прохода сценария; на каждое бот должен ответить одним сообщением
+    (на Say с until - подтверждением и затем результатом задачи)"""
+    if name == 'mixed':
+        name = rng.choice(['ping', 'help', 'new_path', 'schedule'])
+    if name == 'ping':
+        return ['ping']
+    if name == 'help':
+        return ['help']
+    if name == 'new_path':
+        return ['new_path', '01-01-2025 15-01-2025', 'Москва - Казань, поезд']
+    if name == 'schedule':
+        meeting = (datetime.now() + timedelta(days=30)).strftime('%d-%m-%Y %H:%M')
+        return ['schedule', 'ivanov, petrov', meeting, 'Планирование']
+    if name == 'db_check':
+        return ['db_check', '1', f'Сотрудник {rng.randrange(100)}', Say('', file=STAFF_FILE, until=DB_CHECK_DONE)]
+    if name == 'report':
+        # Период внутри журнала звонков generate_calls (январь 2024)
+        first = rng.randint(1, 20)
+        dates = f'{first:02d}-01-2024 {first + rng.randint(0, 10):02d}-01-2024'
+        return ['report', '3', Say(dates, until=REPORT_DONE)]
+    raise ValueError(f"Неизвестный сценарий: {name}")
+
+
+def rss_bytes() -> int:
+    """Текущий RSS процесса (на Linux из /proc, иначе - пиковый из getrusage)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoadDriver:
+    """Пользователи, которые по очереди пишут боту и ждут ответа"""
+
+    def __init__(
+        self,
+        server: FakeRocketChat,
+        users: int,
+        scenario_name: str = 'mixed',
+        think_time: float = 0.5,
+        reply_timeout: float = 10.0,
+        seed: int = 0
+    ):
+        self.server = server
+        self.users = users
+        self.scenario_name = scenario_name
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self.seed = seed
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Вложения сценариев: имя -> содержимое
+        self.files: Dict[str, bytes] = {}
+        # Комната -> (время сообщения, ожидание ответа, until)
+        self.waiting: Dict[str, Tuple[float, asyncio.Future, Optional[Tuple[str, ...]]]] = {}
+        self.timed_out: Counter = Counter()
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.dropped = 0
+        self.late = 0
+        self.duplicates = 0
+        server.on_reply = self.on_reply
+
+    def on_reply(self, room_id: str, text: str):
+        # HTTP-сервер вызывает из своего потока
+        self.loop.call_soon_threadsafe(self._reply, room_id, text, time.monotonic())
+
+    def _reply(self, room_id: str, text: str, received: float):
+        entry = self.waiting.get(room_id)
+        if entry is not None and not entry[1].done():
+            sent, future, until = entry
+            # Подтверждение задачи и ход ее выполнения - ждем результат
+            if until is None or any(mark in text for mark in until):
+                del self.waiting[room_id]
+                future.set_result(received - sent)
+        elif self.timed_out[room_id] > 0:
+            # Ответ на сообщение, которое уже засчитано потерянным
+            self.timed_out[room_id] -= 1
+            self.late += 1
+        else:
+            self.duplicates += 1
+
+    async def user(self, index: int, deadline: float):
+        rng = random.Random(self.seed * 100_003 + index)
+        room_id = f'room-{index}'
+        username = f'user{index}'
+        while time.monotonic() < deadline:
+            for step in scenario(self.scenario_name, rng):
+                if isinstance(step, str):
+                    step = Say(step)
+                future = self.loop.create_future()
+                self.waiting[room_id] = (time.monotonic(), future, step.until)
+                file = (step.file, self.files[step.file]) if step.file else None
+                self.server.user_message(room_id, username, step.text, file)
+                self.sent += 1
+                try:
+                    self.latencies.append(await asyncio.wait_for(future, self.reply_timeout))
+                except asyncio.TimeoutError:
+                    self.waiting.pop(room_id, None)
+                    self.timed_out[room_id] += 1
+                    self.dropped += 1
+                    # Состояние диалога неизвестно - начинаем следующий проход сценария
+                    break
+                if self.think_time:
+                    await asyncio.sleep(rng.expovariate(1 / self.think_time))
+
+    async def run(self, duration: float):
+        self.loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(self.user(index, deadline) for index in range(self.users)))
+
+
+async def run_load(args) -> Dict[str, Any]:
+    server = FakeRocketChat(
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+        post_rate=args.post_rate, error_rate=args.error_rate, seed=args.seed
+    )
+    driver = LoadDriver(server, args.users, args.scenario, args.think_time, args.reply_timeout, args.seed)
+    driver.files[STAFF_FILE] = staff_csv(args.file_rows)
+    for index in range(args.users):
+        server.add_room(f'room-{index}')
+
+    config = {
+        'server_url': 'http://fake', 'username': BOT_NAME, 'password': 'x',
+        'poll_interval': args.poll_interval, 'stats_interval': 3600
+    }
+    cluster_dir = None
+    if args.replicas > 1:
+        # Реплики в одном процессе с общей базой во временном каталоге; аренды короче обычных
+        cluster_dir = tempfile.mkdtemp(prefix='loadtest-cluster-')
+        config.update({'cluster_db': os.path.join(cluster_dir, 'cluster.sqlite3'), 'lease_interval': 0.5, 'lease_ttl': 3})
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    if args.scenario == 'report':
+        # pandas нужен только отчету
+        from know_stats import generate_calls
+
+        calls_path = os.path.join(work_dir, 'calls.csv')
+        generate_calls(args.calls_rows, seed=args.seed).to_csv(calls_path, index=False)
+        # Отчет всегда уходит первой страницей и вложением (rooms.upload), а не набором страниц:
+        # LoadDriver видит готовый результат по одному сообщению
+        config.update({
+            'calls_path': calls_path,
+            'report_store': os.path.join(work_dir, 'know_stats.sqlite3'),
+            'report_max_pages': 0
+        })
+    config['download_dir'] = work_dir
+    config.update(json.loads(args.bot_config))
+    httpd = None
+    transport = None
+    if args.http:
+        httpd = serve_http(server)
+        config['server_url'] = f'http://127.0.0.1:{httpd.server_address[1]}'
+    else:
+        transport = FakeTransport(server)
+
+    bots = [RocketChatBot({**config, 'replica_id': f'replica-{index}'}, transport) for index in range(args.replicas)]
+    bot_tasks = [asyncio.create_task(bot.run()) for bot in bots]
+    while any(bot.user_id is None for bot in bots):
+        if any(task.done() for task in bot_tasks):
+            raise RuntimeError("Бот не подключился к фейковому серверу")
+        await asyncio.sleep(0.01)
+    if cluster_dir is not None:
+        # Нагрузку даем, когда все разделы розданы
+        partitions = bots[0].cluster.partitions
+        while sum(len(bot.cluster.owned) for bot in bots) < partitions:
+            await asyncio.sleep(0.05)
+
+    async def stop_replica():
+        await asyncio.sleep(args.stop_replica_after)
+        bots[-1].running = False
+
+    stopper = asyncio.create_task(stop_replica()) if args.stop_replica_after else None
+
+    if args.tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    rss_start = rss_bytes()
+    started = time.monotonic()
+    await driver.run(args.duration)
+    elapsed = time.monotonic() - started
+    rss_end = rss_bytes()
+    growth = []
+    if args.tracemalloc:
+        after = tracemalloc.take_snapshot()
+        growth = [str(stat) for stat in after.compare_to(before, 'lineno')[:10]]
+        tracemalloc.stop()
+
+    bot_state = []
+    for bot, task in zip(bots, bot_tasks):
+        state = {'outbox': {key: value for key, value in bot.outbox.stats().items() if key != 'queues'}}
+        if not task.done():
+            # Хранилища остановленной реплики уже закрыты
+            state.update({
+                'dedup_entries': len(bot.processed_messages),
+                'contexts': len(bot.user_contexts),
+                'room_marks': len(bot.room_marks)
+            })
+        if bot.cluster is not None:
+            state['cluster'] = bot.cluster.stats()
+        bot_state.append(state)
+    if stopper is not None:
+        stopper.cancel()
+    for bot in bots:
+        bot.running = False
+    await asyncio.gather(*bot_tasks)
+    if httpd is not None:
+        httpd.shutdown()
+    if cluster_dir is not None:
+        shutil.rmtree(cluster_dir, ignore_errors=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies = driver.latencies
+    return {
+        'users': args.users,
+        'replicas': args.replicas,
+        'scenario': args.scenario,
+        'transport': 'http' if args.http else 'inprocess',
+        'seconds': elapsed,
+        'sent': driver.sent,
+        'replies': len(latencies),
+        'replies_per_second': len(latencies) / elapsed,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': max(latencies, default=0.0) * 1000
+        },
+        'dropped': driver.dropped,
+        'late': driver.late,
+        'duplicates': driver.duplicates,
+        'server': {
+            'requests': dict(server.requests),
+            'rate_limited': server.rate_limited,
+            'injected_errors': server.injected_errors
+        },
+        'rss_mb': {'start': rss_start / 2 ** 20, 'end': rss_end / 2 ** 20, 'growth': (rss_end - rss_start) / 2 ** 20},
+        'tracemalloc_top': growth,
+        'bot': bot_state,
+        'metrics': {
+            name: metrics.REGISTRY.metrics[name].snapshot()
+            for name in ('bot_reply_seconds', 'bot_poll_seconds', 'bot_handle_seconds')
+        }
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    latency = result['latency_ms']
+    print(f"\n{result['users']} пользователей, реплик {result['replicas']}, сценарий {result['scenario']}, транспорт {result['transport']}, "
+          f"{result['seconds']:.1f} с")
+    print(f"  сообщений: {result['sent']}, ответов: {result['replies']} ({result['replies_per_second']:.1f}/с)")
+    print(f"  задержка ответа: p50 {latency['p50']:.0f} мс, p95 {latency['p95']:.0f} мс, "
+          f"p99 {latency['p99']:.0f} мс, макс {latency['max']:.0f} мс")
+    print(f"  потеряно: {result['dropped']}, запоздало: {result['late']}, лишних: {result['duplicates']}")
+    server = result['server']
+    print(f"  сервер: {server['requests']}, 429 по лимиту: {server['rate_limited']}, "
+          f"внесенных ошибок: {server['injected_errors']}")
+    rss = result['rss_mb']
+    print(f"  память (RSS): {rss['start']:.1f} -> {rss['end']:.1f} МБ ({rss['growth']:+.1f})")
+    for state in result['bot']:
+        print(f"  бот: {state}")
+    for line in result['tracemalloc_top']:
+        print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на фейковом сервере Rocket.Chat')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30, help='секунд нагрузки')
+    parser.add_argument('--scenario', choices=['ping', 'help', 'new_path', 'schedule', 'mixed', 'db_check', 'report'],
+                        default='mixed')
+    parser.add_argument('--think-time', type=float, default=0.5, help='средняя пауза пользователя между сообщениями, с')
+    parser.add_argument('--reply-timeout', type=float, default=10, help='сколько ждать ответ, с')
+    parser.add_argument('--latency-ms', type=float, default=0, help='задержка каждого ответа сервера')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='случайная добавка к задержке')
+    parser.add_argument('--post-rate', type=float, help='лимит chat.postMessage в секунду (429 с X-RateLimit-*)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля случайных 429 на chat.postMessage')
+    parser.add_argument('--poll-interval', type=float, default=3, help='poll_interval бота, с')
+    parser.add_argument('--file-rows', type=int, default=10_000, help='строк в CSV-вложении сценария db_check')
+    parser.add_argument('--calls-rows', type=int, default=100_000, help='строк в журнале звонков сценария report')
+    parser.add_argument('--bot-config', default='{}', help='JSON с настройками бота поверх стандартных')
+    parser.add_argument('--replicas', type=int, default=1, help='реплик бота с общей базой (cluster_db)')
+    parser.add_argument('--stop-replica-after', type=float,
+                        help='остановить последнюю реплику через столько секунд (передача ее комнат)')
+    parser.add_argument('--http', action='store_true', help='HTTP-сервер и ThreadPoolTransport вместо прямых вызовов')
+    parser.add_argument('--tracemalloc', action='store_true', help='показать места наибольшего роста памяти')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING', help='уровень логов бота во время теста')
+    parser.add_argument('--json', help='записать результат в файл')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    result = asyncio.run(run_load(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
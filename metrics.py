@@ -0,0 +1,320 @@
+"""Метрики бота: счетчики, гистограммы задержек и значения, вычисляемые при запросе.
+
+Метрики объявляются на уровне модулей (metrics.counter(...), metrics.histogram(...))
+и попадают в общий REGISTRY. Выдача - текстовый формат Prometheus (GET /metrics
+у MetricsServer) или JSON (GET /metrics.json, Registry.dump_json для записи в файл).
+Значения меняются только из event loop, поэтому блокировок нет.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+    def snapshot(self) -> Any:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in self.values.items()]
+
+    def snapshot(self) -> Any:
+        if not self.labels:
+            return self.values.get((), 0)
+        return {','.join(key): value for key, value in self.values.items()}
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # По набору меток: счетчики корзин (последняя - +Inf), сумма, количество
+        self.series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замер времени блока (в том числе с await внутри)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, key: Tuple[str, ...], q: float) -> float:
+        """Оценка квантиля по корзинам (линейно внутри корзины)"""
+        counts, _, total = self.series[key]
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket
+                le = 'le="+Inf"' if bound == math.inf else f'le="{bound!r}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+    def snapshot(self) -> Any:
+        result = {}
+        for key, (_, total, count) in self.series.items():
+            result[','.join(key) or 'all'] = {
+                'count': count,
+                'avg': total / count if count else 0.0,
+                'p50': self.quantile(key, 0.5),
+                'p95': self.quantile(key, 0.95),
+                'p99': self.quantile(key, 0.99)
+            }
+        return result
+
+
+class Gauge(Metric):
+    """Значение, которое вычисляется при каждом запросе метрик (длина очереди, число диалогов).
+
+    kind='counter' - для накопительных счетчиков, которые уже ведет сам объект (outbox.sent).
+    """
+
+    def __init__(self, name: str, help: str, func: Callable[[], float], kind: str = 'gauge'):
+        super().__init__(name, help)
+        self.func = func
+        self.kind = kind
+
+    def value(self) -> float:
+        try:
+            return self.func()
+        except Exception as e:
+            logger.debug("Метрика %s недоступна: %s", self.name, e)
+            return math.nan
+
+    def render(self) -> List[str]:
+        return [f'{self.name} {self.value()}']
+
+    def snapshot(self) -> Any:
+        return self.value()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Повторная регистрация по имени заменяет метрику (например, gauge нового экземпляра бота)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def dump_json(self, path: str):
+        # Запись через временный файл: читатель не увидит наполовину записанный JSON
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'time': time.time(), 'metrics': self.snapshot()}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def histogram(name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+def gauge(name: str, help: str, func: Callable[[], float], kind: str = 'gauge') -> Gauge:
+    return REGISTRY.register(Gauge(name, help, func, kind))
+
+
+class MetricsServer:
+    """HTTP-эндпоинт метрик на event loop бота: GET /metrics (Prometheus) и /metrics.json"""
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = '127.0.0.1', port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            # Заголовки запроса не нужны, дочитываем до пустой строки
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            path = request[1] if len(request) > 1 else ''
+            if path == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.registry.render()
+            elif path == '/metrics.json':
+                status, content_type = '200 OK', 'application/json'
+                body = json.dumps(self.registry.snapshot(), ensure_ascii=False)
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+            payload = body.encode('utf-8')
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n'
+                         f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload)
+            await writer.drain()
+        except Exception as e:
+            logger.debug("Ошибка запроса метрик: %s", e)
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик потока event loop.
+
+    Отдельный поток раз в interval секунд снимает стек целевого потока
+    (sys._current_frames) и считает одинаковые стеки. Накладные расходы не
+    зависят от числа вызовов функций, поэтому его можно включать на работающем
+    боте. Результат - самые частые функции и стеки в формате collapsed
+    (flamegraph.pl, speedscope).
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks: Tally = Tally()
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def top(self, limit: int = 15) -> List[Tuple[str, int, int]]:
+        """(функция, выборок на вершине стека, выборок в стеке) - по убыванию собственного времени"""
+        own: Tally = Tally()
+        total: Tally = Tally()
+        for stack, count in self.stacks.items():
+            # Без номера строки: одна функция - одна запись
+            frames = [frame.rsplit(':', 1)[0] + ')' for frame in stack.split(';')]
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [(frame, count, total[frame]) for frame, count in own.most_common(limit)]
+
+    def dump_collapsed(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def report(self, limit: int = 15) -> str:
+        seconds = time.monotonic() - (self.started_at or time.monotonic())
+        lines = [f"Профиль: {self.samples} выборок за {seconds:.1f} с"]
+        for frame, own, total in self.top(limit):
+            lines.append(f"{own / max(1, self.samples):6.1%} {total / max(1, self.samples):6.1%}  {frame}")
+        return '\n'.join(lines)
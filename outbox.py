@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import metrics
+
+from dispatcher import ShardedDispatcher
+
+
+logger = logging.getLogger(__name__)
+
+REPLY_SECONDS = metrics.histogram('bot_reply_seconds', 'От получения сообщения до отправки ответа на него')
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов с учетом заголовков X-RateLimit-* сервера"""
+
+    # Остаток лимита сервера, ниже которого запросы без своего лимита растягиваются до Reset
+    LOW_REMAINING = 5
+
+    def __init__(self, rate: Optional[float], capacity: float, jitter: float = 0.5):
+        """rate=None - лимит берется из X-RateLimit-Limit первого же ответа сервера;
+        jitter - наибольшая случайная добавка к ожиданию до Reset, с"""
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.jitter = jitter
+        self.auto = rate is None
+        # Окно лимита сервера в заголовках не передается: оценка - наибольшее время до Reset
+        self.window = 1.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                # Ждущие Reset просыпаются не одновременно, а вразброс, и не упираются в лимит снова
+                await asyncio.sleep(self.blocked_until - now + random.uniform(0, self.jitter))
+                continue
+            if self.rate is None:
+                return
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block_for(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def _seed(self, limit: int, until_reset: Optional[float]):
+        """Частота из X-RateLimit-Limit: limit запросов за окно сервера"""
+        if until_reset:
+            self.window = max(self.window, until_reset)
+        rate = limit / self.window
+        if rate != self.rate:
+            self._refill()
+            self.rate = rate
+            self.capacity = float(limit)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def update_from_headers(self, headers) -> bool:
+        """Подстройка под лимит сервера. True, если сервер велел ждать до Reset"""
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return False
+        remaining = int(remaining)
+        reset = headers.get('X-RateLimit-Reset')
+        # Rocket.Chat передает Reset как unix-время в миллисекундах
+        until_reset = max(0.0, float(reset) / 1000 - time.time()) if reset is not None else None
+        limit = headers.get('X-RateLimit-Limit')
+        if self.auto and limit is not None and int(limit) > 0:
+            self._seed(int(limit), until_reset)
+        if remaining <= 0 and until_reset is not None:
+            self.block_for(until_reset)
+            return True
+        if self.rate is None:
+            # Лимит неизвестен, а остаток почти исчерпан: распределяем его равномерно до сброса окна
+            if until_reset is not None and remaining < self.LOW_REMAINING:
+                self.block_for(until_reset / (remaining + 1))
+            return False
+        self._refill()
+        self.tokens = min(self.tokens, float(remaining))
+        return False
+
+
+class Outbox:
+    """Очередь исходящих ответов.
+
+    Ответы в одну комнату, пришедшие в течение coalesce_window секунд,
+    склеиваются в одно сообщение (не длиннее max_length). Отправка идет через
+    TokenBucket: по умолчанию (rate=None) частота берется из X-RateLimit-Limit
+    ответов сервера, так что 429 - исключение, а не обычный путь. На 429
+    ответ не теряется, а отправляется повторно после X-RateLimit-Reset
+    (с jitter) или после паузы с jitter, на сетевые ошибки и 5xx - до
+    max_retries повторов. Порядок сообщений в комнате сохраняется:
+    комнаты распределяются по отправителям так же, как входящие по воркерам.
+    """
+
+    def __init__(
+        self,
+        post: Callable[[str, str], Awaitable[Any]],
+        coalesce_window: float = 0.2,
+        rate: Optional[float] = None,
+        burst: float = 10.0,
+        senders: int = 4,
+        max_retries: int = 5,
+        max_length: int = 5000
+    ):
+        self.post = post
+        self.coalesce_window = coalesce_window
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.max_length = max_length
+        self.dispatcher = ShardedDispatcher(self._deliver, workers=senders)
+        self._pending: Dict[str, List[str]] = {}
+        # Время получения самого раннего сообщения, на которое отвечает накопленный буфер
+        self._received_at: Dict[str, float] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.dropped = 0
+
+    def start(self):
+        self.dispatcher.start()
+
+    async def close(self):
+        """Немедленная отправка накопленных ответов и остановка"""
+        for room_id in list(self._pending):
+            timer = self._timers.pop(room_id, None)
+            if timer is not None:
+                timer.cancel()
+            await self.dispatcher.submit(self._take(room_id))
+        await asyncio.gather(*self._timers.values(), return_exceptions=True)
+        await self.dispatcher.join()
+        await self.dispatcher.stop()
+
+    async def send(self, room_id: str, text: str, received_at: Optional[float] = None):
+        """received_at - time.monotonic() получения входящего сообщения, для метрики задержки ответа"""
+        if received_at is not None:
+            self._received_at[room_id] = min(received_at, self._received_at.get(room_id, received_at))
+        buffer = self._pending.get(room_id)
+        if buffer is not None:
+            buffer.append(text)
+            self.coalesced += 1
+            return
+        self._pending[room_id] = [text]
+        self._timers[room_id] = asyncio.create_task(self._flush_later(room_id))
+
+    def _take(self, room_id: str) -> Dict[str, Any]:
+        return {
+            'rid': room_id,
+            'texts': self._pending.pop(room_id),
+            'received_at': self._received_at.pop(room_id, None)
+        }
+
+    async def _flush_later(self, room_id: str):
+        try:
+            await asyncio.sleep(self.coalesce_window)
+            await self.dispatcher.submit(self._take(room_id))
+        finally:
+            # Пока шла отправка в очередь, в комнату мог прийти ответ с новым таймером
+            if self._timers.get(room_id) is asyncio.current_task():
+                del self._timers[room_id]
+
+    def _coalesce(self, texts: List[str]) -> List[str]:
+        messages = []
+        for text in texts:
+            if messages and len(messages[-1]) + 2 + len(text) <= self.max_length:
+                messages[-1] += '\n\n' + text
+            else:
+                messages.append(text)
+        return messages
+
+    def _backoff(self, attempt: int) -> float:
+        return min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    async def _deliver(self, item: Dict[str, Any]):
+        delivered = True
+        for text in self._coalesce(item['texts']):
+            delivered = await self._post_with_retry(item['rid'], text) and delivered
+        if delivered and item.get('received_at') is not None:
+            REPLY_SECONDS.observe(time.monotonic() - item['received_at'])
+
+    async def _post_with_retry(self, room_id: str, text: str) -> bool:
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                response = await self.post(room_id, text)
+                status = response.status_code
+            except Exception as e:
+                logger.warning("Ошибка отправки в %s: %s", room_id, e)
+                response, status = None, None
+
+            if response is not None:
+                waiting_reset = self.bucket.update_from_headers(response.headers)
+                if status == 429:
+                    # Лимит сервера: ответ не выбрасываем, повторяем без ограничения числа попыток
+                    self.rate_limited += 1
+                    if not waiting_reset:
+                        self.bucket.block_for(self._backoff(min(attempt, 6)))
+                    attempt += 1
+                    continue
+                if status < 400:
+                    self.sent += 1
+                    return True
+                if status < 500:
+                    logger.error("Сервер отклонил ответ в %s: HTTP %s", room_id, status)
+                    self.dropped += 1
+                    return False
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error("Ответ в %s не отправлен после %s повторов", room_id, self.max_retries)
+                self.dropped += 1
+                return False
+            self.retries += 1
+            await asyncio.sleep(self._backoff(attempt))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending_rooms': len(self._pending),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'dropped': self.dropped,
+            'queues': self.dispatcher.stats()
+        }
@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+import websockets
+
+
+logger = logging.getLogger(__name__)
+
+
+def ws_url_from_server(server_url: str) -> str:
+    """http(s)://host -> ws(s)://host/websocket"""
+    if server_url.startswith('https://'):
+        url = 'wss://' + server_url[len('https://'):]
+    elif server_url.startswith('http://'):
+        url = 'ws://' + server_url[len('http://'):]
+    else:
+        url = server_url
+    return url.rstrip('/') + '/websocket'
+
+
+def parse_ddp_date(value) -> Optional[datetime]:
+    """DDP передает даты как {"$date": <мс>}, REST - как ISO-строку"""
+    if isinstance(value, dict) and '$date' in value:
+        return datetime.fromtimestamp(value['$date'] / 1000, tz=timezone.utc)
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+    return None
+
+
+def format_ts(dt: datetime) -> str:
+    """Время в формате REST API Rocket.Chat (2024-01-01T06:55:11.123Z), строки сравнимы лексикографически"""
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+
+
+class RealtimeClient:
+    """Прием сообщений через WebSocket (DDP) API Rocket.Chat.
+
+    Подписывается на stream-room-messages (__my_messages__ - все комнаты
+    пользователя) и передает сообщения в bot.process_new_message, сдвигая
+    отметку комнаты (bot.advance_mark), как это делает опрос.
+    При разрыве соединения переподключается с экспоненциальной задержкой,
+    а после переподключения догружает пропущенное через bot.catch_up
+    начиная с последнего увиденного сообщения. Пока connected == False,
+    бот продолжает опрашивать REST API (см. RocketChatBot.run).
+    """
+
+    def __init__(self, bot, url: str, reconnect_delay: float = 1.0, max_reconnect_delay: float = 30.0):
+        self.bot = bot
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.connected = False
+        # С какого момента догружать сообщения после переподключения
+        self.last_seen: datetime = datetime.now(timezone.utc)
+        self._ids = itertools.count(1)
+
+    async def run(self):
+        delay = self.reconnect_delay
+        while self.bot.running:
+            try:
+                async with websockets.connect(self.url) as ws:
+                    await self._handshake(ws)
+                    self.connected = True
+                    delay = self.reconnect_delay
+                    logger.info("Realtime-подключение установлено")
+                    await self.bot.catch_up(self.last_seen)
+                    await self._listen(ws)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Realtime-соединение потеряно: {e}")
+            finally:
+                self.connected = False
+
+            if not self.bot.running:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _send(self, ws, payload: Dict[str, Any]):
+        await ws.send(json.dumps(payload))
+
+    async def _wait_for(self, ws, predicate: Callable[[Dict[str, Any]], bool]) -> Dict[str, Any]:
+        """Читает сокет до нужного сообщения, отвечая на ping сервера"""
+        while True:
+            msg = json.loads(await ws.recv())
+            if msg.get('msg') == 'ping':
+                await self._send(ws, {'msg': 'pong'})
+            elif predicate(msg):
+                return msg
+
+    async def _call(self, ws, method: str, *params) -> Any:
+        call_id = str(next(self._ids))
+        await self._send(ws, {'msg': 'method', 'method': method, 'id': call_id, 'params': list(params)})
+        reply = await self._wait_for(ws, lambda m: m.get('msg') == 'result' and m.get('id') == call_id)
+        if 'error' in reply:
+            raise ConnectionError(f"{method}: {reply['error']}")
+        return reply.get('result')
+
+    async def _subscribe(self, ws, name: str, *params):
+        sub_id = str(next(self._ids))
+        await self._send(ws, {'msg': 'sub', 'id': sub_id, 'name': name, 'params': list(params)})
+        reply = await self._wait_for(
+            ws,
+            lambda m: (m.get('msg') == 'ready' and sub_id in m.get('subs', []))
+            or (m.get('msg') == 'nosub' and m.get('id') == sub_id)
+        )
+        if reply['msg'] == 'nosub':
+            raise ConnectionError(f"Подписка {name} отклонена: {reply.get('error')}")
+
+    async def _handshake(self, ws):
+        await self._send(ws, {'msg': 'connect', 'version': '1', 'support': ['1']})
+        await self._wait_for(ws, lambda m: m.get('msg') == 'connected')
+
+        digest = hashlib.sha256(self.bot.config['password'].encode('utf-8')).hexdigest()
+        await self._call(ws, 'login', {
+            'user': {'username': self.bot.config['username']},
+            'password': {'digest': digest, 'algorithm': 'sha-256'}
+        })
+        await self._subscribe(ws, 'stream-room-messages', '__my_messages__', False)
+
+    async def _listen(self, ws):
+        async for raw in ws:
+            msg = json.loads(raw)
+            if msg.get('msg') == 'ping':
+                await self._send(ws, {'msg': 'pong'})
+            elif msg.get('msg') == 'changed' and msg.get('collection') == 'stream-room-messages':
+                # args: [сообщение, {roomType, roomParticipant, ...}]
+                args = msg.get('fields', {}).get('args', [])
+                if not args:
+                    continue
+                meta = args[1] if len(args) > 1 and isinstance(args[1], dict) else {}
+                # Бот работает только с личными сообщениями, как и в режиме опроса im_list
+                if meta.get('roomType', 'd') != 'd':
+                    continue
+                await self._handle(args[0])
+
+    async def _handle(self, message: Dict[str, Any]):
+        await self.bot.process_new_message(message)
+        # Отметки сдвигаем только после приема: если он упал, сообщение догрузится после переподключения
+        ts = parse_ddp_date(message.get('ts'))
+        if ts is None:
+            return
+        if ts > self.last_seen:
+            self.last_seen = ts
+        # Опрос (пока WebSocket не подключен) не будет заново загружать историю этой комнаты
+        self.bot.advance_mark(message['rid'], format_ts(ts))
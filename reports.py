@@ -0,0 +1,141 @@
+import asyncio
+import csv
+import io
+import os
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+def build_unknown_report(
+    path: str,
+    store_path: str,
+    date_from: Optional[str],
+    date_to: Optional[str],
+    timeout: float = 600
+) -> List[Dict[str, Any]]:
+    """Отчет по абонентам с неизвестной группой за период [date_from, date_to).
+
+    Считается по накопленным агрегатам know_stats.AggregateStore: перед
+    расчетом в хранилище дозагружаются только строки, дописанные в выгрузку
+    path с прошлого раза, а отчет за период складывается из агрегатов по дням.
+    Выполняется в отдельном процессе, поэтому pandas импортируется здесь, а
+    даты возвращаются строками - результат не требует pandas для распаковки.
+    """
+    from know_stats import AggregateStore, format_result
+
+    store = AggregateStore(store_path, timeout=timeout)
+    try:
+        store.sync_file(path)
+        formatted = format_result(store.result(date_from, date_to))
+    finally:
+        store.close()
+    for entry in formatted:
+        for connect in entry['connect_dates']:
+            connect['date_first_connect'] = str(connect['date_first_connect'])
+            connect['date_last_connect'] = str(connect['date_last_connect'])
+    return formatted
+
+
+def period_for(report_type: str, dates: Optional[List[str]] = None, today: Optional[date] = None) -> Tuple[str, str]:
+    """Период отчета как ISO-даты [начало, конец): daily - вчера и сегодня, weekly - 7 дней, custom - введенные даты"""
+    today = today or date.today()
+    if report_type == 'daily':
+        start, end = today - timedelta(days=1), today + timedelta(days=1)
+    elif report_type == 'weekly':
+        start, end = today - timedelta(days=7), today + timedelta(days=1)
+    else:
+        # Даты пользователя - ДД-ММ-ГГГГ, вторая включительно
+        first, last = (date(int(y), int(m), int(d)) for d, m, y in (value.split('-') for value in dates))
+        start, end = first, last + timedelta(days=1)
+    return start.isoformat(), end.isoformat()
+
+
+def render_entry(entry: Dict[str, Any]) -> str:
+    lines = [
+        f"Телефон: {entry['tlf_new']}",
+        f"ФИО абонентов: {entry['fio_abonents_agg']}",
+        f"Группы абонентов: {entry['group_abonents_agg']}"
+    ]
+    for connect in entry['connect_dates']:
+        lines.append(f"Связь: {connect['pair']}, первое соединение: {connect['date_first_connect']}, "
+                     f"последнее: {connect['date_last_connect']}")
+    return '\n'.join(lines)
+
+
+def render_pages(formatted: List[Dict[str, Any]], page_size: int) -> List[str]:
+    pages = []
+    total = (len(formatted) + page_size - 1) // page_size
+    for number, start in enumerate(range(0, len(formatted), page_size), 1):
+        body = '\n\n'.join(render_entry(entry) for entry in formatted[start:start + page_size])
+        pages.append(f"Страница {number}/{total}\n\n{body}")
+    return pages
+
+
+def render_csv(formatted: List[Dict[str, Any]]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(['tlf_new', 'fio_abonents_agg', 'group_abonents_agg', 'pair', 'date_first_connect', 'date_last_connect'])
+    for entry in formatted:
+        for connect in entry['connect_dates'] or [{}]:
+            writer.writerow([
+                entry['tlf_new'], entry['fio_abonents_agg'], entry['group_abonents_agg'],
+                connect.get('pair', ''), connect.get('date_first_connect', ''), connect.get('date_last_connect', '')
+            ])
+    # utf-8-sig - чтобы Excel правильно открыл кириллицу
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+class UnknownSubscribersReport:
+    """Отчет know_stats для бота: расчет в пуле процессов и LRU-кэш результатов.
+
+    Расчет идет по хранилищу агрегатов store_path (AggregateStore), которое
+    дополняется новыми строками выгрузки, а не по всему файлу заново.
+    Ключ кэша - (файл, время его изменения, период), так что обновление
+    выгрузки сбрасывает устаревшие результаты. Одинаковые запросы, пришедшие
+    во время расчета, ждут один и тот же расчет.
+    """
+
+    def __init__(
+        self,
+        calls_path: str,
+        store_path: str,
+        run_in_pool: Callable[..., Awaitable[Any]],
+        cache_size: int = 16
+    ):
+        self.calls_path = calls_path
+        self.store_path = store_path
+        # JobManager.run_in_pool: расчет занимает слот задачи, пока не закончится в процессе
+        self.run_in_pool = run_in_pool
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[tuple, List[Dict[str, Any]]]' = OrderedDict()
+        self._running: Dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, date_from: str, date_to: str) -> List[Dict[str, Any]]:
+        key = (self.calls_path, os.stat(self.calls_path).st_mtime_ns, date_from, date_to)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        running = self._running.get(key)
+        if running is not None:
+            self.hits += 1
+            return await asyncio.shield(running)
+
+        self.misses += 1
+        future = asyncio.ensure_future(self.run_in_pool(
+            build_unknown_report, self.calls_path, self.store_path, date_from, date_to
+        ))
+        self._running[key] = future
+        try:
+            formatted = await asyncio.shield(future)
+        finally:
+            self._running.pop(key, None)
+
+        self._cache[key] = formatted
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return formatted
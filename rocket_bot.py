@@ -1,66 +1,276 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import logging
-import re
-from rocketchat_API.rocketchat import RocketChat
-from datetime import datetime
-from typing import Dict, Any, Optional, Tuple
-import csv
-import io
-from datetime import datetime, timedelta
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+
+from transport import AsyncTransport, ThreadPoolTransport
+from realtime import RealtimeClient, format_ts, ws_url_from_server
+from dedup import DedupStore
+from dispatcher import ShardedDispatcher
+from outbox import Outbox
+from context_store import ContextStore, MemoryContextStore, SqliteContextStore
+from commands import COMMAND_SECONDS, CommandRouter, command
+from dialogs import COMPLETE, Dialog, DialogError, Step, choice, parse_datetime
+from csv_index import SEARCH_COLUMNS, CsvIndex
+from reports import UnknownSubscribersReport, period_for, render_csv, render_pages
+from jobs import DONE, Job, JobManager
+from cluster import Cluster
+import metrics
+from metrics import MetricsServer, SamplingProfiler
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def room_last_ts(chat: Dict[str, Any]) -> Optional[str]:
+    """Время последнего изменения комнаты из ответа im_list"""
+    last_message = chat.get('lastMessage') or {}
+    return last_message.get('ts') or chat.get('_updatedAt')
+
+
+def validate_date_range(user_input: str, data: Dict[str, Any]) -> List[str]:
+    error = "Неверный формат дат. Используйте ДД-ММ-ГГГГ (например: 01-01-2025 15-01-2025)"
+    parts = user_input.split()
+    if len(parts) != 2:
+        raise DialogError(error)
+    date1, date2 = (parse_datetime(part, "%d-%m-%Y", error) for part in parts)
+    if date1 > date2:
+        raise DialogError("Первая дата должна быть раньше второй. Попробуйте еще раз.")
+    return parts
+
+
+def validate_csv_file(attachment: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+    if not attachment['name'].lower().endswith('.csv'):
+        raise DialogError("Пожалуйста, отправьте именно CSV файл")
+    return attachment
+
+
+def message_attachment(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Описание загруженного в сообщение файла: имя, путь для скачивания, MIME-тип"""
+    file = message.get('file')
+    if not file:
+        return None
+    url = next((a['title_link'] for a in message.get('attachments') or [] if a.get('title_link')), None)
+    return {
+        'name': file.get('name', ''),
+        'url': url or f"/file-upload/{file['_id']}/{file.get('name', '')}",
+        'type': file.get('type')
+    }
+
+
+def validate_participants(user_input: str, data: Dict[str, Any]) -> List[str]:
+    participants = [p.strip() for p in user_input.split(',') if p.strip()]
+    if len(participants) < 1:
+        raise DialogError("Нужно указать хотя бы одного участника")
+    return participants
+
+
+def parse_number(args: List[str]) -> List[str]:
+    if len(args) != 1:
+        raise ValueError("Укажите один номер")
+    return args
+
+
+def parse_two_numbers(args: List[str]) -> List[str]:
+    if len(args) != 2:
+        raise ValueError("Укажите два номера")
+    return args
+
+
+def parse_number_and_group(args: List[str]) -> List[str]:
+    if len(args) < 2:
+        raise ValueError("Укажите номер и название группы")
+    # Название группы может содержать пробелы
+    return [args[0], ' '.join(args[1:])]
+
+
+def parse_profile_action(args: List[str]) -> List[Any]:
+    if not args or args[0] not in ('start', 'stop'):
+        raise ValueError("Укажите start или stop")
+    if args[0] == 'start' and len(args) > 1:
+        if not args[1].isdigit() or int(args[1]) == 0:
+            raise ValueError("Интервал выборки - целое число миллисекунд")
+        return ['start', int(args[1])]
+    return [args[0], None]
+
+
+def parse_job_id(args: List[str]) -> List[int]:
+    if len(args) != 1 or not args[0].lstrip('#').isdigit():
+        raise ValueError("Укажите номер задачи")
+    return [int(args[0].lstrip('#'))]
+
+
+def validate_meeting_time(user_input: str, data: Dict[str, Any]) -> str:
+    meeting_time = parse_datetime(user_input, "%d-%m-%Y %H:%M", "Неверный формат. Используйте ДД-ММ-ГГГГ ЧЧ:ММ")
+    if meeting_time < datetime.now():
+        raise DialogError("Дата должна быть в будущем. Попробуйте еще раз")
+    return user_input.strip()
+
+
+MESSAGES = metrics.counter('bot_messages_total', 'Сообщения, принятые к обработке')
+DEDUP_HITS = metrics.counter('bot_dedup_hits_total', 'Повторно полученные сообщения (опрос и realtime), отброшены')
+ERRORS = metrics.counter('bot_errors_total', 'Ошибки по этапам обработки', ['stage'])
+POLL_SECONDS = metrics.histogram('bot_poll_seconds', 'Цикл опроса: список комнат и история изменившихся')
+HANDLE_SECONDS = metrics.histogram('bot_handle_seconds', 'Обработка одного сообщения воркером')
+
+
 class RocketChatBot:
-    def __init__(self, config):
+    def __init__(self, config, transport: Optional[AsyncTransport] = None):
         self.config = config
-        self.rocket = None
+        # Все REST-вызовы идут через асинхронный транспорт, чтобы не блокировать event loop
+        self.transport = transport
+        self.realtime: Optional[RealtimeClient] = None
         self.user_id = None
         self.username = None
         self.running = False
-        self.processed_messages = set()
-        self.user_contexts: Dict[str, Dict[str, Any]] = {}
-
-        self.commands = {
-            'help': {
-                'function': self.show_help,
-                'description': 'Показать список команд'
-            },
-            'ping': {
-                'function': self.ping,
-                'description': 'Проверить работу бота'
-            },
-            'new_path': {
-                'function': self.start_new_path_dialog,
-                'description': 'Создать новый отчет (диалоговый режим)'
-            },
-            'db_check': {
-                'function': self.start_db_check_dialog,
-                'description': 'Проверить данные в базе'
-            },
-            'schedule': {
-                'function': self.start_schedule_meeting_dialog,
-                'description': 'Запланировать встречу'
-            },
-            'report': {
-                'function': self.start_report_request_dialog,
-                'description': 'Запросить специальный отчет'
-            }
-        }
+        # Несколько реплик (cluster_db): каждая обслуживает свою долю комнат, обработанные id,
+        # контексты и отметки комнат - в общей базе, чтобы при переезде комнаты следовать за ней
+        self.cluster: Optional[Cluster] = None
+        if config.get('cluster_db'):
+            self.cluster = Cluster(
+                config['cluster_db'],
+                replica_id=config.get('replica_id'),
+                partitions=config.get('cluster_partitions', 64),
+                ttl=config.get('lease_ttl', 10),
+                interval=config.get('lease_interval', 2)
+            )
+        shared_db = config.get('cluster_db')
+        # Ограниченное (и при заданном dedup_path сохраняемое на диск) множество обработанных id
+        self.processed_messages = DedupStore(
+            path=config.get('dedup_path') or shared_db,
+            max_entries=config.get('dedup_max_entries', 100_000)
+        )
+        # Отметка (ts последнего обработанного сообщения) по каждой комнате
+        self.room_marks: Dict[str, str] = {}
+        # Для комнат без отметки берутся сообщения, пришедшие после запуска бота
+        self.started_at = format_ts(datetime.now(timezone.utc))
+        # Контексты диалогов: в памяти или (context_db) в SQLite, общем для нескольких процессов
+        context_ttl = config.get('context_ttl', 300)
+        context_db = config.get('context_db') or shared_db
+        self.user_contexts: ContextStore = (
+            SqliteContextStore(context_db, ttl=context_ttl, timeout=config.get('context_db_timeout', 1.0)) if context_db
+            else MemoryContextStore(ttl=context_ttl)
+        )
+        # Контекст хранит имя диалога, а не метод, чтобы его можно было сериализовать
+        self.dialogs = self.build_dialogs()
+        # Очереди по пользователям: порядок сообщений одного пользователя сохраняется
+        self.dispatcher = ShardedDispatcher(
+            self.process_message,
+            workers=config.get('workers', 8),
+            queue_size=config.get('worker_queue_size', 100),
+            max_in_flight=config.get('max_in_flight', 500)
+        )
+        # Исходящие ответы: склейка по комнате, учет лимитов сервера, повторы
+        self.outbox = Outbox(
+            self.post_message,
+            coalesce_window=config.get('coalesce_window', 0.2),
+            rate=config.get('send_rate'),
+            burst=config.get('send_burst', 10.0)
+        )
+
+        # Тяжелые команды (отчеты, разбор файлов) - задачи вне event loop: пул процессов, лимит времени, отмена
+        job_workers = config.get('job_workers', config.get('report_workers', 2))
+        # forkserver, а не fork: у бота уже есть потоки (транспорт, to_thread, классификатор) и открытые
+        # соединения SQLite, копия их заблокированного состояния в дочернем процессе может зависнуть
+        self.job_executor = ProcessPoolExecutor(
+            max_workers=job_workers, mp_context=multiprocessing.get_context('forkserver')
+        )
+        self.jobs = JobManager(
+            self.job_executor,
+            self.outbox.send,
+            workers=job_workers,
+            timeout=config.get('job_timeout', 600),
+            progress_interval=config.get('job_progress_interval', 30)
+        )
+
+        # Отчет по абонентам с неизвестной группой (know_stats) считается в том же пуле процессов
+        # по накопленным агрегатам (report_store), в которые дозагружаются новые строки calls_path
+        self.unknown_report: Optional[UnknownSubscribersReport] = None
+        if config.get('calls_path'):
+            self.unknown_report = UnknownSubscribersReport(
+                config['calls_path'],
+                config.get('report_store', 'know_stats.sqlite3'),
+                self.jobs.run_in_pool,
+                cache_size=config.get('report_cache_size', 16)
+            )
+
+        # Граф звонков (call_graph.py) для запросов contacts/common/chain; открывается при первом запросе
+        self.call_graph = None
+
+        # Классификатор сообщений (модель из unbalance_classes.py); torch нужен только если он включен
+        self.classifier = None
+        if config.get('classifier_model'):
+            from classifier import BatchClassifier
+
+            self.classifier = BatchClassifier(
+                config['classifier_model'],
+                max_batch=config.get('classifier_batch', 32),
+                max_wait=config.get('classifier_wait_ms', 5) / 1000,
+                threads=config.get('classifier_threads'),
+                backend=config.get('classifier_backend', 'auto')
+            )
+
+        # Команды: help и ping объявлены декоратором @command, диалоги - по таблице
+        self.router = CommandRouter()
+        self.router.register_handlers(self)
+        dialog_commands = [
+            ('new_path', 'Создать новый отчет (диалоговый режим)', ('путь',)),
+            ('db_check', 'Проверить данные в базе', ('dbcheck', 'проверка')),
+            ('schedule', 'Запланировать встречу', ('встреча',)),
+            ('report', 'Запросить специальный отчет', ('отчет',)),
+        ]
+        for name, description, aliases in dialog_commands:
+            self.router.add(name, functools.partial(self.start_dialog, name), description, aliases)
+
+        # Метрики: HTTP-эндпоинт (metrics_port) и/или периодическая запись JSON (metrics_json)
+        self.metrics_server: Optional[MetricsServer] = None
+        if config.get('metrics_port'):
+            self.metrics_server = MetricsServer(
+                host=config.get('metrics_host', '127.0.0.1'), port=config['metrics_port']
+            )
+        self.profiler: Optional[SamplingProfiler] = None
+        self.register_metrics()
+
+    def register_metrics(self):
+        """Значения, которые считываются с объектов бота в момент запроса метрик"""
+        metrics.gauge('bot_active_dialogs', 'Пользователи в незавершенном диалоге', lambda: len(self.user_contexts))
+        metrics.gauge('bot_dedup_entries', 'Id сообщений в хранилище дедупликации', lambda: len(self.processed_messages))
+        metrics.gauge('bot_rooms_tracked', 'Комнаты с отметкой последнего сообщения', lambda: len(self.room_marks))
+        metrics.gauge('bot_dispatch_queued', 'Сообщения в очередях воркеров', lambda: self.dispatcher.stats()['queued'])
+        metrics.gauge('bot_dispatch_in_flight', 'Сообщения в обработке', lambda: self.dispatcher.stats()['in_flight'])
+        metrics.gauge('bot_outbox_pending_rooms', 'Комнаты с ответами, ждущими склейки', lambda: self.outbox.stats()['pending_rooms'])
+        metrics.gauge('bot_outbox_sent_total', 'Отправленные сообщения', lambda: self.outbox.sent, kind='counter')
+        metrics.gauge('bot_outbox_retries_total', 'Повторы отправки', lambda: self.outbox.retries, kind='counter')
+        metrics.gauge('bot_outbox_rate_limited_total', 'Ответы 429', lambda: self.outbox.rate_limited, kind='counter')
+        metrics.gauge('bot_outbox_dropped_total', 'Неотправленные ответы', lambda: self.outbox.dropped, kind='counter')
+        metrics.gauge('bot_jobs_queued', 'Задачи в очереди', lambda: self.jobs.stats()['queued'])
+        metrics.gauge('bot_jobs_running', 'Выполняющиеся задачи', lambda: self.jobs.stats()['running'])
+        if self.cluster is not None:
+            metrics.gauge('bot_cluster_partitions', 'Разделы комнат этой реплики', lambda: len(self.cluster.owned))
+            metrics.gauge('bot_cluster_replicas', 'Живые реплики', lambda: len(self.cluster.replicas))
 
     async def connect(self):
         """Подключение к REST API"""
         try:
-            self.rocket = RocketChat(
-                user=self.config['username'],
-                password=self.config['password'],
-                server_url=self.config['server_url']
-            )
-            me = self.rocket.me().json()
+            if self.transport is None:
+                self.transport = ThreadPoolTransport(
+                    self.config,
+                    max_workers=self.config.get('rest_workers', 16)
+                )
+            await self.transport.connect()
+            me = (await self.transport.me()).json()
             self.user_id = me['_id']
             self.username = me['username']
+            # Для разбора обращений вида "@бот help"
+            self.router.bot_username = self.username
             logger.info(f"Подключено как {self.username}")
             return True
         except Exception as e:
@@ -69,308 +279,513 @@ class RocketChatBot:
 
     async def get_new_messages(self):
         try:
-            # self.rocket.im_list() - Вызов REST API Rocket.Chat для получения списка личных чатов
+            # self.transport.im_list() - Вызов REST API Rocket.Chat для получения списка личных чатов
             # .get('ims', []) - Безопасное извлечение списка чатов (если ключа нет, вернёт пустой список)
-            im_list = self.rocket.im_list().json().get('ims', [])
-
-            # Создаем задачи для параллельной обработки комнат
-            tasks = []  # Инициализация списка для хранения задач
-            for chat in im_list:  # Перебор всех полученных чатов
-                # Создание асинхронной задачи для обработки одной комнаты:
-                # Задача начинает выполняться сразу после создания
-                # Не блокирует основной поток
-                task = asyncio.create_task(self.process_room(chat['_id']))
-                tasks.append(task)
-
-            # *tasks - распаковка списка задач в отдельные аргументы
-            await asyncio.gather(*tasks)  # Ожидание завершения всех созданных задач:
+            im_list = (await self.transport.im_list()).json().get('ims', [])
+            await self.process_changed_rooms(im_list, self.started_at)
 
         except Exception as e:
+            ERRORS.inc(stage='poll')
             logger.error(f"Ошибка получения сообщений: {e}")
 
-    # async def process_room(self, room_id):
-    #     # Rocket.Chat API имеет лимиты на частоту запросов
-    #     # Рекомендуется добавить задержку между запросами к одной комнате:
-    #     now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-    #     messages = self.rocket.im_history(room_id=room_id, count=10).json().get('messages', [])
-    #     await asyncio.sleep(0.1)  # Задержка 100 мс между запросами
-    #     for msg in messages:
-    #         if msg['_id'] not in self.processed_messages:
-    #             await self.process_message(msg)
-    #             self.processed_messages.add(msg['_id'])
-
-    async def process_room(self, room_id):
-        # Загружаем только сообщения, отправленные после текущего времени минус 5 секунд
-        # now_five_min = (datetime.utcnow() - timedelta(minutes=5))
-        # print(f'now - {now_five_min}')
-        # message_last = self.rocket.im_history(room_id=room_id, count=1, oldest=now_five_min).json().get('messages', [])
-        # print(message_last)
-        # if message_last:
-        #     message_last_ts = datetime.strptime(message_last[0]['ts'], "%Y-%m-%dT%H:%M:%S.%fZ")
-        #     print(message_last_ts)
-        #     if message_last_ts < now_five_min:
-        #         print('старые сообщения')
-        #         print(message_last)
-        #         await self.process_room(room_id)
-
-        messages = self.rocket.im_history(room_id=room_id, count=1).json().get('messages', [])
-
+    async def process_changed_rooms(self, im_list, default_mark: str):
+        """Запуск обработки только тех комнат, где есть сообщения новее отметки"""
+        # Создаем задачи для параллельной обработки комнат
+        tasks = []  # Инициализация списка для хранения задач
+        for chat in im_list:  # Перебор всех полученных чатов
+            # Комнаты других реплик не трогаем
+            if self.cluster is not None and not self.cluster.owns(chat['_id']):
+                continue
+            room_ts = room_last_ts(chat)
+            mark = self.room_marks.get(chat['_id'], default_mark)
+            # Комната не менялась с прошлого цикла - историю не запрашиваем
+            if room_ts is not None and room_ts <= mark:
+                continue
+            # Создание асинхронной задачи для обработки одной комнаты:
+            # Задача начинает выполняться сразу после создания
+            # Не блокирует основной поток
+            task = asyncio.create_task(self.process_room(chat['_id'], mark, room_ts))
+            tasks.append(task)
+
+        # *tasks - распаковка списка задач в отдельные аргументы
+        await asyncio.gather(*tasks)  # Ожидание завершения всех созданных задач:
+
+    async def fetch_room_history(self, room_id: str, oldest: str, page_size: int = 100):
+        """Все сообщения комнаты новее oldest, от старых к новым"""
+        messages = []
+        offset = 0
+        while True:
+            page = (await self.transport.im_history(
+                room_id=room_id, oldest=oldest, count=page_size, offset=offset
+            )).json().get('messages', [])
+            messages.extend(page)
+            if len(page) < page_size:
+                break
+            offset += page_size
+        # im_history возвращает сообщения от новых к старым
+        messages.sort(key=lambda m: m['ts'])
+        return messages
+
+    async def process_room(self, room_id: str, oldest: str, room_ts: Optional[str] = None):
+        # Загружаем все сообщения после отметки комнаты, а не только последнее,
+        # чтобы не терять несколько сообщений, пришедших между циклами опроса
+        messages = await self.fetch_room_history(room_id, oldest)
 
         for msg in messages:
-            if msg['_id'] not in self.processed_messages:
-                await self.process_message(msg)
-                self.processed_messages.add(msg['_id'])
+            await self.process_new_message(msg)
 
-    async def process_message(self, message):
-        """Обработка сообщения"""
+        self.advance_mark(room_id, max([oldest, room_ts or oldest] + [msg['ts'] for msg in messages]))
+
+    def advance_mark(self, room_id: str, ts: str):
+        """Сдвиг отметки комнаты вперед: сообщения до ts уже приняты (опросом или через realtime)"""
+        # Комнату другой реплики не отмечаем: ее отметку ведет владелица
+        if self.cluster is not None and not self.cluster.owns(room_id):
+            return
+        if ts > self.room_marks.get(room_id, ''):
+            self.room_marks[room_id] = ts
+            if self.cluster is not None:
+                self.cluster.note_mark(room_id, ts)
+
+    async def process_new_message(self, msg):
+        """Обработка сообщения, если оно еще не обрабатывалось (опрос и realtime могут прислать его дважды)"""
+        # realtime присылает сообщения всех комнат; чужие до отметки в общей базе не доходят
+        if self.cluster is not None and not self.cluster.owns(msg['rid']):
+            return
+        if not await self.processed_messages.check_and_add(msg['_id']):
+            DEDUP_HITS.inc()
+            return
+        # Собственные ответы бота не обрабатываем
+        if msg.get('u', {}).get('_id') == self.user_id:
+            return
+        MESSAGES.inc()
+        # От этого момента считается задержка ответа (bot_reply_seconds)
+        msg['_received_at'] = time.monotonic()
+        if self.cluster is None:
+            await self.dispatcher.submit(msg)
+            return
+        # Раздел комнаты не отдается другой реплике, пока сообщение не обработано
+        self.cluster.accept(msg['rid'])
         try:
-            text = message.get('msg', '').strip()
-            sender = message['u']['username']
-            room_id = message['rid']
-
-            logger.info(f"Новое сообщение от {sender}: {text}")
-
-            # Добавляем room_id при вызове
-            response = await self.handle_command(text, sender, room_id)
-            if response:
-                self.rocket.chat_post_message(
-                    room_id=room_id,
-                    text=response
-                )
-                logger.info(f"Отправлен ответ: {response}")
+            await self.dispatcher.submit(msg)
+        except BaseException:
+            self.cluster.done(msg['rid'])
+            raise
 
+    async def catch_up(self, since: datetime):
+        """Догрузка сообщений, пришедших начиная с since (после разрыва realtime-соединения)"""
+        try:
+            im_list = (await self.transport.im_list()).json().get('ims', [])
+            await self.process_changed_rooms(im_list, format_ts(since))
         except Exception as e:
-            logger.error(f"Ошибка обработки: {e}")
-
+            logger.error(f"Ошибка догрузки сообщений: {e}")
 
-    async def handle_command(self, command_text: str, sender: str, room_id: str) -> Optional[str]:
-        """Основной обработчик команд с поддержкой контекста"""
+    async def process_message(self, message):
+        """Обработка сообщения"""
+        # На этом пути логирование с аргументами, а не f-строками: при выключенном
+        # уровне сообщение (с текстом и ответом целиком) не форматируется
         try:
-            if sender in self.user_contexts:
-                return await self.continue_dialog(sender, room_id, command_text)
+            with HANDLE_SECONDS.time():
+                text = message.get('msg', '').strip()
+                sender = message['u']['username']
+                room_id = message['rid']
 
-            parts = command_text.split()
-            if not parts:
-                return None
+                logger.info("Новое сообщение от %s: %s", sender, text)
 
-            command = parts[0].lower()
-            args = parts[1:] if len(parts) > 1 else []
+                if self.classifier is not None and text:
+                    # Метка доступна обработчикам; тексты разных пользователей классифицируются пачкой
+                    message['label'] = await self.classifier.classify(text)
+                    logger.info("Класс сообщения: %s", message['label'])
 
-            if command in self.commands:
-                return await self.commands[command]['function'](sender, room_id, *args)
+                # Добавляем room_id при вызове
+                response = await self.handle_command(text, sender, room_id, message_attachment(message))
+                if response:
+                    await self.outbox.send(room_id, response, received_at=message.get('_received_at'))
+                    logger.debug("Поставлен в очередь ответ: %s", response)
 
-            return None
         except Exception as e:
+            ERRORS.inc(stage='process')
+            logger.error("Ошибка обработки: %s", e)
+        finally:
+            if self.cluster is not None:
+                self.cluster.done(message['rid'])
+
+    async def post_message(self, room_id: str, text: str):
+        return await self.transport.chat_post_message(
+            room_id=room_id,
+            text=text
+        )
+
+    async def handle_command(
+        self,
+        command_text: str,
+        sender: str,
+        room_id: str,
+        attachment: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        """Основной обработчик команд с поддержкой контекста"""
+        try:
+            context = await self.user_contexts.get(sender)
+            if context is not None:
+                return await self.continue_dialog(sender, room_id, command_text, attachment, context)
+
+            return await self.router.dispatch(command_text, sender, room_id)
+        except Exception as e:
+            ERRORS.inc(stage='command')
             logger.error(f"Command handling error: {e}")
             return "Произошла ошибка при обработке команды"
 
     # ======================
-    # Диалог для new_path
-    # ======================
-    async def start_new_path_dialog(self, sender: str, room_id: str) -> str:
-        """Начало диалога создания пути"""
-        self.user_contexts[sender] = {
-            'state': 'awaiting_dates',
-            'room_id': room_id,
-            'handler': self.handle_new_path_dialog,
-            'data': {},
-            'created_at': datetime.now()
-        }
-        return "За какой промежуток времени? Введите 2 даты в формате ДД-ММ-ГГГГ"
-
-    async def handle_new_path_dialog(self, sender: str, state: str, user_input: str) -> Tuple[str, str]:
-        """Обработчик шагов диалога new_path"""
-        if user_input.lower() == 'отмена':
-            return "complete", "Диалог прерван"
-
-        if state == 'awaiting_dates':
-            try:
-                date1, date2 = map(lambda x: datetime.strptime(x, "%d-%m-%Y"), user_input.split())
-                if date1 > date2:
-                    return "awaiting_dates", "Первая дата должна быть раньше второй. Попробуйте еще раз."
-
-                return "awaiting_details", "Теперь укажите детали маршрута (города, транспорт и т.д.):"
-            except:
-                return "awaiting_dates", "Неверный формат дат. Используйте ДД-ММ-ГГГГ (например: 01-01-2025 15-01-2025)"
-
-        elif state == 'awaiting_details':
-            # Здесь можно добавить обработку деталей
-            return "complete", f"Маршрут запланирован с деталями: {user_input}"
-
-
-    # ======================
-    # Функция обработки отчетов
-    # ======================
-    async def start_report_request_dialog(self, sender: str, room_id: str) -> str:
-        """Начало диалога запроса специального отчета"""
-        self.user_contexts[sender] = {
-            'state': 'awaiting_report_type',
-            'room_id': room_id,
-            'handler': self.handle_report_request_dialog,
-            'data': {},
-            'created_at': datetime.now()
-        }
-        return ("Какой отчет вам нужен? Выберите тип:\n"
-                "1. Ежедневный\n"
-                "2. Еженедельный\n"
-                "3. Пользовательский\n"
-                "Введите номер варианта")
-
-    async def handle_report_request_dialog(self, sender: str, state: str, user_input: str) -> Tuple[str, str]:
-        """Обработчик шагов диалога запроса отчета"""
-        if user_input.lower() == 'отмена':
-            return "complete", "Диалог прерван"
-
-        if state == 'awaiting_report_type':
-            report_types = {
-                '1': 'daily',
-                '2': 'weekly',
-                '3': 'custom'
-            }
-
-            if user_input not in report_types:
-                return "awaiting_report_type", "Неверный вариант. Введите число от 1 до 3"
-
-            if user_input == '3':  # Для пользовательского отчета запросим дополнительные параметры
-                return "awaiting_custom_params", "Введите параметры отчета (период, фильтры и т.д.):"
-
-            return "complete", f"Отчет ({report_types[user_input]}) будет сформирован и отправлен вам в течение часа"
-
-        elif state == 'awaiting_custom_params':
-            return "complete", f"Пользовательский отчет с параметрами '{user_input}' будет сформирован в течение 2 часов"
-
-    # ======================
-    # Диалог для проверки БД
-    # ======================
-    async def start_db_check_dialog(self, sender: str, room_id: str) -> str:
-        """Начало диалога проверки базы данных"""
-        self.user_contexts[sender] = {
-            'state': 'awaiting_search_type',
-            'room_id': room_id,
-            'handler': self.handle_db_check_dialog,
-            'data': {},
-            'created_at': datetime.now()
-        }
-        return ("Как будем искать данные? Выберите тип:\n"
-                "1. По ФИО\n"
-                "2. По отделу\n"
-                "3. По местоположению\n"
-                "Введите номер варианта")
-
-    async def handle_db_check_dialog(self, sender: str, state: str, user_input: str) -> Tuple[str, str]:
-        """Обработчик шагов диалога проверки БД"""
-
-        if user_input.lower() == 'отмена':
-            return "complete", "Диалог прерван"
-
-        if state == 'awaiting_search_type':
-            search_types = {
-                '1': 'fio',
-                '2': 'department',
-                '3': 'location'
-            }
-
-            if user_input not in search_types:
-                return "awaiting_search_type", "Неверный вариант. Введите число от 1 до 3"
-
-            return "awaiting_search_value", f"Введите значение для поиска по {search_types[user_input]}:"
-
-        elif state == 'awaiting_search_value':
-            return "awaiting_file", "Теперь отправьте CSV файл с данными для проверки"
-
-        elif state == 'awaiting_file':
-            if not user_input.lower().endswith('.csv'):
-                return "awaiting_file", "Пожалуйста, отправьте именно CSV файл"
-
-            # Здесь была бы обработка файла
-            return "complete", "Данные успешно проверены. Найдено 42 совпадения"
-
-    # ======================
-    # Диалог планирования встречи
+    # Описания диалогов
     # ======================
-    async def start_schedule_meeting_dialog(self, sender: str, room_id: str) -> str:
-        """Начало диалога планирования встречи"""
-        self.user_contexts[sender] = {
-            'state': 'awaiting_participants',
-            'room_id': room_id,
-            'handler': self.handle_schedule_meeting_dialog,
-            'data': {},
-            'created_at': datetime.now()
-        }
-        return "Введите участников встречи (через запятую):"
-
-    async def handle_schedule_meeting_dialog(self, sender: str, state: str, user_input: str) -> Tuple[str, str]:
-        """Обработчик шагов диалога планирования встречи"""
-        if user_input.lower() == 'отмена':
-            return "complete", "Диалог прерван"
-
-        if state == 'awaiting_participants':
-            participants = [p.strip() for p in user_input.split(',')]
-            if len(participants) < 1:
-                return "awaiting_participants", "Нужно указать хотя бы одного участника"
-
-            return "awaiting_date", "Введите дату и время встречи (ДД-ММ-ГГГГ ЧЧ:ММ):"
-
-        elif state == 'awaiting_date':
-            try:
-                meeting_time = datetime.strptime(user_input, "%d-%m-%Y %H:%M")
-                if meeting_time < datetime.now():
-                    return "awaiting_date", "Дата должна быть в будущем. Попробуйте еще раз"
+    def build_dialogs(self) -> Dict[str, Dialog]:
+        """Диалоги бота: состояния, проверки, переходы и вопросы"""
+        dialogs = [
+            Dialog('new_path', {
+                'awaiting_dates': Step(
+                    "За какой промежуток времени? Введите 2 даты в формате ДД-ММ-ГГГГ",
+                    field='dates', validate=validate_date_range, next='awaiting_details'
+                ),
+                'awaiting_details': Step(
+                    "Теперь укажите детали маршрута (города, транспорт и т.д.):",
+                    field='details'
+                ),
+            }, finish=lambda data, context: f"Маршрут запланирован с деталями: {data['details']}"),
+
+            Dialog('report', {
+                'awaiting_report_type': Step(
+                    "Какой отчет вам нужен? Выберите тип:\n"
+                    "1. Ежедневный\n"
+                    "2. Еженедельный\n"
+                    "3. Пользовательский\n"
+                    "Введите номер варианта",
+                    field='report_type',
+                    validate=choice({'1': 'daily', '2': 'weekly', '3': 'custom'},
+                                    "Неверный вариант. Введите число от 1 до 3"),
+                    # Для пользовательского отчета запросим дополнительные параметры
+                    next=lambda data: 'awaiting_custom_params' if data['report_type'] == 'custom' else COMPLETE
+                ),
+                'awaiting_custom_params': Step(
+                    "Введите период отчета: 2 даты в формате ДД-ММ-ГГГГ",
+                    field='dates', validate=validate_date_range
+                ),
+            }, finish=self.finish_report_request),
+
+            Dialog('db_check', {
+                'awaiting_search_type': Step(
+                    "Как будем искать данные? Выберите тип:\n"
+                    "1. По ФИО\n"
+                    "2. По отделу\n"
+                    "3. По местоположению\n"
+                    "Введите номер варианта",
+                    field='search_type',
+                    validate=choice({'1': 'fio', '2': 'department', '3': 'location'},
+                                    "Неверный вариант. Введите число от 1 до 3"),
+                    next='awaiting_search_value'
+                ),
+                'awaiting_search_value': Step(
+                    "Введите значение для поиска по {search_type}:",
+                    field='search_value', next='awaiting_file'
+                ),
+                'awaiting_file': Step(
+                    "Теперь отправьте CSV файл с данными для проверки",
+                    field='file', validate=validate_csv_file, file=True
+                ),
+            }, finish=self.finish_db_check),
+
+            Dialog('schedule', {
+                'awaiting_participants': Step(
+                    "Введите участников встречи (через запятую):",
+                    field='participants', validate=validate_participants, next='awaiting_date'
+                ),
+                'awaiting_date': Step(
+                    "Введите дату и время встречи (ДД-ММ-ГГГГ ЧЧ:ММ):",
+                    field='meeting_time', validate=validate_meeting_time, next='awaiting_topic'
+                ),
+                'awaiting_topic': Step(
+                    "Введите тему встречи:",
+                    field='topic'
+                ),
+            }, finish=lambda data, context: f"Встреча запланирована на тему: {data['topic']}"),
+        ]
+        return {dialog.name: dialog for dialog in dialogs}
+
+    async def start_dialog(self, name: str, sender: str, room_id: str, *args) -> str:
+        """Начало диалога: сохраняем контекст и задаем первый вопрос"""
+        context, prompt = self.dialogs[name].start(room_id)
+        # Автор диалога нужен задачам, которые диалог запускает (отмена - по пользователю)
+        context['sender'] = sender
+        await self.user_contexts.set(sender, context)
+        return prompt
+
+    async def finish_report_request(self, data: Dict[str, Any], context: Dict[str, Any]) -> str:
+        if self.unknown_report is None:
+            if data['report_type'] == 'custom':
+                return f"Пользовательский отчет за период {' - '.join(data['dates'])} будет сформирован в течение 2 часов"
+            return f"Отчет ({data['report_type']}) будет сформирован и отправлен вам в течение часа"
+
+        date_from, date_to = period_for(data['report_type'], data.get('dates'))
+        # Расчет идет задачей: очередь сообщений пользователя не ждет его окончания
+        job = self.jobs.submit(
+            context.get('sender', ''), context['room_id'], 'report',
+            lambda: self.unknown_report.get(date_from, date_to),
+            on_done=functools.partial(self.send_unknown_report, date_from, date_to)
+        )
+        return (f"Формирую отчет по абонентам с неизвестной группой за период {date_from} - {date_to} "
+                f"(задача #{job.id}, отменить - 'отмена')")
+
+    async def send_unknown_report(self, date_from: str, date_to: str, job: Job):
+        room_id = job.room_id
+        formatted = job.result
+        if not formatted:
+            await self.outbox.send(room_id, "Абонентов с неизвестной группой за этот период нет")
+            return
 
-                return "awaiting_topic", "Введите тему встречи:"
-            except:
-                return "awaiting_date", "Неверный формат. Используйте ДД-ММ-ГГГГ ЧЧ:ММ"
+        pages = render_pages(formatted, self.config.get('report_page_size', 10))
+        if len(pages) <= self.config.get('report_max_pages', 5):
+            for page in pages:
+                await self.outbox.send(room_id, page)
+            return
 
-        elif state == "awaiting_topic":
-            return "complete", f"Встреча запланирована на тему: {user_input}"
+        # Длинный отчет: первая страница сообщением, целиком - CSV-вложением
+        await self.outbox.send(room_id, f"{pages[0]}\n\nВсего абонентов: {len(formatted)}, полный отчет - во вложении")
+        content = await asyncio.to_thread(render_csv, formatted)
+        await self.transport.upload_file(room_id, f"unknown_{date_from}_{date_to}.csv", content)
+
+    async def finish_db_check(self, data: Dict[str, Any], context: Dict[str, Any]) -> str:
+        job = self.jobs.submit(
+            context.get('sender', ''), context['room_id'], 'db_check',
+            functools.partial(self.check_csv, data),
+            on_done=lambda job: self.outbox.send(job.room_id, job.result)
+        )
+        return f"Проверяю файл {data['file']['name']} (задача #{job.id}, отменить - 'отмена')"
+
+    async def check_csv(self, data: Dict[str, Any]) -> str:
+        # Транспорт только скачивает файл во временный; разбор - в пуле процессов задач,
+        # он не держит GIL бота и не занимает потоки REST-вызовов
+        fd, path = tempfile.mkstemp(suffix='.csv', dir=self.config.get('download_dir'))
+        os.close(fd)
+        try:
+            await self.transport.download_file(data['file']['url'], path)
+            # Хранятся только значения, подходящие под искомое: память не зависит от размера файла
+            index = await self.jobs.run_in_pool(functools.partial(
+                CsvIndex.build_file, path,
+                column_candidates=SEARCH_COLUMNS[data['search_type']],
+                search_value=data['search_value']
+            ))
+        except ValueError as e:
+            return f"Не удалось проверить файл: {e}"
+        finally:
+            os.remove(path)
+        stats = index.stats()
+        logger.info("CSV %s: %s строк за %.2f с (%.0f строк/с, %.1f МБ/с)", data['file']['name'],
+                    stats['rows'], stats['seconds'], stats['rows_per_sec'], stats['mb_per_sec'])
+        return index.format_matches(data['search_value'])
 
     # ======================
     # Общий обработчик диалогов
     # ======================
-    async def continue_dialog(self, sender: str, room_id: str, user_input: str) -> Optional[str]:
-        """Продолжение диалога на основе контекста"""
-        if sender not in self.user_contexts:
+    async def continue_dialog(
+        self,
+        sender: str,
+        room_id: str,
+        user_input: str,
+        attachment: Optional[Dict[str, Any]] = None,
+        context: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        """Продолжение диалога на основе контекста (если он уже прочитан - переданного в context)"""
+        if context is None:
+            context = await self.user_contexts.get(sender)
+        if context is None:
             return None
 
-        context = self.user_contexts[sender]
-        handler = context['handler']
-        state = context['state']
+        dialog = self.dialogs[context['dialog']]
 
         try:
-            new_state, response = await handler(sender, state, user_input)
+            with COMMAND_SECONDS.time(command=context['dialog']):
+                new_state, response = await dialog.handle(context, user_input, attachment)
 
-            if new_state == "complete":
-                del self.user_contexts[sender]
+            if new_state == COMPLETE:
+                await self.user_contexts.delete(sender)
                 return response
             else:
-                context['state'] = new_state
+                # Сохранение заодно продлевает срок жизни контекста
+                await self.user_contexts.set(sender, context)
                 return response
 
         except Exception as e:
+            ERRORS.inc(stage='dialog')
             logger.error(f"Dialog error for {sender}: {e}")
-            del self.user_contexts[sender]
+            await self.user_contexts.delete(sender)
             return "Произошла ошибка. Диалог прерван."
 
-    async def cleanup_contexts(self):
+    async def log_stats(self):
+        # Очереди и задержки: глубина очередей обработки, отправки и задач, время задач
+        while self.running:
+            await asyncio.sleep(self.config.get('stats_interval', 60))
+            logger.info("Обработка: %s", self.dispatcher.stats())
+            logger.info("Отправка: %s", self.outbox.stats())
+            logger.info("Задачи: %s", self.jobs.stats())
+            if self.cluster is not None:
+                logger.info("Реплика: %s", self.cluster.stats())
+            if self.config.get('metrics_json'):
+                try:
+                    metrics.REGISTRY.dump_json(self.config['metrics_json'])
+                except OSError as e:
+                    logger.error("Не удалось записать метрики: %s", e)
+
+    async def maintain_cluster(self):
+        """Аренда разделов комнат: продление, захват своей доли, передача лишних разделов другим репликам"""
         while self.running:
-            await asyncio.sleep(60)  # Проверка каждую минуту
-            now = datetime.now()
-            expired = [user for user, ctx in self.user_contexts.items()
-                       if now - ctx['created_at'] > timedelta(minutes=5)]
+            try:
+                change = await self.cluster.heartbeat()
+                # Полученные комнаты продолжаем с отметок прежней владелицы
+                for room_id, ts in change.marks.items():
+                    if ts > self.room_marks.get(room_id, ''):
+                        self.room_marks[room_id] = ts
+                if change.surrender:
+                    # Новых сообщений этих комнат уже не берем; ждем начатые и отдаем разделы
+                    drained = await self.cluster.drain(change.surrender, self.cluster.ttl / 2)
+                    busy = [p for p in change.surrender if p not in drained]
+                    if busy:
+                        # Аренду занятых разделов продлит следующий шаг, тогда и попробуем отдать снова
+                        logger.warning("Разделы %s еще обрабатываются, передача отложена", busy)
+                    if drained:
+                        await self.cluster.release(drained)
+                        self.room_marks = {
+                            room_id: ts for room_id, ts in self.room_marks.items() if self.cluster.owns(room_id)
+                        }
+            except Exception as e:
+                logger.error(f"Ошибка согласования разделов: {e}")
+            await asyncio.sleep(self.cluster.interval)
 
+    async def cleanup_contexts(self):
+        while self.running:
+            await asyncio.sleep(10)  # Проверка каждые 10 секунд
+            if not self.running:
+                # Бот остановлен во время паузы - хранилище уже закрыто
+                break
+            # Хранилище само удаляет контексты без активности дольше context_ttl
+            try:
+                expired = await self.user_contexts.expire()
+            except sqlite3.OperationalError as e:
+                # Базу контекстов держит другая реплика - очистка повторится в следующий раз
+                logger.warning("Очистка контекстов отложена: %s", e)
+                continue
             for user in expired:
-                del self.user_contexts[user]
                 logger.info(f"Удален просроченный контекст для {user}")
 
+    @command('help', 'Показать список команд', aliases=('помощь', '?'))
     async def show_help(self, sender, room_id, *args):
-        help_text = "Доступные команды:\n"
-        for cmd, data in self.commands.items():
-            help_text += f"• {cmd} - {data['description']}\n"
-        return help_text
+        return self.router.help_text
 
+    @command('ping', 'Проверить работу бота', aliases=('пинг',))
     async def ping(self, sender, room_id, *args):
         return "Pong! 🏓"
 
+    @command('jobs', 'Мои задачи (отчеты, проверки файлов)', aliases=('задачи',))
+    async def show_jobs(self, sender, room_id, *args):
+        jobs = self.jobs.user_jobs(sender)[-10:]
+        if not jobs:
+            return "Задач нет"
+        return '\n'.join(job.describe() for job in jobs)
+
+    @command('job', 'Результат задачи', aliases=('задача',), parser=parse_job_id, usage='job <номер>')
+    async def show_job(self, sender, room_id, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.sender != sender:
+            return f"Задача #{job_id} не найдена"
+        if job.status != DONE:
+            return job.describe()
+        await self.jobs.deliver(job)
+        return None
+
+    @command('cancel', 'Отменить свои выполняющиеся задачи', aliases=('отмена',))
+    async def cancel_jobs(self, sender, room_id, *args):
+        cancelled = self.jobs.cancel(sender)
+        if not cancelled:
+            return "Нет выполняющихся задач"
+        return "Отменены задачи: " + ', '.join(f"#{job.id} {job.name}" for job in cancelled)
+
+    @command('profile', 'Профилирование event loop (администраторы)', aliases=('профиль',),
+             parser=parse_profile_action, usage='profile start [мс] | profile stop')
+    async def profile(self, sender, room_id, action, interval_ms):
+        if sender not in self.config.get('admins', []):
+            return "Команда доступна только администраторам"
+        if action == 'start':
+            if self.profiler is not None and self.profiler.running:
+                return "Профилирование уже идет"
+            self.profiler = SamplingProfiler(interval=(interval_ms or self.config.get('profile_interval_ms', 5)) / 1000)
+            self.profiler.start()
+            logger.info("Профилирование включено (%s)", sender)
+            return f"Профилирование включено, выборка раз в {self.profiler.interval * 1000:.0f} мс"
+        if self.profiler is None or not self.profiler.running:
+            return "Профилирование не запущено"
+        self.profiler.stop()
+        path = os.path.join(self.config.get('profile_dir', '.'), f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt")
+        try:
+            self.profiler.dump_collapsed(path)
+        except OSError as e:
+            logger.error("Не удалось сохранить профиль: %s", e)
+            path = None
+        text = self.profiler.report()
+        return text + (f"\nСтеки (collapsed, для flamegraph): {path}" if path else "")
+
+    def get_call_graph(self):
+        """Граф звонков из call_graph_path; перестроенный граф открывается заново при следующем запросе"""
+        path = self.config.get('call_graph_path')
+        if not path:
+            return None
+        try:
+            mtime = os.path.getmtime(os.path.join(path, 'meta.json'))
+            if self.call_graph is None or self.call_graph.mtime != mtime:
+                from call_graph import CallGraph
+
+                self.call_graph = CallGraph(path)
+                logger.info(f"Открыт граф звонков {path}: {self.call_graph.stats()}")
+        except OSError as e:
+            logger.error(f"Граф звонков недоступен: {e}")
+            return None
+        return self.call_graph
+
+    @command('contacts', 'Связи номера по графу звонков', aliases=('связи',),
+             parser=parse_number, usage='contacts <номер>')
+    async def graph_contacts(self, sender, room_id, number):
+        from call_graph import render_neighbours
+
+        graph = self.get_call_graph()
+        if graph is None:
+            return "Граф звонков не подключен"
+        result = await asyncio.to_thread(graph.neighbours, number, self.config.get('graph_limit', 20))
+        if result is None:
+            return f"Номера {number} нет в графе звонков"
+        return render_neighbours(result)
+
+    @command('common', 'Общие контакты двух номеров', aliases=('общие',),
+             parser=parse_two_numbers, usage='common <номер> <номер>')
+    async def graph_common(self, sender, room_id, first, second):
+        from call_graph import render_shared
+
+        graph = self.get_call_graph()
+        if graph is None:
+            return "Граф звонков не подключен"
+        contacts = await asyncio.to_thread(graph.shared_contacts, first, second, self.config.get('graph_limit', 20))
+        if contacts is None:
+            return f"Одного из номеров ({first}, {second}) нет в графе звонков"
+        return render_shared(first, second, contacts)
+
+    @command('chain', 'Пути от номера до группы (через одного посредника)', aliases=('цепочка',),
+             parser=parse_number_and_group, usage='chain <номер> <группа>')
+    async def graph_chain(self, sender, room_id, number, group):
+        from call_graph import render_paths
+
+        graph = self.get_call_graph()
+        if graph is None:
+            return "Граф звонков не подключен"
+        paths = await asyncio.to_thread(graph.paths_to_group, number, group, self.config.get('graph_limit', 20))
+        if paths is None:
+            return f"Номера {number} или группы {group} нет в графе звонков"
+        return render_paths(number, group, paths)
+
     async def calculate(self, sender, room_id, *args):
         if not args:
             return "Укажите выражение для вычисления (например: calc 2+2)"
@@ -385,17 +800,41 @@ class RocketChatBot:
         """Основной цикл"""
         self.running = True
         asyncio.create_task(self.cleanup_contexts())  # Добавить эту строку
+        asyncio.create_task(self.log_stats())
 
         if not await self.connect():
             self.running = False
             return
 
-        logger.info("Бот запущен. Ожидание сообщений...")
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error("Эндпоинт метрик не запущен: %s", e)
+                self.metrics_server = None
 
         try:
+            # Ошибка загрузки модели тоже проходит через finally: пулы и базы закрываются
+            if self.classifier is not None:
+                await self.classifier.start()
+
+            logger.info("Бот запущен. Ожидание сообщений...")
+            self.dispatcher.start()
+            if self.cluster is not None:
+                asyncio.create_task(self.maintain_cluster())
+            self.outbox.start()
+
+            if self.config.get('realtime'):
+                ws_url = self.config.get('ws_url') or ws_url_from_server(self.config['server_url'])
+                self.realtime = RealtimeClient(self, ws_url)
+                asyncio.create_task(self.realtime.run())
+
             while self.running:
-                await self.get_new_messages()
-                await asyncio.sleep(3)  # Проверка каждые 3 секунды
+                # В realtime-режиме опрос нужен только пока WebSocket не подключен
+                if self.realtime is None or not self.realtime.connected:
+                    with POLL_SECONDS.time():
+                        await self.get_new_messages()
+                await asyncio.sleep(self.config.get('poll_interval', 3))  # Проверка каждые poll_interval секунд
 
         except KeyboardInterrupt:
             logger.info("Остановка по запросу пользователя")
@@ -403,6 +842,31 @@ class RocketChatBot:
             logger.error(f"Ошибка: {e}")
         finally:
             self.running = False
+            if self.profiler is not None:
+                self.profiler.stop()
+            if self.metrics_server is not None:
+                await self.metrics_server.close()
+            # Доделываем принятые сообщения: их id уже в хранилище дедупликации,
+            # и после перезапуска (или другой репликой) они не будут обработаны
+            drain_timeout = self.config.get('shutdown_timeout', self.cluster.ttl if self.cluster is not None else 10)
+            try:
+                await asyncio.wait_for(self.dispatcher.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Очереди не разобраны за {drain_timeout} с, в очередях: {self.dispatcher.in_flight}")
+            await self.dispatcher.stop()
+            if self.cluster is not None:
+                # Разделы сразу отдаем остальным репликам
+                await self.cluster.leave()
+                self.cluster.close()
+            await self.outbox.close()
+            if self.classifier is not None:
+                await self.classifier.stop()
+            await self.jobs.close()
+            self.job_executor.shutdown(wait=False, cancel_futures=True)
+            if self.transport is not None:
+                await self.transport.close()
+            await self.processed_messages.close()
+            await self.user_contexts.close()
             logger.info("Бот остановлен")
 
 
@@ -410,7 +874,17 @@ if __name__ == "__main__":
     config = {
         'server_url': 'http://localhost:3000',
         'username': 'ArbiTrue',
-        'password': 'ArbiTrue'
+        'password': 'ArbiTrue',
+        # Прием сообщений через WebSocket вместо опроса каждые 3 секунды
+        'realtime': False,
+        # Файл SQLite с id обработанных сообщений (None - хранить только в памяти)
+        'dedup_path': 'processed_messages.sqlite3',
+        # Метрики в формате Prometheus на http://127.0.0.1:9108/metrics (None - выключено)
+        'metrics_port': None,
+        # Пользователи, которым доступна команда profile
+        'admins': [],
+        # Общая база реплик: при запуске нескольких процессов комнаты делятся между ними
+        'cluster_db': None
     }
 
     bot = RocketChatBot(config)
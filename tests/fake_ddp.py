@@ -0,0 +1,95 @@
+"""Минимальный DDP-сервер Rocket.Chat для проверки RealtimeClient.
+
+Понимает connect, метод login и подписку stream-room-messages; умеет
+разослать сообщение подписчикам, разорвать соединения и отклонить
+несколько следующих подписок (для проверки переподключения).
+"""
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional, Set
+
+import websockets
+
+
+class FakeDDPServer:
+    def __init__(self, password_digest: Optional[str] = None):
+        self.password_digest = password_digest
+        self.connections: Set[Any] = set()
+        # Время каждого подключения клиента (time.monotonic()), для проверки задержек
+        self.connected_at: List[float] = []
+        self.logins = 0
+        self.pongs = 0
+        self.reject_subscriptions = 0
+        self._subscribed: Dict[Any, str] = {}
+        self._ready = asyncio.Event()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f'ws://{host}:{port}/websocket'
+
+    async def start(self):
+        self._server = await websockets.serve(self._handle, '127.0.0.1', 0)
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def wait_subscribed(self, timeout: float = 5):
+        await asyncio.wait_for(self._ready.wait(), timeout)
+
+    async def push(self, message: Dict[str, Any], room_type: str = 'd'):
+        """Рассылка сообщения всем подписчикам stream-room-messages"""
+        payload = json.dumps({
+            'msg': 'changed',
+            'collection': 'stream-room-messages',
+            'id': 'id',
+            'fields': {'eventName': '__my_messages__', 'args': [message, {'roomType': room_type}]}
+        })
+        for ws in list(self._subscribed):
+            await ws.send(payload)
+
+    async def drop(self):
+        """Разрыв всех соединений, как при перезапуске сервера"""
+        self._ready.clear()
+        for ws in list(self.connections):
+            await ws.close()
+
+    async def _handle(self, ws):
+        self.connections.add(ws)
+        self.connected_at.append(time.monotonic())
+        try:
+            async for raw in ws:
+                await self._reply(ws, json.loads(raw))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(ws)
+            self._subscribed.pop(ws, None)
+
+    async def _reply(self, ws, msg: Dict[str, Any]):
+        kind = msg.get('msg')
+        if kind == 'connect':
+            # Ping до ответа: клиент должен ответить pong, не теряя connected
+            await ws.send(json.dumps({'msg': 'ping'}))
+            await ws.send(json.dumps({'msg': 'connected', 'session': 'session'}))
+        elif kind == 'pong':
+            self.pongs += 1
+        elif kind == 'method' and msg.get('method') == 'login':
+            digest = msg['params'][0]['password']['digest']
+            if self.password_digest is not None and digest != self.password_digest:
+                await ws.send(json.dumps({'msg': 'result', 'id': msg['id'], 'error': {'error': 403}}))
+                return
+            self.logins += 1
+            await ws.send(json.dumps({'msg': 'result', 'id': msg['id'], 'result': {'token': 'token'}}))
+        elif kind == 'sub':
+            if self.reject_subscriptions > 0:
+                self.reject_subscriptions -= 1
+                await ws.send(json.dumps({'msg': 'nosub', 'id': msg['id'], 'error': {'error': 'too-many-requests'}}))
+                await ws.close()
+                return
+            self._subscribed[ws] = msg['name']
+            await ws.send(json.dumps({'msg': 'ready', 'subs': [msg['id']]}))
+            self._ready.set()
@@ -0,0 +1,110 @@
+"""Cluster и LeaseStore: доли разделов по rendezvous hashing, истечение аренды, передача разделов"""
+import asyncio
+import time
+
+from cluster import Cluster, LeaseStore, partition_of, rendezvous_owner
+
+
+PARTITIONS = 16
+
+
+def share(replica, replicas):
+    return {p for p in range(PARTITIONS) if rendezvous_owner(p, replicas) == replica}
+
+
+def test_rendezvous_ownership():
+    assert rendezvous_owner(0, []) is None
+    replicas = ['a', 'b', 'c']
+    owners = {p: rendezvous_owner(p, replicas) for p in range(PARTITIONS)}
+    # Не зависит от порядка реплик
+    assert owners == {p: rendezvous_owner(p, list(reversed(replicas))) for p in range(PARTITIONS)}
+    assert set(owners.values()) == set(replicas)
+    # Пропажа реплики переносит только ее разделы
+    without_c = {p: rendezvous_owner(p, ['a', 'b']) for p in range(PARTITIONS)}
+    assert all(without_c[p] == owner for p, owner in owners.items() if owner != 'c')
+
+
+def test_new_replica_gets_its_share_after_release(tmp_path):
+    path = str(tmp_path / 'cluster.sqlite3')
+    a = LeaseStore(path, 'a', PARTITIONS)
+    b = LeaseStore(path, 'b', PARTITIONS)
+    room = next(f'room-{i}' for i in range(1000) if partition_of(f'room-{i}', PARTITIONS) in share('b', ['a', 'b']))
+
+    change = a.heartbeat({room: '2024-01-01T00:00:00.000Z'}, set())
+    assert set(change.owned) == set(range(PARTITIONS))
+    held_by_a = set(change.owned)
+
+    # Разделы живой реплики с действующей арендой не захватываются
+    change = b.heartbeat({}, set())
+    assert change.owned == {}
+    assert change.replicas == ['a', 'b']
+
+    # Доля b уходит у a в surrender, но аренда на нее продлевается до передачи
+    change = a.heartbeat({}, held_by_a)
+    assert set(change.surrender) == share('b', ['a', 'b'])
+    assert set(change.owned) == set(range(PARTITIONS))
+    assert change.acquired == []
+
+    # Пока a не отпустила разделы, повторный шаг не считает их полученными заново
+    change = a.heartbeat({}, held_by_a - set(change.surrender))
+    assert change.acquired == []
+
+    a.release(change.surrender, {})
+    change = b.heartbeat({}, set())
+    assert set(change.owned) == set(change.acquired) == share('b', ['a', 'b'])
+    # Отметки комнат переходят к новой владелице вместе с разделом
+    assert change.marks == {room: '2024-01-01T00:00:00.000Z'}
+    a.close()
+    b.close()
+
+
+def test_expired_lease_taken_over(tmp_path):
+    path = str(tmp_path / 'cluster.sqlite3')
+    a = LeaseStore(path, 'a', PARTITIONS, ttl=0.2)
+    b = LeaseStore(path, 'b', PARTITIONS, ttl=0.2)
+    a.heartbeat({}, set())
+    assert b.heartbeat({}, set()).owned == {}
+
+    # a перестала продлевать аренду (упала): после ttl ее разделы забирает b
+    time.sleep(0.3)
+    change = b.heartbeat({}, set())
+    assert change.replicas == ['b']
+    assert set(change.owned) == set(range(PARTITIONS))
+    a.close()
+    b.close()
+
+
+def test_busy_partition_kept_until_drained(tmp_path):
+    async def scenario():
+        path = str(tmp_path / 'cluster.sqlite3')
+        a = Cluster(path, 'a', PARTITIONS, ttl=5)
+        b = Cluster(path, 'b', PARTITIONS, ttl=5)
+        await a.heartbeat()
+        await b.heartbeat()
+        change = await a.heartbeat()
+        surrender = change.surrender
+        assert surrender
+        room = next(f'room-{i}' for i in range(1000) if partition_of(f'room-{i}', PARTITIONS) == surrender[0])
+        # Отдаваемые разделы a уже не обслуживает
+        assert not a.owns(room)
+
+        # Сообщение комнаты еще в обработке: раздел не отдается
+        a.accept(room)
+        drained = await a.drain(surrender, 0.05)
+        assert surrender[0] not in drained
+        await a.release(drained)
+        assert surrender[0] not in (await b.heartbeat()).owned
+
+        # Следующий шаг a продлевает аренду занятого раздела, после обработки он передается
+        change = await a.heartbeat()
+        assert surrender[0] in change.surrender
+        asyncio.get_running_loop().call_later(0.05, a.done, room)
+        assert await a.drain(change.surrender, 1) == change.surrender
+        await a.release(change.surrender)
+        await b.heartbeat()
+        assert b.owns(room)
+        assert a.stats()['handovers'] == len(surrender)
+        a.close()
+        b.close()
+
+    asyncio.run(scenario())
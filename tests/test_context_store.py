@@ -0,0 +1,71 @@
+"""SqliteContextStore: запросы вне event loop, ограниченное ожидание блокировки общей базы"""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from context_store import MemoryContextStore, SqliteContextStore
+
+
+@pytest.mark.parametrize('sqlite', [False, True])
+def test_set_get_delete_expire(tmp_path, sqlite):
+    async def scenario():
+        store = SqliteContextStore(str(tmp_path / 'contexts.sqlite3'), ttl=0.2) if sqlite else MemoryContextStore(ttl=0.2)
+        await store.set('alice', {'dialog': 'schedule', 'state': 'topic'})
+        await store.set('bob', {'dialog': 'report'})
+        assert await store.get('alice') == {'dialog': 'schedule', 'state': 'topic'}
+        await store.delete('bob')
+        assert await store.get('bob') is None
+        await asyncio.sleep(0.3)
+        assert await store.get('alice') is None
+        assert await store.expire() == ['alice']
+        assert len(store) == 0
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_calls_keep_order(tmp_path):
+    async def scenario():
+        store = SqliteContextStore(str(tmp_path / 'contexts.sqlite3'))
+        # set и delete одного пользователя выполняются в порядке вызова, даже запущенные одновременно
+        await asyncio.gather(store.set('alice', {'n': 1}), store.delete('alice'), store.set('alice', {'n': 2}))
+        assert await store.get('alice') == {'n': 2}
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_locked_database_does_not_block_loop(tmp_path):
+    path = str(tmp_path / 'contexts.sqlite3')
+
+    async def scenario():
+        store = SqliteContextStore(path, timeout=0.5)
+        # Другая реплика держит запись в общей базе
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        started = time.monotonic()
+        with pytest.raises(sqlite3.OperationalError):
+            await store.set('alice', {'n': 1})
+        elapsed = time.monotonic() - started
+        task.cancel()
+        other.rollback()
+        other.close()
+        # Ожидание ограничено timeout, и все это время event loop продолжал работу
+        assert elapsed < 2
+        assert ticks >= 20
+        await store.set('alice', {'n': 1})
+        assert await store.get('alice') == {'n': 1}
+        await store.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,131 @@
+"""Все варианты агрегации должны давать тот же вывод, что эталонный цикл aggregate_loop"""
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from know_stats import (  # noqa: E402
+    AggregateStore, aggregate, aggregate_file, aggregate_loop, filter_unknown, format_result, generate_calls,
+    nulls_as_none
+)
+
+
+@pytest.fixture
+def calls() -> 'pd.DataFrame':
+    # Пропуски ФИО с обеих сторон, повторные пары, строка с двумя неизвестными группами
+    return pd.DataFrame({
+        'date': ['2024-01-01 06:55:11', '2024-01-02 07:00:00', '2024-01-03 08:00:00', '2024-01-01 09:00:00',
+                 '2024-01-02 10:00:00', '2024-01-04 11:00:00', '2024-01-05 12:00:00', '2024-01-06 13:00:00',
+                 '2024-01-07 14:00:00', '2024-01-08 15:00:00'],
+        'tlf_call': ['100', '100', '100', '200', '200', '300', '300', '400', '400', '500'],
+        'tlf_to': ['200', '100', '111', '100', '222', '100', '100', '600', '700', '100'],
+        'fio_call': ['Иванов', 'Иванов', 'Иванов', 'Петров', 'Петров', None, None, 'Козлов', 'Козлов', 'Орлов'],
+        'fio_to': ['Петров', 'Иванов', None, 'Иванов', 'Сидоров', 'Иванов', 'Иванов', None, 'Смирнов', 'Иванов'],
+        'group_call': [None, None, None, 'A', 'B', None, None, 'B', 'B', 'A'],
+        'group_to': ['A', None, 'C', None, 'C', 'A', 'A', None, None, 'B'],
+    })
+
+
+@pytest.fixture
+def expected(calls):
+    unknown = filter_unknown(calls.assign(date=pd.to_datetime(calls['date'])))
+    return format_result(aggregate_loop(nulls_as_none(unknown)))
+
+
+def test_fixture_has_null_fio(expected):
+    fio = [entry['fio_abonents_agg'] for entry in expected]
+    assert 'None: 2' in fio
+    assert any(text.startswith('None: 1') for text in fio)
+
+
+def test_aggregate(calls, expected):
+    unknown = filter_unknown(calls.assign(date=pd.to_datetime(calls['date'])))
+    assert format_result(aggregate(unknown)) == expected
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_aggregate_file(calls, expected, tmp_path, workers):
+    path = tmp_path / 'calls.csv'
+    calls.to_csv(path, index=False)
+    assert format_result(aggregate_file(str(path), chunksize=3, workers=workers)) == expected
+
+
+def test_aggregate_store(calls, expected, tmp_path):
+    path = tmp_path / 'calls.csv'
+    calls.to_csv(path, index=False)
+    rows = pd.read_csv(path, dtype=str)
+    store = AggregateStore(str(tmp_path / 'stats.sqlite3'))
+    try:
+        # Дозагрузка частями, как выгрузки по дням
+        store.update(rows.iloc[:4])
+        store.update(rows.iloc[4:7])
+        store.update(rows.iloc[7:])
+        assert format_result(store.result()) == expected
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('date_from, date_to', [('2024-01-02', '2024-01-05'), ('2024-01-05', '2024-01-09')])
+def test_aggregate_store_period(calls, tmp_path, date_from, date_to):
+    path = tmp_path / 'calls.csv'
+    calls.to_csv(path, index=False)
+    expected = format_result(aggregate_file(
+        str(path), chunksize=3, date_from=pd.Timestamp(date_from), date_to=pd.Timestamp(date_to)))
+    assert expected
+
+    store = AggregateStore(str(tmp_path / 'stats.sqlite3'))
+    try:
+        store.update(pd.read_csv(path, dtype=str))
+        assert format_result(store.result(date_from, date_to)) == expected
+    finally:
+        store.close()
+
+
+def test_aggregate_store_sync_file(calls, expected, tmp_path):
+    path = tmp_path / 'calls.csv'
+    store = AggregateStore(str(tmp_path / 'stats.sqlite3'))
+    try:
+        # Выгрузка пополняется дописыванием: загружаются только новые строки
+        calls.iloc[:6].to_csv(path, index=False)
+        assert store.sync_file(str(path), chunksize=4) == 6
+        assert store.sync_file(str(path)) == 0
+        calls.iloc[6:].to_csv(path, index=False, header=False, mode='a')
+        assert store.sync_file(str(path), chunksize=4) == len(calls) - 6
+        assert format_result(store.result()) == expected
+
+        # Замененный (более короткий) файл - агрегаты строятся заново
+        calls.iloc[:3].to_csv(path, index=False)
+        assert store.sync_file(str(path)) == 3
+        unknown = filter_unknown(calls.iloc[:3].assign(date=pd.to_datetime(calls['date'].iloc[:3])))
+        assert format_result(store.result()) == format_result(aggregate_loop(nulls_as_none(unknown)))
+    finally:
+        store.close()
+
+
+def test_aggregate_store_sync_reads_only_appended_bytes(tmp_path):
+    calls = generate_calls(100_000, seed=1)
+    path = tmp_path / 'calls.csv'
+    calls.iloc[:90_000].to_csv(path, index=False)
+    store = AggregateStore(str(tmp_path / 'stats.sqlite3'))
+    try:
+        assert store.sync_file(str(path), chunksize=25_000) == 90_000
+
+        # Уже загруженную часть портим той же длиной: повторный разбор ее сломал бы результат
+        with open(path, 'r+b') as f:
+            f.readline()
+            row_start = f.tell()
+            row = f.readline()
+            f.seek(row_start)
+            f.write(b'x' * (len(row) - 1))
+        # Дописываемая строка без перевода строки загрузится, только когда будет дописана
+        tail = calls.iloc[90_000:].to_csv(index=False, header=False).encode('utf-8')
+        with open(path, 'ab') as f:
+            f.write(tail[:-10])
+        assert store.sync_file(str(path), chunksize=25_000) == 9_999
+        with open(path, 'ab') as f:
+            f.write(tail[-10:])
+        assert store.sync_file(str(path)) == 1
+
+        unknown = filter_unknown(calls.assign(date=pd.to_datetime(calls['date'])))
+        assert format_result(store.result()) == format_result(aggregate(unknown))
+    finally:
+        store.close()
@@ -0,0 +1,141 @@
+"""TokenBucket: разбор заголовков X-RateLimit-*; Outbox: повтор ответа после 429 и ошибок"""
+import asyncio
+import time
+
+import pytest
+
+from outbox import Outbox, TokenBucket
+
+
+def reset_in(seconds):
+    return str(int((time.time() + seconds) * 1000))
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_headers_without_rate_limit():
+    bucket = TokenBucket(None, 10)
+    assert bucket.update_from_headers({}) is False
+    assert bucket.rate is None
+    assert bucket.blocked_until == 0.0
+
+
+def test_rate_seeded_from_limit():
+    bucket = TokenBucket(None, 10)
+    assert bucket.update_from_headers({
+        'X-RateLimit-Limit': '20', 'X-RateLimit-Remaining': '19', 'X-RateLimit-Reset': reset_in(0)
+    }) is False
+    assert bucket.rate == 20
+    assert bucket.capacity == 20
+    assert bucket.tokens <= 19
+
+    # Окно 60 с: 10 запросов в минуту
+    bucket = TokenBucket(None, 10)
+    bucket.update_from_headers({
+        'X-RateLimit-Limit': '10', 'X-RateLimit-Remaining': '9', 'X-RateLimit-Reset': reset_in(60)
+    })
+    assert bucket.rate == pytest.approx(10 / 60, rel=0.05)
+
+
+def test_explicit_rate_is_kept():
+    bucket = TokenBucket(5.0, 10)
+    bucket.update_from_headers({'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '3'})
+    assert bucket.rate == 5.0
+    assert bucket.tokens <= 3
+
+
+def test_exhausted_limit_blocks_until_reset():
+    bucket = TokenBucket(None, 10)
+    assert bucket.update_from_headers({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset_in(2)}) is True
+    assert 1.5 < bucket.blocked_until - time.monotonic() <= 2.0
+    # Reset в прошлом - ждать нечего
+    bucket = TokenBucket(None, 10)
+    bucket.update_from_headers({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset_in(-5)})
+    assert bucket.blocked_until <= time.monotonic()
+
+
+def test_low_remaining_is_spread_until_reset():
+    bucket = TokenBucket(None, 10)
+    assert bucket.update_from_headers({'X-RateLimit-Remaining': '1', 'X-RateLimit-Reset': reset_in(2)}) is False
+    assert 0.7 < bucket.blocked_until - time.monotonic() <= 1.0
+
+
+def test_reset_waits_are_jittered():
+    async def scenario():
+        bucket = TokenBucket(None, 10, jitter=0.2)
+        bucket.block_for(0.1)
+        woke = []
+
+        async def waiter():
+            await bucket.acquire()
+            woke.append(time.monotonic())
+
+        started = time.monotonic()
+        await asyncio.gather(*(waiter() for _ in range(20)))
+        return started, woke
+
+    started, woke = asyncio.run(scenario())
+    assert min(woke) - started >= 0.1
+    assert max(woke) - min(woke) > 0.05
+
+
+def run_outbox(responses, **kwargs):
+    """Отправка одного ответа через Outbox с заданной последовательностью ответов сервера"""
+    calls = []
+
+    async def post(room_id, text):
+        calls.append(time.monotonic())
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def scenario():
+        outbox = Outbox(post, coalesce_window=0, **kwargs)
+        outbox.bucket.jitter = 0.0
+        outbox._backoff = lambda attempt: 0.01
+        outbox.start()
+        await outbox.send('room', 'text')
+        await outbox.close()
+        return outbox
+
+    return asyncio.run(scenario()), calls
+
+
+def test_429_is_retried_after_reset():
+    outbox, calls = run_outbox([
+        Response(429, {'X-RateLimit-Limit': '10', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset_in(0.3)}),
+        Response(200, {'X-RateLimit-Limit': '10', 'X-RateLimit-Remaining': '9'})
+    ])
+    assert outbox.stats()['sent'] == 1
+    assert outbox.rate_limited == 1
+    assert outbox.dropped == 0
+    assert calls[1] - calls[0] >= 0.2
+
+
+def test_429_without_headers_uses_backoff():
+    outbox, calls = run_outbox([Response(429), Response(429), Response(200)])
+    assert outbox.sent == 1
+    assert outbox.rate_limited == 2
+    assert len(calls) == 3
+
+
+def test_server_errors_are_retried_then_dropped():
+    outbox, calls = run_outbox([Response(502), ConnectionError('reset'), Response(200)])
+    assert outbox.sent == 1
+    assert outbox.retries == 2
+
+    outbox, calls = run_outbox([Response(500)] * 3, max_retries=2)
+    assert outbox.sent == 0
+    assert outbox.dropped == 1
+    assert len(calls) == 3
+
+
+def test_client_error_is_not_retried():
+    outbox, calls = run_outbox([Response(400)])
+    assert outbox.dropped == 1
+    assert len(calls) == 1
@@ -0,0 +1,151 @@
+"""RealtimeClient против FakeDDPServer: подписка, переподключение с задержкой, догрузка пропущенного"""
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('websockets')
+
+from fake_ddp import FakeDDPServer  # noqa: E402
+from realtime import RealtimeClient, format_ts  # noqa: E402
+
+
+class StubBot:
+    """То, что RealtimeClient использует у RocketChatBot"""
+
+    def __init__(self):
+        self.config = {'username': 'bot', 'password': 'secret'}
+        self.running = True
+        self.messages = []
+        self.catch_ups = []
+        self.room_marks = {}
+        self.fail_next = False
+
+    async def process_new_message(self, msg):
+        if self.fail_next:
+            self.fail_next = False
+            raise RuntimeError('database is locked')
+        self.messages.append(msg)
+
+    async def catch_up(self, since):
+        self.catch_ups.append(since)
+
+    def advance_mark(self, room_id, ts):
+        if ts > self.room_marks.get(room_id, ''):
+            self.room_marks[room_id] = ts
+
+
+def ddp_message(msg_id, room_id, ts):
+    return {'_id': msg_id, 'rid': room_id, 'msg': 'ping', 'u': {'_id': 'u1', 'username': 'user'},
+            'ts': {'$date': int(ts.timestamp() * 1000)}}
+
+
+async def wait_until(predicate, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError('условие не выполнилось')
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def run():
+    """Запуск сервера, бота и клиента; после теста все останавливается"""
+    async def scenario(body, **client_kwargs):
+        digest = hashlib.sha256(b'secret').hexdigest()
+        server = FakeDDPServer(password_digest=digest)
+        await server.start()
+        bot = StubBot()
+        client = RealtimeClient(bot, server.url, **client_kwargs)
+        task = asyncio.create_task(client.run())
+        try:
+            await body(server, bot, client)
+        finally:
+            bot.running = False
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.close()
+
+    return lambda body, **kwargs: asyncio.run(scenario(body, **kwargs))
+
+
+def test_subscribe_and_deliver(run):
+    async def body(server, bot, client):
+        await server.wait_subscribed()
+        await wait_until(lambda: client.connected)
+        assert server.logins == 1
+        assert server.pongs >= 1
+
+        ts = datetime.now(timezone.utc) + timedelta(seconds=1)
+        await server.push(ddp_message('m1', 'room1', ts))
+        # Не личные сообщения пропускаются
+        await server.push(ddp_message('m2', 'channel', ts), room_type='c')
+        await wait_until(lambda: bot.messages)
+        await asyncio.sleep(0.05)
+
+        assert [m['_id'] for m in bot.messages] == ['m1']
+        assert bot.room_marks == {'room1': format_ts(ts)}
+        assert client.last_seen == datetime.fromtimestamp(int(ts.timestamp() * 1000) / 1000, tz=timezone.utc)
+
+    run(body)
+
+
+def test_reconnect_catches_up_from_last_seen(run):
+    async def body(server, bot, client):
+        await server.wait_subscribed()
+        await wait_until(lambda: len(bot.catch_ups) == 1)
+        started = bot.catch_ups[0]
+
+        ts = datetime.now(timezone.utc) + timedelta(seconds=5)
+        await server.push(ddp_message('m1', 'room1', ts))
+        await wait_until(lambda: bot.messages)
+
+        await server.drop()
+        await wait_until(lambda: len(bot.catch_ups) == 2)
+        assert client.connected
+        assert server.logins == 2
+        # Первая догрузка - с момента запуска, после разрыва - с последнего увиденного сообщения
+        assert started < bot.catch_ups[1]
+        assert format_ts(bot.catch_ups[1]) == format_ts(ts)
+
+    run(body, reconnect_delay=0.01)
+
+
+def test_failed_message_is_caught_up_after_reconnect(run):
+    async def body(server, bot, client):
+        await server.wait_subscribed()
+        await wait_until(lambda: len(bot.catch_ups) == 1)
+        since = client.last_seen
+
+        bot.fail_next = True
+        await server.push(ddp_message('m1', 'room1', datetime.now(timezone.utc) + timedelta(seconds=5)))
+        # Ошибка приема рвет соединение; отметки не сдвинуты, и догрузка начнется до этого сообщения
+        await wait_until(lambda: len(bot.catch_ups) == 2)
+        assert bot.catch_ups[1] == since
+        assert bot.room_marks == {}
+
+    run(body, reconnect_delay=0.01)
+
+
+def test_reconnect_backoff(run):
+    async def body(server, bot, client):
+        await server.wait_subscribed()
+        # Следующие 4 подписки отклоняются: задержки 0.05, 0.1, 0.2, 0.2 (не больше max_reconnect_delay)
+        server.reject_subscriptions = 4
+        await server.drop()
+        await server.wait_subscribed()
+
+        attempts = server.connected_at[1:]
+        assert len(attempts) == 5
+        gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+        for gap, delay in zip(gaps, (0.1, 0.2, 0.2, 0.2)):
+            assert delay * 0.9 <= gap < delay + 0.15
+        # После успешной подписки задержка снова начальная
+        connected = len(server.connected_at)
+        await server.drop()
+        await server.wait_subscribed()
+        assert server.connected_at[-1] - server.connected_at[connected - 1] < 0.15
+        assert len(bot.catch_ups) == 3
+
+    run(body, reconnect_delay=0.05, max_reconnect_delay=0.2)
@@ -0,0 +1,257 @@
+"""Кэш токенизированного корпуса для обучающих скриптов (unbalance_classes.py, distil.py).
+
+Тексты токенизируются один раз быстрым токенизатором пачками и без
+дополнения. Идентификаторы токенов лежат подряд в файле ids.bin (int32),
+границы текстов - в offsets.npy; оба читаются через memmap, поэтому память
+не растет с размером корпуса, а воркеры DataLoader открывают файлы сами.
+Дополнение до самого длинного текста пачки делает PadCollate, а
+LengthBucketSampler собирает в пачку тексты близкой длины.
+"""
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+
+IDS_FILE = 'ids.bin'
+OFFSETS_FILE = 'offsets.npy'
+LABELS_FILE = 'labels.npy'
+META_FILE = 'meta.json'
+
+
+def fingerprint(texts: Sequence[str], labels: Sequence[int], tokenizer, max_length: int) -> str:
+    """Ключ кэша: при смене текстов, меток, токенизатора или max_length кэш строится заново"""
+    digest = hashlib.sha1(f'{tokenizer.name_or_path}|{max_length}|{len(texts)}'.encode('utf-8'))
+    for text in texts:
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(np.asarray(labels, dtype=np.int64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def build_cache(
+    path: str,
+    texts: Sequence[str],
+    labels: Sequence[int],
+    tokenizer,
+    max_length: int,
+    batch_size: int = 1000
+):
+    # Пишем во временный каталог и переименовываем: оборванная сборка не выглядит готовым кэшем
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+    with open(os.path.join(tmp, IDS_FILE), 'wb') as f:
+        for start in range(0, len(texts), batch_size):
+            encoded = tokenizer(
+                list(texts[start:start + batch_size]), truncation=True, max_length=max_length,
+                return_attention_mask=False, return_token_type_ids=False
+            )['input_ids']
+            lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+            count = int(lengths.sum())
+            f.write(np.fromiter(itertools.chain.from_iterable(encoded), dtype=np.int32, count=count).tobytes())
+            offsets.append(total + np.cumsum(lengths))
+            total += count
+
+    np.save(os.path.join(tmp, OFFSETS_FILE), np.concatenate(offsets))
+    np.save(os.path.join(tmp, LABELS_FILE), np.asarray(labels, dtype=np.int64))
+    with open(os.path.join(tmp, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump({
+            'tokenizer': tokenizer.name_or_path,
+            'max_length': max_length,
+            'texts': len(texts),
+            'tokens': total,
+            'pad_token_id': tokenizer.pad_token_id
+        }, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+class TokenizedDataset(Dataset):
+    """Датасет поверх кэша: элемент - недополненные input_ids, метка и дополнительные поля.
+
+    extra - массивы по одной строке на текст (например, логиты учителя в distil.py).
+    """
+
+    def __init__(self, path: str, **extra):
+        self.path = path
+        self.extra = extra
+        self._ids = None
+        self._offsets = None
+        self._labels = None
+
+    def _open(self):
+        self._ids = np.memmap(os.path.join(self.path, IDS_FILE), dtype=np.int32, mode='r')
+        self._offsets = np.load(os.path.join(self.path, OFFSETS_FILE), mmap_mode='r')
+        self._labels = np.load(os.path.join(self.path, LABELS_FILE), mmap_mode='r')
+
+    def __getstate__(self):
+        # В воркеры DataLoader передается только путь: memmap открывается заново, а не копируется
+        state = self.__dict__.copy()
+        state.update(_ids=None, _offsets=None, _labels=None)
+        return state
+
+    def __len__(self):
+        if self._offsets is None:
+            self._open()
+        return len(self._offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        if self._offsets is None:
+            self._open()
+        return np.diff(self._offsets)
+
+    @property
+    def labels(self) -> np.ndarray:
+        if self._labels is None:
+            self._open()
+        return np.asarray(self._labels)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        if self._ids is None:
+            self._open()
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+        item = {
+            'input_ids': torch.from_numpy(self._ids[start:end].astype(np.int64)),
+            'labels': int(self._labels[idx])
+        }
+        for key, values in self.extra.items():
+            item[key] = values[idx]
+        return item
+
+
+def cached_dataset(
+    root: str,
+    texts: Sequence[str],
+    labels: Sequence[int],
+    tokenizer,
+    max_length: int,
+    **extra
+) -> TokenizedDataset:
+    """Датасет из кэша в root; при первом обращении (или смене данных) кэш строится"""
+    path = os.path.join(root, fingerprint(texts, labels, tokenizer, max_length))
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        build_cache(path, texts, labels, tokenizer, max_length)
+    return TokenizedDataset(path, **extra)
+
+
+class PadCollate:
+    """Сборка пачки с дополнением до самого длинного текста в ней, а не до max_length.
+
+    Класс, а не замыкание - чтобы передаваться в воркеры DataLoader.
+    """
+
+    def __init__(self, pad_token_id: int):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, items: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        width = max(len(item['input_ids']) for item in items)
+        input_ids = torch.full((len(items), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(items), width), dtype=torch.long)
+        for row, item in enumerate(items):
+            size = len(item['input_ids'])
+            input_ids[row, :size] = item['input_ids']
+            attention_mask[row, :size] = 1
+
+        batch = {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': torch.tensor([item['labels'] for item in items], dtype=torch.long)
+        }
+        for key in items[0]:
+            if key not in batch:
+                batch[key] = torch.stack([torch.as_tensor(item[key]) for item in items])
+        return batch
+
+
+class LengthBucketSampler(Sampler):
+    """Пачки из текстов близкой длины.
+
+    Индексы перемешиваются и режутся на корзины по bucket_size; внутри корзины
+    тексты сортируются по длине и режутся на пачки, затем пачки перемешиваются.
+    Каждая эпоха перемешивается по-своему. При обучении в нескольких процессах
+    (world_size > 1) процесс rank берет каждую world_size-ю пачку, а хвост,
+    который не делится поровну, отбрасывается - у всех процессов одно число шагов.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        bucket_size: Optional[int] = None,
+        seed: int = 0,
+        rank: int = 0,
+        world_size: int = 1
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        # Корзина кратна пачке, чтобы неполной была только последняя пачка
+        self.bucket_size = batch_size * max(1, (bucket_size or batch_size * 50) // batch_size)
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size // self.world_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        # Сид одинаков во всех процессах, поэтому порядок пачек у них совпадает
+        generator = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        indices = generator.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+        random.Random(self.seed + self.epoch).shuffle(batches)
+        if self.world_size > 1:
+            batches = batches[:len(batches) // self.world_size * self.world_size][self.rank::self.world_size]
+        return iter(batches)
+
+
+class FlatSampler(Sampler):
+    """Индексы пачек batch_sampler подряд - для Trainer, который сам режет поток на пачки"""
+
+    def __init__(self, batch_sampler: Sampler):
+        self.batch_sampler = batch_sampler
+
+    def __len__(self):
+        return len(self.batch_sampler.lengths)
+
+    def __iter__(self) -> Iterator[int]:
+        return itertools.chain.from_iterable(self.batch_sampler)
+
+
+def make_dataloader(
+    dataset: TokenizedDataset,
+    batch_size: int,
+    pad_token_id: int,
+    shuffle: bool = True,
+    num_workers: int = 0,
+    seed: int = 0,
+    rank: int = 0,
+    world_size: int = 1
+) -> DataLoader:
+    collate = PadCollate(pad_token_id)
+    if shuffle:
+        return DataLoader(
+            dataset,
+            batch_sampler=LengthBucketSampler(dataset.lengths, batch_size, seed=seed, rank=rank, world_size=world_size),
+            collate_fn=collate,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0
+        )
+    return DataLoader(dataset, batch_size=batch_size, collate_fn=collate, num_workers=num_workers)
@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from rocketchat_API.rocketchat import RocketChat
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+REST_SECONDS = metrics.histogram('rocketchat_rest_seconds', 'Задержка REST-вызова Rocket.Chat', ['method'])
+REST_ERRORS = metrics.counter('rocketchat_rest_errors_total', 'REST-вызовы, завершившиеся исключением', ['method'])
+
+
+class AsyncTransport:
+    """Асинхронный интерфейс к REST API Rocket.Chat.
+
+    Все REST-вызовы бота проходят через транспорт, поэтому реализацию
+    (пул потоков, aiohttp, фейковый сервер в тестах) можно подменить,
+    не трогая RocketChatBot. Методы возвращают объект ответа с .json(),
+    .status_code и .headers (как у requests.Response).
+    """
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def me(self):
+        raise NotImplementedError
+
+    async def im_list(self, **kwargs):
+        raise NotImplementedError
+
+    async def im_history(self, room_id: str, **kwargs):
+        raise NotImplementedError
+
+    async def chat_post_message(self, room_id: str, text: str, **kwargs):
+        raise NotImplementedError
+
+    async def download_file(self, path: str, dest: str) -> int:
+        """Потоковое скачивание файла сервера (например, вложения) в файл dest; возвращает число байт.
+        Разбор файла - дело вызывающего (обычно в пуле процессов задач), потоки транспорта он не занимает"""
+        raise NotImplementedError
+
+    async def upload_file(self, room_id: str, filename: str, content: bytes, description: str = ''):
+        """Отправка файла в комнату"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class ThreadPoolTransport(AsyncTransport):
+    """Адаптер синхронного клиента rocketchat_API на ограниченном пуле потоков.
+
+    Каждый вызов выполняется в ThreadPoolExecutor, так что event loop не
+    блокируется, а запросы к разным комнатам идут параллельно (не больше
+    max_workers одновременно). Общая requests.Session с пулом keep-alive
+    соединений того же размера избавляет от TCP/TLS-рукопожатия на каждый запрос.
+    """
+
+    def __init__(self, config: Dict[str, Any], max_workers: int = 16):
+        self.config = config
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rocket-rest')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.rocket: Optional[RocketChat] = None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _timed(self, method: str, func, *args, **kwargs):
+        # Время включает ожидание свободного потока пула - его бот и видит как задержку вызова
+        with REST_SECONDS.time(method=method):
+            try:
+                return await self._run(func, *args, **kwargs)
+            except Exception:
+                REST_ERRORS.inc(method=method)
+                raise
+
+    async def _call(self, method: str, *args, **kwargs):
+        """Единая точка вызова метода клиента RocketChat в пуле потоков"""
+        return await self._timed(method, getattr(self.rocket, method), *args, **kwargs)
+
+    async def connect(self):
+        # Конструктор RocketChat сразу делает login - это тоже сетевой вызов
+        self.rocket = await self._run(
+            RocketChat,
+            user=self.config['username'],
+            password=self.config['password'],
+            server_url=self.config['server_url'],
+            session=self.session
+        )
+
+    async def me(self):
+        return await self._call('me')
+
+    async def im_list(self, **kwargs):
+        return await self._call('im_list', **kwargs)
+
+    async def im_history(self, room_id: str, **kwargs):
+        return await self._call('im_history', room_id=room_id, **kwargs)
+
+    async def chat_post_message(self, room_id: str, text: str, **kwargs):
+        return await self._call('chat_post_message', text=text, room_id=room_id, **kwargs)
+
+    async def download_file(self, path: str, dest: str) -> int:
+        def download():
+            url = self.config['server_url'].rstrip('/') + path
+            # Заголовки авторизации (X-Auth-Token, X-User-Id) выставлены клиентом при login
+            with self.session.get(url, headers=self.rocket.headers, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with open(dest, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f, 1 << 20)
+                    return f.tell()
+
+        return await self._timed('download_file', download)
+
+    async def upload_file(self, room_id: str, filename: str, content: bytes, description: str = ''):
+        def upload():
+            # rooms_upload принимает путь к файлу; имя файла в чате - имя на диске
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, filename)
+                with open(path, 'wb') as f:
+                    f.write(content)
+                return self.rocket.rooms_upload(rid=room_id, file=path, description=description)
+
+        return await self._timed('rooms_upload', upload)
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -1,105 +1,208 @@
+import argparse
+
 import pandas as pd
 import numpy as np
 import torch
+import torch.nn.functional as F
+from sklearn.metrics import precision_recall_fscore_support
 from sklearn.model_selection import train_test_split
-from transformers import BertTokenizer, BertForSequenceClassification, Trainer, TrainingArguments
-from torch.utils.data import Dataset
-
-# Загружаем и подготавливаем данные
-data = {
-    'text': ['текст 1', 'текст 2', '...', 'текст с классом 1'] * 10000,
-    'label': [1] * 37000 + [0] * 4000
-}
-df = pd.DataFrame(data)
-
-# Разделяем данные на обучающую и тестовую выборки
-X_train, X_test, y_train, y_test = train_test_split(df['text'], df['label'], test_size=0.1, random_state=42)
-
-# Класс для создания датасета
-class CustomDataset(Dataset):
-    def __init__(self, texts, labels, tokenizer, max_len):
-        self.texts = texts
-        self.labels = labels
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-    
-    def __len__(self):
-        return len(self.texts)
-    
-    def __getitem__(self, idx):
-        text = self.texts[idx]
-        label = self.labels[idx]
-        
-        encoding = self.tokenizer.encode_plus(
-            text,
-            max_length=self.max_len,
-            truncation=True,
-            padding='max_length',
-            return_tensors='pt'
-        )
-        
-        return {
-            'input_ids': encoding['input_ids'].flatten(),
-            'attention_mask': encoding['attention_mask'].flatten(),
-            'labels': torch.tensor(label, dtype=torch.long)
-        }
-
-# Инициализация токенизатора и датасетов
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-train_dataset = CustomDataset(X_train.tolist(), y_train.tolist(), tokenizer, max_len=128)
-test_dataset = CustomDataset(X_test.tolist(), y_test.tolist(), tokenizer, max_len=128)
-
-# Настройки обучения
-training_args = TrainingArguments(
-    output_dir='./results',
-    num_train_epochs=3,
-    per_device_train_batch_size=16,
-    per_device_eval_batch_size=64,
-    warmup_steps=500,
-    weight_decay=0.01,
-    logging_dir='./logs',
-    logging_steps=10,
-)
-
-# Инициализация модели
-model = BertForSequenceClassification.from_pretrained('bert-base-uncased', num_labels=2)
-
-# Взвешивание классов
 from sklearn.utils.class_weight import compute_class_weight
+from torch.utils.data import WeightedRandomSampler
+from transformers import BertTokenizerFast, BertForSequenceClassification, Trainer, TrainingArguments
 
-class_weights = compute_class_weight('balanced', classes=np.unique(y_train), y=y_train)
-class_weights = torch.tensor(class_weights, dtype=torch.float)
+from token_cache import FlatSampler, LengthBucketSampler, PadCollate, cached_dataset
 
-# Обучение
-class_weights = class_weights.to('cuda') if torch.cuda.is_available() else class_weights
 
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=train_dataset,
-    eval_dataset=test_dataset,
-    compute_metrics=lambda p: {
-        'accuracy': (p.predictions.argmax(-1) == p.label_ids).mean(),
+def load_data() -> pd.DataFrame:
+    # Загружаем и подготавливаем данные
+    data = {
+        # 41000 текстов: по числу меток ниже (37000 + 4000)
+        'text': ['текст 1', 'текст 2', '...', 'текст с классом 1'] * 10250,
+        'label': [1] * 37000 + [0] * 4000
     }
-)
+    return pd.DataFrame(data)
+
+
+def split_data(df: pd.DataFrame):
+    # Разделяем данные на обучающую и тестовую выборки
+    return train_test_split(df['text'], df['label'], test_size=0.1, random_state=42)
+
+
+def resample(texts: pd.Series, labels: pd.Series, strategy: str, seed: int = 42):
+    """Выравнивание классов обучающей выборки.
+
+    over  - строки малых классов повторяются случайно до размера самого большого
+    under - из больших классов случайно берется столько строк, сколько в самом малом
+    """
+    counts = labels.value_counts()
+    target = counts.max() if strategy == 'over' else counts.min()
+    rng = np.random.default_rng(seed)
+    parts = []
+    for label in counts.index:
+        positions = np.flatnonzero(labels.to_numpy() == label)
+        if strategy == 'over':
+            extra = rng.choice(positions, target - len(positions), replace=True)
+            positions = np.concatenate([positions, extra])
+        else:
+            positions = rng.choice(positions, target, replace=False)
+        parts.append(positions)
+    positions = rng.permutation(np.concatenate(parts))
+    return texts.iloc[positions], labels.iloc[positions]
+
+
+def focal_loss(logits, labels, weight=None, gamma=2.0):
+    """Focal loss: уверенно угаданные примеры (p -> 1) почти не дают вклада, обучение идет на трудных"""
+    log_p = F.log_softmax(logits, dim=-1).gather(1, labels.unsqueeze(1)).squeeze(1)
+    loss = -(1 - log_p.exp()) ** gamma * log_p
+    if weight is None:
+        return loss.mean()
+    # Нормировка как у взвешенной cross_entropy
+    sample_weight = weight[labels]
+    return (loss * sample_weight).sum() / sample_weight.sum()
+
+
+def per_class_metrics(predictions, label_ids):
+    """accuracy, macro-F1 и precision/recall/F1 по каждому классу"""
+    predicted = predictions.argmax(-1)
+    classes = np.unique(np.concatenate([label_ids, predicted]))
+    precision, recall, f1, support = precision_recall_fscore_support(
+        label_ids, predicted, labels=classes, zero_division=0
+    )
+    metrics = {
+        'accuracy': float((predicted == label_ids).mean()),
+        'macro_f1': float(f1.mean())
+    }
+    for index, label in enumerate(classes):
+        metrics[f'precision_{label}'] = float(precision[index])
+        metrics[f'recall_{label}'] = float(recall[index])
+        metrics[f'f1_{label}'] = float(f1[index])
+        metrics[f'support_{label}'] = int(support[index])
+    return metrics
+
+
+class WeightedTrainer(Trainer):
+    """Trainer со взвешенной (или focal) функцией потерь и своим порядком обучающих примеров.
 
-trainer.train()
+    class_weights - веса классов для cross_entropy / focal loss (None - без весов)
+    focal_gamma   - > 0 включает focal loss
+    sampler       - 'length': пачки из текстов близкой длины (LengthBucketSampler),
+                    'balanced': классы выбираются равновероятно (WeightedRandomSampler)
+    """
 
-# Сохраняем модель
-model.save_pretrained('./my_model')
-tokenizer.save_pretrained('./my_model')
+    def __init__(self, *args, class_weights=None, focal_gamma=0.0, sampler='length', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.class_weights = class_weights
+        self.focal_gamma = focal_gamma
+        self.sampler = sampler
 
-# Использование модели для предсказаний
-def predict(text):
-    model.eval()
-    inputs = tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=128)
-    with torch.no_grad():
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        labels = inputs.pop('labels')
         outputs = model(**inputs)
-    predictions = torch.argmax(outputs.logits, dim=1)
-    return predictions.item()
+        logits = outputs.logits
+        weight = self.class_weights.to(logits.device) if self.class_weights is not None else None
+        if self.focal_gamma > 0:
+            loss = focal_loss(logits, labels, weight, self.focal_gamma)
+        else:
+            loss = F.cross_entropy(logits, labels, weight=weight)
+        return (loss, outputs) if return_outputs else loss
+
+    def _get_train_sampler(self, *args, **kwargs):
+        dataset = self.train_dataset
+        if self.sampler == 'balanced':
+            labels = dataset.labels
+            counts = np.bincount(labels)
+            weights = torch.as_tensor(1.0 / counts[labels], dtype=torch.double)
+            return WeightedRandomSampler(weights, num_samples=len(labels), replacement=True)
+        batch_size = self.args.per_device_train_batch_size * self.args.gradient_accumulation_steps
+        return FlatSampler(LengthBucketSampler(dataset.lengths, batch_size, seed=self.args.seed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Обучение классификатора на несбалансированных классах')
+    parser.add_argument('--loss', choices=['ce', 'weighted', 'focal'],
+                        help='ce - без весов, weighted - веса balanced, focal - focal loss с весами balanced '
+                             '(по умолчанию weighted, а с --sampler balanced - ce)')
+    parser.add_argument('--focal-gamma', type=float, default=2.0)
+    parser.add_argument('--sampler', choices=['length', 'balanced'], default='length',
+                        help='balanced выравнивает классы в пачках; веса в потерях тогда не используются')
+    parser.add_argument('--resample', choices=['none', 'over', 'under'], default='none',
+                        help='выровнять классы обучающей выборки повтором малых или прореживанием больших')
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args()
+    # Сэмплер balanced уже выравнивает классы: веса в потерях учли бы дисбаланс второй раз
+    if args.loss is None:
+        args.loss = 'ce' if args.sampler == 'balanced' else 'weighted'
+    elif args.loss == 'weighted' and args.sampler == 'balanced':
+        parser.error("--loss weighted с --sampler balanced учитывает дисбаланс дважды: используйте --loss ce")
+
+    X_train, X_test, y_train, y_test = split_data(load_data())
+    if args.resample != 'none':
+        X_train, y_train = resample(X_train, y_train, args.resample)
+
+    # Инициализация токенизатора и датасетов: тексты токенизируются один раз в кэш ./token_cache
+    tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+    train_dataset = cached_dataset('./token_cache', X_train.tolist(), y_train.tolist(), tokenizer, max_length=128)
+    test_dataset = cached_dataset('./token_cache', X_test.tolist(), y_test.tolist(), tokenizer, max_length=128)
+
+    # Настройки обучения
+    training_args = TrainingArguments(
+        output_dir='./results',
+        num_train_epochs=args.epochs,
+        per_device_train_batch_size=16,
+        per_device_eval_batch_size=64,
+        warmup_steps=500,
+        weight_decay=0.01,
+        logging_dir='./logs',
+        logging_steps=10,
+        dataloader_num_workers=2,
+    )
+
+    # Инициализация модели
+    model = BertForSequenceClassification.from_pretrained('bert-base-uncased', num_labels=2)
+
+    # Взвешивание классов: веса считаются по выборке после resample и передаются в функцию потерь
+    class_weights = None
+    # focal с --sampler balanced - только фокусировка на трудных примерах, без весов
+    if args.loss != 'ce' and args.sampler != 'balanced':
+        class_weights = compute_class_weight('balanced', classes=np.unique(y_train), y=y_train)
+        class_weights = torch.tensor(class_weights, dtype=torch.float)
+        print(f"Веса классов: {class_weights.tolist()}")
+
+    # Обучение
+    trainer = WeightedTrainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=test_dataset,
+        data_collator=PadCollate(tokenizer.pad_token_id),
+        compute_metrics=lambda p: per_class_metrics(p.predictions, p.label_ids),
+        class_weights=class_weights,
+        focal_gamma=args.focal_gamma if args.loss == 'focal' else 0.0,
+        sampler=args.sampler
+    )
+
+    trainer.train()
+    for name, value in trainer.evaluate().items():
+        print(f"{name}: {value}")
+
+    # Сохраняем модель
+    model.save_pretrained('./my_model')
+    tokenizer.save_pretrained('./my_model')
+
+    # Использование модели для предсказаний
+    def predict(text):
+        model.eval()
+        inputs = tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=128)
+        with torch.no_grad():
+            outputs = model(**inputs)
+        predictions = torch.argmax(outputs.logits, dim=1)
+        return predictions.item()
+
+    # Пример предсказания
+    new_text = "Тестовый текст для предсказания"
+    prediction = predict(new_text)
+    print(f"Предсказанный класс: {prediction}")
 
-# Пример предсказания
-new_text = "Тестовый текст для предсказания"
-prediction = predict(new_text)
-print(f"Предсказанный класс: {prediction}")
 
+if __name__ == '__main__':
+    main()